@@ -54,13 +54,24 @@ class QuestRequirementAdmin(admin.ModelAdmin):
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
+class CharacterItemAdmin(admin.ModelAdmin):
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        models.CharacterStats.rebuild(obj.character_id)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        models.CharacterStats.rebuild(obj.character_id)
+
+
 admin.site.register(models.Resources)
 admin.site.register(models.CustomUser, UserAdmin)
 admin.site.register(models.Character)
 admin.site.register(models.UserItems)
 admin.site.register(models.UserPotions)
 admin.site.register(models.UserCollectableItem)
-admin.site.register(models.CharacterItem)
+admin.site.register(models.CharacterItem, CharacterItemAdmin)
 admin.site.register(models.Item)
 admin.site.register(models.Potion)
 admin.site.register(models.CollectableItem)
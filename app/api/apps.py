@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Connect cache invalidation, player provisioning, state sync and notification receivers
+        from api import authentication, caching, content, metrics, notifications, provisioning, sync, world  # noqa: F401
@@ -0,0 +1,98 @@
+import copy
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from api.caching import LocalCache
+
+
+TOKEN_CACHE_TIMEOUT = 300
+# Longest time another process may still accept a deleted token or a deactivated user
+TOKEN_LOCAL_TIMEOUT = 5
+TOKEN_LOCAL_MAX_SIZE = 10_000
+
+_local = LocalCache(max_size=TOKEN_LOCAL_MAX_SIZE, timeout=TOKEN_LOCAL_TIMEOUT)
+
+
+def token_cache_key(key):
+    # Token keys are credentials, the shared cache only sees their digest
+    return f'api:auth:token:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+def forget_tokens(keys):
+    for key in keys:
+        cache_key = token_cache_key(key)
+        _local.delete(cache_key)
+        caches[settings.API_CACHE_ALIAS].delete(cache_key)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication keeping the token and its user in the API cache.
+
+    Tokens live in a small per-process tier in front of the shared cache, so
+    most requests authenticate without a query. The shared tier only holds the
+    user id and flags, never the key or the user's password hash, a hit there
+    costs one user lookup by pk. Deleting a token or saving its user drops the
+    entry, other processes may keep using their local copy for up to
+    TOKEN_LOCAL_TIMEOUT seconds.
+    """
+
+    def authenticate_credentials(self, key):
+        cache_key = token_cache_key(key)
+        token = _local.get(cache_key)
+        if token is None:
+            token = self.load_token(key, cache_key)
+            _local.set(cache_key, token)
+
+        # Views get their own copies, cached instances are shared between requests
+        token = copy.copy(token)
+        token.user = copy.copy(token.user)
+        return token.user, token
+
+    def load_token(self, key, cache_key):
+        shared = caches[settings.API_CACHE_ALIAS]
+        entry = shared.get(cache_key)
+        if entry is not None:
+            if not entry['is_active']:
+                raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+            try:
+                user = get_user_model().objects.get(pk=entry['user_id'])
+            except get_user_model().DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            return self.get_model()(key=key, user=user, created=entry['created'])
+
+        try:
+            token = self.get_model().objects.select_related('user').get(key=key)
+        except self.get_model().DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        shared.set(
+            cache_key, {'user_id': token.user_id, 'is_active': token.user.is_active, 'created': token.created},
+            TOKEN_CACHE_TIMEOUT
+        )
+        return token
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    # The key is the pk, which the instance loses once deleted
+    key = instance.key
+    transaction.on_commit(lambda: forget_tokens([key]))
+
+
+@receiver(post_save, sender=get_user_model())
+def forget_user_tokens(sender, instance, created, **kwargs):
+    # Covers deactivation as well as any other change of the cached user
+    if not created:
+        keys = list(Token.objects.filter(user=instance).values_list('key', flat=True))
+        transaction.on_commit(lambda: forget_tokens(keys))
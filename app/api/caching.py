@@ -0,0 +1,193 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from api import models
+
+
+LOCAL_MAX_SIZE = 1024
+LOCAL_TIMEOUT = 60
+SHARED_TIMEOUT = 300
+# Longest time a process keeps using a generation after another process bumped it
+GENERATION_TIMEOUT = 1
+
+
+def initial_version():
+    # Counters start from the clock, so after a flush or eviction of the cache a
+    # restarted counter never repeats a number some worker still has data for
+    return time.time_ns() // 1000
+
+
+def get_version(cache, key):
+    return cache.get_or_set(key, initial_version, None)
+
+
+def incr_version(cache, key):
+    """Increase a counter kept in a Django-compatible cache, starting it when missing"""
+    cache.add(key, initial_version(), None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Key evicted between add and incr
+        version = initial_version()
+        cache.set(key, version, None)
+        return version
+
+
+class LocalCache:
+    """Thread-safe in-process cache with TTL and LRU eviction.
+
+    Implements the subset of the Django cache API used here, so it can also
+    stand in for the shared tier in tests.
+    """
+
+    def __init__(self, max_size=LOCAL_MAX_SIZE, timeout=LOCAL_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=-1):
+        timeout = self.timeout if timeout == -1 else timeout
+        expires = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def add(self, key, value, timeout=-1):
+        with self.lock:
+            if key in self.data:
+                return False
+        self.set(key, value, timeout)
+        return True
+
+    def get_or_set(self, key, default, timeout=-1):
+        value = self.get(key)
+        if value is None:
+            # Callable defaults are called, as in Django's caches
+            if callable(default):
+                default = default()
+            self.add(key, default, timeout)
+            value = self.get(key, default)
+        return value
+
+    def incr(self, key, delta=1):
+        with self.lock:
+            if key not in self.data:
+                raise ValueError(f"Key '{key}' not found")
+            value, expires = self.data[key]
+            self.data[key] = (value + delta, expires)
+            return value + delta
+
+    def delete(self, key):
+        with self.lock:
+            return self.data.pop(key, None) is not None
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class ModelCache:
+    """Read-through cache for a model, looked up by pk or by field filters.
+
+    Values live in a small local tier in front of a shared tier (a Django cache
+    alias by default). Every key carries a generation number kept in the shared
+    tier, any save or delete of the model or of ``depends_on`` models bumps it and
+    so drops all entries of this cache in every process, other processes notice
+    within GENERATION_TIMEOUT seconds. Returned instances are shared between
+    requests and must not be modified.
+    """
+
+    def __init__(self, model, select_related=(), depends_on=(), local=None, shared=None):
+        self.model = model
+        self.name = model._meta.label_lower
+        self.select_related = select_related
+        self.local = local or LocalCache()
+        self._shared = shared
+
+        for sender in (model, *depends_on):
+            uid = f'model_cache_{self.name}_{sender._meta.label_lower}'
+            post_save.connect(self.invalidate, sender=sender, dispatch_uid=uid, weak=False)
+            post_delete.connect(self.invalidate, sender=sender, dispatch_uid=uid, weak=False)
+
+    @property
+    def shared(self):
+        if self._shared is None:
+            return caches[settings.API_CACHE_ALIAS]
+        return self._shared
+
+    @shared.setter
+    def shared(self, cache):
+        self._shared = cache
+
+    def get_generation(self):
+        # Kept locally for a moment, so reads don't each cost a shared tier round trip
+        key = f'api:{self.name}:generation'
+        generation = self.local.get(key)
+        if generation is None:
+            generation = get_version(self.shared, key)
+            self.local.set(key, generation, GENERATION_TIMEOUT)
+        return generation
+
+    def invalidate(self, *args, **kwargs):
+        # Bumping before commit would let other workers cache the old rows under the new generation
+        transaction.on_commit(self.bump_generation)
+
+    def bump_generation(self):
+        incr_version(self.shared, f'api:{self.name}:generation')
+        self.local.clear()
+
+    def get_queryset(self):
+        return self.model.objects.select_related(*self.select_related).order_by('pk')
+
+    def read_through(self, suffix, load):
+        key = f'api:{self.name}:{self.get_generation()}:{suffix}'
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        value = self.shared.get(key)
+        if value is None:
+            value = load()
+            self.shared.set(key, value, SHARED_TIMEOUT)
+        self.local.set(key, value)
+        return value
+
+    def get(self, pk):
+        # Misses are not cached, an unknown pk always goes to the database
+        return self.read_through(f'pk:{int(pk)}', lambda: self.get_queryset().get(pk=pk))
+
+    def filter(self, **lookups):
+        suffix = ','.join(f'{field}={value}' for field, value in sorted(lookups.items()))
+        return self.read_through(f'filter:{suffix}', lambda: list(self.get_queryset().filter(**lookups)))
+
+    def all(self):
+        return self.read_through('all', lambda: list(self.get_queryset()))
+
+
+item_cache = ModelCache(models.Item)
+enemy_cache = ModelCache(models.Enemy)
+enemy_loot_cache = ModelCache(models.EnemyLoot, select_related=('item',), depends_on=(models.Item,))
+store_cache = ModelCache(models.Store, select_related=('npc',), depends_on=(models.NPC,))
+store_item_cache = ModelCache(models.StoreItem, select_related=('item',), depends_on=(models.Item,))
+user_lvl_cache = ModelCache(models.UserLvl)
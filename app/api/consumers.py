@@ -1,110 +1,341 @@
+import asyncio
 import json
-from channels.generic.websocket import WebsocketConsumer
+import uuid
+from collections import Counter
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
 
 from api import models
 from api import serializers
-from api.fight import Fight
+from api.authentication import CachedTokenAuthentication
+from api.fight import Fight, FightSession
+from api.metrics import MetricsConsumerMixin
+from api.notifications import get_travel_scheduler, notify, travel_payload, user_group
+from api.renderers import dumps, loads
+
+
+# Seconds a resumed fight holds actions for the previous owner's state before going on from the snapshot
+HANDOVER_TIMEOUT = 2
+
 
-class CombatSystemConsumer(WebsocketConsumer):
-    def connect(self):
+class CombatSystemConsumer(MetricsConsumerMixin, AsyncWebsocketConsumer):
+    """Combat session, turns are computed in the event loop and only fight start,
+    periodic snapshots and fight end touch the database.
+
+    Every connection to a fight joins its channel layer group. The consumer that
+    joined last owns the fight session and computes turns, the others forward
+    their client's actions to it, and all updates are sent through the group,
+    so a fight can be driven from connections on any node. The owner's channel
+    is kept in models.Fight, and a new owner of a fight that still had one holds
+    the actions it gets until the previous owner has handed over its state.
+    """
+
+    async def connect(self):
             self.user = None
             self.userTurnDone = True
             self.enemyTurnDone = True
             self.enemy = None
+            self.enemyId = None
+            self.userEmail = None
             self.winner = False
             self.loot = None
+            self.drops = []
             self.lvl = None
             self.expPoints = None
             self.exp = None
             self.gained_exp = 0
             self.fightInfo = Fight()
-            self.accept()
+            self.session = None
+            self.group = None
+            # Actions held until the handover, None once the session accepts them
+            self.pending_actions = None
+            self.handover_id = None
+            self.handover_timeout = None
+            await self.accept()
+
+    async def disconnect(self, close_code):
+        self.cancel_handover_timeout()
+        if self.group is None:
+            return
+        await self.channel_layer.group_discard(self.group, self.channel_name)
 
-    def disconnect(self, close_code):
-        # Leave the room group
-        self.close()
+        if self.session and self.session.record.isActive:
+            # Keep the latest state so the fight can be resumed after reconnecting
+            if self.session.dirty:
+                await database_sync_to_async(self.session.snapshot)()
+            await database_sync_to_async(self.session.release)(self.channel_name)
+            # Remaining connections resume from the snapshot
+            await self.channel_layer.group_send(self.group, {'type': 'fight.released'})
 
-    def handle_user_attack(self):
+    async def join_fight(self):
+        self.enemy, self.user, self.session, resumed = await self.start_fight()
+        self.group = f'fight_{self.session.record.pk}'
+        await self.channel_layer.group_add(self.group, self.channel_name)
+
+        if resumed:
+            await self.send(text_data=dumps({
+                'fightResumed': True,
+                'character': serializers.CharacterSerializer(self.user).data,
+                'enemy': serializers.EnemySerializer(self.enemy).data
+            }).decode())
+        if self.session.previous_owner:
+            # The previous owner, if still connected, hands over its unsaved state. Actions applied
+            # before it arrives would be overwritten, so they wait for it or for the timeout.
+            # Without an owner the snapshot is the latest state and actions go on right away
+            self.handover_id = uuid.uuid4().hex
+            self.pending_actions = []
+            self.handover_timeout = asyncio.ensure_future(self.expire_handover(self.handover_id))
+            await self.channel_layer.send(
+                self.session.previous_owner,
+                {'type': 'fight.takeover', 'owner': self.channel_name, 'handover': self.handover_id}
+            )
+
+    async def expire_handover(self, handover_id):
+        await asyncio.sleep(HANDOVER_TIMEOUT)
+        # Sent through the channel so it is handled in turn with the other events
+        await self.channel_layer.send(self.channel_name, {'type': 'fight.handover', 'handover': handover_id})
+
+    def cancel_handover_timeout(self):
+        if self.handover_timeout is not None:
+            self.handover_timeout.cancel()
+            self.handover_timeout = None
+
+    async def handle_user_attack(self):
         self.userTurnDone = False
         self.user, self.enemy = self.fightInfo.perform_attack(self.user, self.enemy)
-        self.send_enemy_update()
+        self.session.update(self.user, self.enemy)
+        await self.send_enemy_update()
         self.userTurnDone = True
 
         if self.enemy.health <= 0:
             self.winner = True
-            self.handle_fight_end()
-    
-    def handle_enemy_attack(self):
+            await self.handle_fight_end()
+
+    async def handle_enemy_attack(self):
         self.enemyTurnDone = False
         self.enemy, self.user = self.fightInfo.perform_attack(self.enemy, self.user)
-        self.send_character_update()
+        self.session.update(self.user, self.enemy)
+        await self.send_character_update()
         self.enemyTurnDone = True
 
         if self.user.health <= 0:
             self.winner = False
-            self.handle_fight_end()
-
-    def handle_loot(self):
-        self.loot = Fight.get_loot(self.enemy)
-        if self.loot:
-            models.UserItems.add_item(self.loot['id'], self.user.user.pk)
-
-
-    def update_user_lvl(self):
-        models.Resources.objects.get(user=self.user.user).add_exp(self.enemy.exp)
-        self.lvl = models.Resources.objects.get(user=self.user.user).lvl.lvl
-        # Get user's current lvl exp needed to next lvl
-        self.expPoints = models.UserLvl.objects.get(lvl=self.lvl).expPoints
-        # Get user's current exp points
-        self.exp = models.Resources.objects.get(user=self.user.user).exp
-
-    def handle_fight_end(self):
-        if self.winner:
-            self.handle_loot()
-            self.update_user_lvl()
-
-        
-        self.send_fight_data()
-        self.close()
-
-    def send_character_update(self):
-        self.send(text_data=json.dumps({'character': serializers.CharacterSerializer(self.user).data, 'criticalHit': self.fightInfo.last_strike_critical, 'enemyDamageDealt': self.fightInfo.damage_dealt}))
-    
-    def send_enemy_update(self):
-        self.send(text_data=json.dumps({'enemy': serializers.EnemySerializer(self.enemy).data, 'criticalHit': self.fightInfo.last_strike_critical, 'userDamageDealt': self.fightInfo.damage_dealt}))
-
-    def send_fight_data(self):
+            await self.handle_fight_end()
+        elif self.session.should_snapshot():
+            # Enemy attack closes the round
+            await database_sync_to_async(self.session.snapshot)()
+
+    @database_sync_to_async
+    def start_fight(self):
+        enemy = models.Enemy.objects.get(id=self.enemyId)
+        character = models.Character.objects.select_related('user', 'itemStats').get(user__email=self.userEmail)
+        character = character.get_character_object_with_item_stats()
+        session, resumed = FightSession.start(character, enemy, self.channel_name)
+        return enemy, character, session, resumed
+
+    @database_sync_to_async
+    def finish_fight(self):
+        # Rewards and the final snapshot are written together so the fight end costs a single trip to the database
+        with transaction.atomic():
+            self.session.snapshot(is_active=False)
+            if not self.winner:
+                return None, None, None, None
+
+            drops = Fight.get_drops(self.enemy)
+            if drops:
+                models.UserItems.add_items(self.user.user_id, Counter(drop['id'] for drop in drops))
+
+            resources = models.Resources.objects.select_for_update().get(user=self.user.user)
+            previous_lvl = resources.lvl_id
+            # lvl, user's current exp points and exp needed to next lvl
+            lvl, exp, exp_points = resources.add_exp(self.enemy.exp)
+
+            notify(self.user.user_id, 'loot', {'enemy': self.enemy.pk, 'drops': drops, 'exp': self.enemy.exp})
+            if resources.lvl_id != previous_lvl:
+                notify(self.user.user_id, 'levelUp', {'lvl': lvl, 'exp': exp, 'expPoints': exp_points})
+
+        return drops, lvl, exp, exp_points
+
+    async def handle_fight_end(self):
+        drops, self.lvl, self.exp, self.expPoints = await self.finish_fight()
+        self.drops = drops or []
+        # Clients reading a single drop get the first one
+        self.loot = self.drops[0] if self.drops else None
+        self.session = None
+
+        # Every connection closes once it has forwarded the result
+        await self.send_fight_data()
+
+    async def play_action(self, action):
+        if self.pending_actions is not None:
+            self.pending_actions.append(action)
+        else:
+            await self.handle_action(action)
+
+    async def handle_action(self, action):
+        if action == 'user_attack':
+            if self.userTurnDone:
+                await self.handle_user_attack()
+
+        if action == 'enemy_attack':
+            if self.enemyTurnDone:
+                await self.handle_enemy_attack()
+
+    async def send_to_fight(self, data, close=False):
+        await self.channel_layer.group_send(self.group, {'type': 'fight.message', 'text': dumps(data).decode(), 'close': close})
+
+    async def fight_message(self, event):
+        await self.send(text_data=event['text'])
+        if event['close']:
+            await self.close()
+
+    async def fight_action(self, event):
+        if self.session:
+            await self.play_action(event['action'])
+
+    async def fight_takeover(self, event):
+        if event['owner'] == self.channel_name:
+            return
+        if self.session is None:
+            # Nothing unsaved to hand over, the new owner goes on from the snapshot
+            await self.channel_layer.send(event['owner'], {'type': 'fight.handover', 'handover': event['handover']})
+            return
+        session, self.session = self.session, None
+        pending_actions, self.pending_actions = self.pending_actions or [], None
+        self.cancel_handover_timeout()
+        await self.channel_layer.send(event['owner'], {
+            'type': 'fight.handover',
+            'handover': event['handover'],
+            'currentPlayerHP': session.record.currentPlayerHP,
+            'currentEnemyHP': session.record.currentEnemyHP,
+        })
+        # Actions this connection was holding follow the state to the new owner
+        for action in pending_actions:
+            await self.channel_layer.group_send(self.group, {'type': 'fight.action', 'action': action})
+
+    async def fight_handover(self, event):
+        # Handovers of an earlier takeover, or arriving after the timeout, are dropped
+        if self.session is None or self.pending_actions is None or event['handover'] != self.handover_id:
+            return
+        self.cancel_handover_timeout()
+        if 'currentPlayerHP' in event:
+            self.user.health = event['currentPlayerHP']
+            self.enemy.health = event['currentEnemyHP']
+            self.session.update(self.user, self.enemy)
+
+        pending_actions, self.pending_actions = self.pending_actions, None
+        for action in pending_actions:
+            if self.session:
+                await self.handle_action(action)
+
+    async def fight_released(self, event):
+        if self.session is None and self.user is not None:
+            await self.channel_layer.group_discard(self.group, self.channel_name)
+            # The owner saved the fight as it left, so only a connection that joined since hands over
+            await self.join_fight()
+
+    async def send_character_update(self):
+        await self.send_to_fight({'character': serializers.CharacterSerializer(self.user).data, 'criticalHit': self.fightInfo.last_strike_critical, 'enemyDamageDealt': self.fightInfo.damage_dealt})
+
+    async def send_enemy_update(self):
+        await self.send_to_fight({'enemy': serializers.EnemySerializer(self.enemy).data, 'criticalHit': self.fightInfo.last_strike_critical, 'userDamageDealt': self.fightInfo.damage_dealt})
+
+    async def send_fight_data(self):
         msg = "Wygrałeś walkę! Zdobyto " + str(self.enemy.exp) + " punktów doświadczenia." \
             if self.winner else "Przegrałeś walkę."
         msgShort = "Wygrałeś walkę!" if self.winner else "Przegrałeś walkę."
-        self.send(text_data=json.dumps({
+        await self.send_to_fight({
             'message': msg,
             'fightIsOver': True,
             'loot': self.loot,
+            'drops': self.drops,
             'exp': self.exp,
             'lvl': self.lvl,
             'expPoints': self.expPoints,
             'messageShort':  msgShort
-        }))
+        }, close=True)
+
+    async def receive(self, text_data):
 
-    def receive(self, text_data):
-        
         try:
-            message = json.loads(text_data)
+            message = loads(text_data)
         except json.JSONDecodeError:
             return
-        
+
         if 'type' in message and message['type'] == 'set_enemy':
-            self.enemy = models.Enemy.objects.get(id=message['enemyId'])
+            self.enemyId = message['enemyId']
 
         if 'type' in message and message['type'] == 'set_user':
-            user_id = models.CustomUser.objects.get(email=message['userEmail'])
-            self.user = models.Character.objects.get(user=user_id).get_character_object_with_item_stats()
+            self.userEmail = message['userEmail']
 
-        if 'action' in message and message['action'] == 'user_attack':
-            if self.userTurnDone:
-                self.handle_user_attack()
+        # Enemy and character are loaded together once both are known
+        if self.enemyId is not None and self.userEmail is not None and self.user is None:
+            await self.join_fight()
 
-        if 'action' in message and message['action'] == 'enemy_attack':
-            if self.enemyTurnDone:
-                self.handle_enemy_attack()
\ No newline at end of file
+        if 'action' in message and self.group is not None:
+            if self.session:
+                await self.play_action(message['action'])
+            else:
+                await self.channel_layer.group_send(self.group, {'type': 'fight.action', 'action': message['action']})
+
+
+class NotificationConsumer(MetricsConsumerMixin, AsyncWebsocketConsumer):
+    """Player state events pushed as they happen, connect with ``?token=<API token>``.
+
+    Events sent with api.notifications.notify reach every connection of the
+    player through the ``user_<id>`` group. Travel arrivals are timed by the
+    process's TravelScheduler from the arrival time known at connect and from
+    ``travelStarted`` events.
+    """
+
+    async def connect(self):
+        self.group = None
+        token = parse_qs(self.scope['query_string'].decode()).get('token', [None])[0]
+        try:
+            self.user, _ = await database_sync_to_async(CachedTokenAuthentication().authenticate_credentials)(token or '')
+        except AuthenticationFailed:
+            await self.close()
+            return
+
+        self.group = user_group(self.user.pk)
+        await self.channel_layer.group_add(self.group, self.channel_name)
+        await self.accept()
+
+        travel = await self.get_travel()
+        if travel is not None:
+            self.schedule_arrival(travel)
+
+    async def disconnect(self, close_code):
+        if self.group is None:
+            return
+        get_travel_scheduler().cancel(self.channel_name)
+        await self.channel_layer.group_discard(self.group, self.channel_name)
+
+    @database_sync_to_async
+    def get_travel(self):
+        user_location = models.UserLocation.objects.select_related('location').filter(user=self.user).first()
+        if user_location is None or user_location.travelTime <= timezone.now():
+            return None
+        return travel_payload(user_location)
+
+    def schedule_arrival(self, travel):
+        async def arrive():
+            await self.send_event('travelComplete', {'location': travel['location'], 'locationName': travel['locationName']})
+        get_travel_scheduler().schedule(self.channel_name, travel['arrival'], arrive)
+
+    async def notification_event(self, event):
+        if event['event'] == 'travelStarted':
+            self.schedule_arrival(event['data'])
+        await self.send_event(event['event'], event['data'])
+
+    async def send_event(self, event, data):
+        await self.send(text_data=dumps({'type': event, **data}).decode())
+
+    async def receive(self, text_data):
+        # Push only, clients have nothing to send
+        pass
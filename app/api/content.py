@@ -0,0 +1,123 @@
+import gzip
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from api import models
+from api import serializers
+from api.caching import get_version, incr_version
+from api.prefetch import optimize_queryset
+
+
+CONTENT_VERSION_KEY = 'api:content_version'
+
+# Game design data that only changes through the admin
+CONTENT_MODELS = (
+    models.Item,
+    models.Potion,
+    models.CollectableItem,
+    models.Enemy,
+    models.EnemyLoot,
+    models.Region,
+    models.Location,
+    models.SubLocation,
+    models.LocationElement,
+    models.NPC,
+    models.Store,
+    models.StoreItem,
+    models.Dialog,
+    models.DialogOption,
+    models.Quest,
+    models.QuestRequirement,
+)
+
+CONTENT_SECTIONS = (
+    ('items', models.Item, serializers.ItemSerializer),
+    # Catalogs the compact inventory refers to by id
+    ('potions', models.Potion, serializers.PotionSerializer),
+    ('collectableItems', models.CollectableItem, serializers.CollectableItemSerializer),
+    ('enemies', models.Enemy, serializers.EnemySerializer),
+    ('locations', models.Location, serializers.LocationSerializer),
+    ('sublocations', models.SubLocation, serializers.SubLocationSerializer),
+    ('npcs', models.NPC, serializers.NPCSerializer),
+    ('stores', models.Store, serializers.StoreSerializer),
+    ('storeItems', models.StoreItem, serializers.StoreItemSerializer),
+    ('dialogs', models.Dialog, serializers.DialogSerializer),
+    ('quests', models.Quest, serializers.QuestSerializer),
+)
+
+
+class ContentSnapshot:
+
+    def __init__(self, version, data):
+        self.version = version
+        self.body = json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':')).encode()
+        # mtime=0 keeps the compressed body byte-identical between workers
+        self.gzip_body = gzip.compress(self.body, mtime=0)
+        self.etag = '"%s"' % hashlib.sha256(self.body).hexdigest()[:32]
+        self.gzip_etag = '"%s-gzip"' % self.etag.strip('"')
+
+
+def get_content_version():
+    return get_version(cache, CONTENT_VERSION_KEY)
+
+
+def bump_content_version():
+    incr_version(cache, CONTENT_VERSION_KEY)
+
+
+def build_content_snapshot(version, request=None):
+    data = {'version': version}
+    for section, model, serializer_class in CONTENT_SECTIONS:
+        queryset = optimize_queryset(model.objects.order_by('pk'), serializer_class)
+        data[section] = serializer_class(queryset, many=True, context={'request': request}).data
+    return ContentSnapshot(version, data)
+
+
+# Snapshots of the current version by origin, image urls in the bundle are absolute
+_content_snapshots = {}
+
+
+def get_content_snapshot(request=None):
+    version = get_content_version()
+    origin = request.build_absolute_uri('/') if request is not None else None
+    snapshot = _content_snapshots.get(origin)
+    if snapshot is None or snapshot.version != version:
+        snapshot = build_content_snapshot(version, request)
+        if any(cached.version != version for cached in _content_snapshots.values()):
+            _content_snapshots.clear()
+        _content_snapshots[origin] = snapshot
+    return snapshot
+
+
+def accepts_gzip(accept_encoding):
+    """Whether an Accept-Encoding header allows gzip, codings with q=0 are refused"""
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, *params = [part.strip() for part in coding.split(';')]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities[name.lower()] = quality
+    quality = qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0.0)))
+    return quality > 0
+
+
+def content_changed(sender, **kwargs):
+    # Workers reading before the commit would otherwise snapshot old rows under the new version
+    transaction.on_commit(bump_content_version)
+
+
+for model in CONTENT_MODELS:
+    post_save.connect(content_changed, sender=model, dispatch_uid=f'content_changed_save_{model.__name__}')
+    post_delete.connect(content_changed, sender=model, dispatch_uid=f'content_changed_delete_{model.__name__}')
@@ -1,5 +1,27 @@
-from api import models, serializers
-import random, decimal
+from django.db import transaction
+
+from api import models
+from api.loot import get_loot_table
+import random, decimal, time
+
+
+# Minimum number of seconds between two snapshots of a running fight
+SNAPSHOT_INTERVAL = 5
+
+
+# The strike formula is shared with api.simulation, so both functions work on
+# single Decimal values as well as element-wise on NumPy arrays
+
+def is_critical_hit(critical_hit_chance, roll):
+    """roll is uniform on [0, 1]"""
+    return critical_hit_chance >= roll
+
+
+def strike_damage(damage, critical_hit_damage, is_critical, armor, maximum=max):
+    """Damage dealt by a strike after armor, pass numpy.maximum for arrays"""
+    # damage * critical_hit_damage on a critical hit, written without branching
+    hit = damage + damage * (critical_hit_damage - 1) * is_critical
+    return maximum(hit - armor, 0)
 
 
 class Fight:
@@ -10,23 +32,20 @@ class Fight:
 
     def calculate_critical_hit(self, attacker):
         rand = decimal.Decimal(str(random.uniform(0,1)))
-        is_critical = attacker.criticalHitChance >= rand
+        is_critical = is_critical_hit(attacker.criticalHitChance, rand)
         self.last_strike_critical = is_critical
-        damage = attacker.damage * attacker.criticalHitDamage if is_critical else attacker.damage
-        return damage
+        return is_critical
 
     def perform_attack(self, attacker, defender):
-        hit_dmg = Fight.calculate_critical_hit(self, attacker=attacker)
-        dmg = hit_dmg - defender.armor if hit_dmg - defender.armor > 0 else 0
+        is_critical = Fight.calculate_critical_hit(self, attacker=attacker)
+        dmg = strike_damage(attacker.damage, attacker.criticalHitDamage, is_critical, defender.armor)
         self.damage_dealt = int(dmg)
-        print(self.damage_dealt)
         defender.health -= dmg
 
         return {attacker: attacker, defender: defender}
     
     def handle_fight(attacker, defender, user_turn):
         attacker_stats = attacker
-        print(attacker_stats)
         defender_stats = defender
 
         if user_turn:
@@ -38,17 +57,76 @@ class Fight:
 
     @staticmethod
     def get_loot(enemy: models.Enemy):
-        loots = models.EnemyLoot.objects.filter(enemy=enemy)
-        strike = random.random()
-        counter = 0.0
-        for loot in loots:
-            counter += loot.rarity
-            if strike <= counter:
-                item = serializers.ItemSerializer(loot.item).data
-                return item
-        
-        return None
+        return get_loot_table(enemy.pk).roll()
+
+    @staticmethod
+    def get_drops(enemy: models.Enemy):
+        """Items dropped over the enemy's loot rolls"""
+        return get_loot_table(enemy.pk).roll_many(enemy.lootRolls)
     
     @staticmethod
     def get_exp(enemy: models.Enemy):
         return enemy.exp
+
+
+
+class FightSession:
+    """Write-behind snapshot of a running fight kept in models.Fight.
+
+    HP changes stay in memory and are written at most every SNAPSHOT_INTERVAL
+    seconds on a round boundary and when the client disconnects, so a client
+    reconnecting to any worker resumes from the last snapshot.
+    """
+
+    def __init__(self, record, previous_owner=''):
+        self.record = record
+        # Connection that owned the resumed fight and may still hold unsaved state, empty if none
+        self.previous_owner = previous_owner
+        self.dirty = False
+        self.last_snapshot = time.monotonic()
+
+    @staticmethod
+    def start(character, enemy, owner=''):
+        """Resume the player's active fight with this enemy or start a new one owned by
+        the given channel, returns (session, resumed)"""
+        with transaction.atomic():
+            # Concurrent starts of the player (two sockets, a reconnect) wait on the character row,
+            # so only the first one creates the active fight and the others resume it
+            models.Character.objects.select_for_update().filter(pk=character.pk).values_list('pk', flat=True).get()
+            record = models.Fight.objects.filter(user=character.user, isActive=True).order_by('-pk').first()
+            if record and record.enemy_id == enemy.pk:
+                character.health = record.currentPlayerHP
+                enemy.health = record.currentEnemyHP
+                previous_owner, record.owner = record.owner, owner
+                models.Fight.objects.filter(pk=record.pk).update(owner=owner)
+                return FightSession(record, previous_owner), True
+
+            if record:
+                models.Fight.objects.filter(user=character.user, isActive=True).update(isActive=False)
+            record = models.Fight.objects.create(
+                user=character.user, enemy=enemy, currentPlayerHP=character.health,
+                currentEnemyHP=enemy.health, isActive=True, owner=owner
+            )
+        return FightSession(record), False
+
+    def release(self, owner):
+        """Leave the fight without an owner, unless another connection has taken it over"""
+        models.Fight.objects.filter(pk=self.record.pk, owner=owner).update(owner='')
+
+    def update(self, character, enemy):
+        self.record.currentPlayerHP = int(character.health)
+        self.record.currentEnemyHP = int(enemy.health)
+        self.dirty = True
+
+    def should_snapshot(self):
+        return self.dirty and time.monotonic() - self.last_snapshot >= SNAPSHOT_INTERVAL
+
+    def snapshot(self, is_active=True):
+        self.record.isActive = is_active
+        models.Fight.objects.filter(pk=self.record.pk).update(
+            currentPlayerHP=self.record.currentPlayerHP,
+            currentEnemyHP=self.record.currentEnemyHP,
+            isActive=is_active
+        )
+        self.dirty = False
+        self.last_snapshot = time.monotonic()
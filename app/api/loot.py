@@ -0,0 +1,80 @@
+import random
+
+from api import serializers
+from api.caching import enemy_loot_cache
+
+
+class LootTable:
+    """Walker alias table over an enemy's loot.
+
+    ``EnemyLoot.rarity`` values are drop chances taken in pk order, chances past
+    a total of 1 are cut off and the probability left below 1 drops nothing, the
+    same outcomes the cumulative walk in the original Fight.get_loot produced.
+    Every roll costs one random index and one coin flip.
+    """
+
+    def __init__(self, loots):
+        self.outcomes = []
+        weights = []
+        remaining = 1.0
+        for loot in loots:
+            weight = min(loot.rarity, remaining)
+            remaining -= weight
+            if weight > 0:
+                # Serialized once, drops are shared between fights and must not be modified
+                self.outcomes.append(serializers.ItemSerializer(loot.item).data)
+                weights.append(weight)
+        if remaining > 0:
+            self.outcomes.append(None)
+            weights.append(remaining)
+
+        self.probabilities, self.aliases = build_alias_table(weights)
+
+    def roll(self, rng=random):
+        """Returns the dropped item data or None"""
+        index = int(rng.random() * len(self.outcomes))
+        if rng.random() >= self.probabilities[index]:
+            index = self.aliases[index]
+        return self.outcomes[index]
+
+    def roll_many(self, rolls, rng=random):
+        drops = (self.roll(rng) for _ in range(rolls))
+        return [drop for drop in drops if drop is not None]
+
+
+def build_alias_table(weights):
+    """Vose's alias method, returns (probabilities, aliases) for weights summing to any positive total"""
+    count = len(weights)
+    total = sum(weights)
+    scaled = [weight * count / total for weight in weights]
+    probabilities = [1.0] * count
+    aliases = list(range(count))
+
+    small = [i for i, weight in enumerate(scaled) if weight < 1.0]
+    large = [i for i, weight in enumerate(scaled) if weight >= 1.0]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        probabilities[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] -= 1.0 - scaled[less]
+        (small if scaled[more] < 1.0 else large).append(more)
+    # Whatever is left is 1 up to rounding errors
+    return probabilities, aliases
+
+
+_loot_tables = (None, {})
+
+
+def get_loot_table(enemy_id):
+    global _loot_tables
+    generation = enemy_loot_cache.get_generation()
+    loot_tables = _loot_tables
+    if loot_tables[0] != generation:
+        loot_tables = (generation, {})
+        _loot_tables = loot_tables
+
+    table = loot_tables[1].get(enemy_id)
+    if table is None:
+        table = LootTable(enemy_loot_cache.filter(enemy=enemy_id))
+        loot_tables[1][enemy_id] = table
+    return table
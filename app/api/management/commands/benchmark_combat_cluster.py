@@ -0,0 +1,214 @@
+import asyncio
+import base64
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.management.commands.loadtest_combat import is_dead
+
+
+# Health is fractional and sent rounded down, so a fight showing 0 health may go on.
+# Seconds to wait for fightIsOver before playing the next action
+FIGHT_END_TIMEOUT = 0.5
+
+
+class CombatClient:
+    """Minimal websocket client on asyncio streams, autobahn is bound to Twisted once daphne is installed"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # Read in the background, so waiting for a message with a timeout never cuts a frame
+        self.messages = asyncio.Queue()
+        self.reading = asyncio.ensure_future(self.read_messages())
+
+    @classmethod
+    async def connect(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((
+            f'GET /ws/combat/ HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n'
+        ).encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        if not response.startswith(b'HTTP/1.1 101'):
+            raise CommandError(f'Websocket handshake failed: {response.splitlines()[0].decode()}')
+        return cls(reader, writer)
+
+    def send_json(self, data):
+        self.send_frame(0x1, json.dumps(data).encode())
+
+    def send_frame(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        if len(payload) < 126:
+            header.append(0x80 | len(payload))
+        else:
+            header.append(0x80 | 126)
+            header += struct.pack('!H', len(payload))
+        mask = os.urandom(4)
+        self.writer.write(bytes(header) + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+
+    async def read_messages(self):
+        try:
+            while True:
+                opcode, length = await self.reader.readexactly(2)
+                length &= 0x7f
+                if length == 126:
+                    length, = struct.unpack('!H', await self.reader.readexactly(2))
+                elif length == 127:
+                    length, = struct.unpack('!Q', await self.reader.readexactly(8))
+                payload = await self.reader.readexactly(length)
+                if opcode & 0x0f == 0x8:
+                    break
+                if opcode & 0x0f == 0x9:
+                    # daphne drops connections that leave its pings unanswered
+                    self.send_frame(0xA, payload)
+                if opcode & 0x0f == 0x1:
+                    self.messages.put_nowait(json.loads(payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        self.messages.put_nowait(None)
+
+    async def receive_json(self, timeout=60):
+        message = await asyncio.wait_for(self.messages.get(), timeout)
+        if message is None:
+            self.messages.put_nowait(None)
+            raise CommandError('Connection closed by the server')
+        return message
+
+    def close(self):
+        self.reading.cancel()
+        self.writer.close()
+
+
+async def drain(connection):
+    received = 0
+    while 'fightIsOver' not in await connection.receive_json():
+        received += 1
+    return received + 1
+
+
+async def run_fight(host, player_port, driver_port, email, enemy_id, latencies):
+    """Two connections to one fight on different nodes, the player sends the actions
+    and the updates come back from whichever node owns the fight"""
+    player = await CombatClient.connect(host, player_port)
+    player.send_json({'type': 'set_enemy', 'enemyId': enemy_id})
+    player.send_json({'type': 'set_user', 'userEmail': email})
+
+    latencies_local = []
+    messages = 0
+    driver = drained = None
+    finished = False
+    while not finished:
+        for action in ('user_attack', 'enemy_attack'):
+            start = time.perf_counter()
+            player.send_json({'action': action})
+            message = await player.receive_json()
+            while 'fightResumed' in message:
+                message = await player.receive_json()
+            latencies_local.append(time.perf_counter() - start)
+            messages += 1
+            if is_dead(message):
+                try:
+                    await player.receive_json(FIGHT_END_TIMEOUT)
+                except asyncio.TimeoutError:
+                    continue
+                messages += 1
+                finished = True
+                break
+
+            if driver is None:
+                # Once the fight has started the driver joins on the other node and
+                # takes it over, from then on every action crosses the channel layer
+                driver = await CombatClient.connect(host, driver_port)
+                driver.send_json({'type': 'set_enemy', 'enemyId': enemy_id})
+                driver.send_json({'type': 'set_user', 'userEmail': email})
+                await driver.receive_json()
+                drained = asyncio.ensure_future(drain(driver))
+
+    # The first attack runs before the takeover
+    latencies.extend(latencies_local[1:])
+    if drained is not None:
+        messages += await drained
+        driver.close()
+    player.close()
+    return messages
+
+
+async def run_fights(host, ports, email, enemy_id, count):
+    latencies = []
+    messages = await asyncio.gather(*(
+        run_fight(host, ports[i % len(ports)], ports[(i + 1) % len(ports)], email.format(i), enemy_id, latencies)
+        for i in range(count)
+    ))
+    return sum(messages), sorted(latencies)
+
+
+def wait_for_port(host, port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise CommandError(f'daphne on port {port} exited with code {process.returncode}')
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError(f'daphne on port {port} did not start in {timeout}s')
+
+
+class Command(BaseCommand):
+    help = 'Drive fights across several daphne processes sharing the channel layer and report messages/s'
+
+    def add_arguments(self, parser):
+        parser.add_argument('email', help='Email pattern of the fighting players, {} is replaced with the fight number')
+        parser.add_argument('enemy', type=int, help='Id of the enemy to fight')
+        parser.add_argument('--workers', type=int, default=2, help='Number of daphne processes')
+        parser.add_argument('--fights', type=int, nargs='+', default=[10, 50, 100])
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8100, help='Port of the first worker, the others follow')
+
+    def handle(self, *args, **options):
+        if '{}' not in options['email']:
+            raise CommandError('Concurrent fights of one player share a fight group, use a {} placeholder in email')
+        backend = settings.CHANNEL_LAYERS['default']['BACKEND']
+        if options['workers'] > 1 and backend == 'channels.layers.InMemoryChannelLayer':
+            raise CommandError('The in-memory channel layer does not span processes, set REDIS_URL')
+
+        host = options['host']
+        ports = [options['port'] + i for i in range(options['workers'])]
+        application = ':'.join(settings.ASGI_APPLICATION.rsplit('.', 1))
+        processes = [
+            subprocess.Popen(
+                [sys.executable, '-m', 'daphne', '-b', host, '-p', str(port), application],
+                env=os.environ.copy(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            for port in ports
+        ]
+
+        try:
+            for process, port in zip(processes, ports):
+                wait_for_port(host, port, process)
+
+            for count in options['fights']:
+                start = time.perf_counter()
+                messages, latencies = asyncio.run(run_fights(host, ports, options['email'], options['enemy'], count))
+                elapsed = time.perf_counter() - start
+
+                self.stdout.write(
+                    f'{options["workers"]:>3} workers {count:>5} fights  {messages / elapsed:8.1f} messages/s  '
+                    f'p50 {latencies[len(latencies) // 2] * 1000:7.1f} ms  '
+                    f'p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:7.1f} ms'
+                )
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
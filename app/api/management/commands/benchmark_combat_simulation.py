@@ -0,0 +1,76 @@
+import random
+import time
+from decimal import Decimal
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api import models
+from api.fight import Fight
+from api.simulation import MAX_ROUNDS, simulate_fights, stat_arrays
+
+
+def live_fights(character, enemy, fights):
+    """Fights played hit by hit with api.fight.Fight like the combat consumer does, returns (wins, rounds)"""
+    character_health, enemy_health = character.health, enemy.health
+    wins = rounds = 0
+    for _ in range(fights):
+        character.health, enemy.health = character_health, enemy_health
+        fight = Fight()
+        for round_number in range(1, MAX_ROUNDS + 1):
+            fight.perform_attack(character, enemy)
+            if enemy.health <= 0:
+                wins += 1
+                break
+            fight.perform_attack(enemy, character)
+            if character.health <= 0:
+                break
+        rounds += round_number
+    character.health, enemy.health = character_health, enemy_health
+    return wins, rounds
+
+
+class Command(BaseCommand):
+    help = 'Compare the NumPy combat simulator with fights played hit by hit on Decimal stats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fights', type=int, default=1_000_000, help='Fights run by the simulator')
+        parser.add_argument('--live-fights', type=int, default=20_000, help='Fights played by api.fight.Fight')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        # Unsaved combatants need a pk, perform_attack keys its result by them
+        character = models.Character(
+            pk=1, health=150, armor=4, damage=18, criticalHitChance=Decimal('0.15'), criticalHitDamage=Decimal('1.75')
+        )
+        enemy = models.Enemy(
+            pk=1, name='Benchmark', health=160, armor=3, magicResist=0, damage=19,
+            criticalHitChance=Decimal('0.10'), criticalHitDamage=Decimal('1.50'), lvl=1
+        )
+
+        start = time.perf_counter()
+        live_wins, live_rounds = live_fights(character, enemy, options['live_fights'])
+        live_time = (time.perf_counter() - start) / options['live_fights']
+
+        start = time.perf_counter()
+        results = simulate_fights(
+            stat_arrays([character]), stat_arrays([enemy]), options['fights'], np.random.default_rng(options['seed'])
+        )
+        simulated_time = (time.perf_counter() - start) / options['fights']
+
+        live_rate = live_wins / options['live_fights']
+        simulated_rate = results['wins'][0] / options['fights']
+        self.stdout.write(
+            f'live       {live_time * 1e6:10.2f} us/fight  win rate {live_rate:.4f}  '
+            f'rounds {live_rounds / options["live_fights"]:.3f}'
+        )
+        self.stdout.write(
+            f'simulated  {simulated_time * 1e6:10.2f} us/fight  win rate {simulated_rate:.4f}  '
+            f'rounds {results["rounds"][0] / options["fights"]:.3f}  speedup {live_time / simulated_time:6.1f}x'
+        )
+
+        # Both sample the same distribution, a gap over 5 standard errors points to diverging formulas
+        error = (live_rate * (1 - live_rate) / options['live_fights'] + simulated_rate * (1 - simulated_rate) / options['fights']) ** 0.5
+        if abs(live_rate - simulated_rate) > 5 * error:
+            self.stderr.write(self.style.ERROR('Win rates differ between implementations'))
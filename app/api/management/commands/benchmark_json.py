@@ -0,0 +1,95 @@
+import json
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api import models
+from api import renderers
+from api import serializers
+from api import views
+from api.prefetch import optimize_queryset
+
+
+def create_world(locations, items):
+    """Locations laid out like the game map and a player holding ``items`` inventory rows, returns the player"""
+    region = models.Region.objects.create(name='Benchmark', description='Region used by benchmark_json')
+    for number in range(locations):
+        location = models.Location.objects.create(
+            name=f'Location {number}', region=region, lvlRequired=1,
+            description='Ośnieżona przełęcz ' * 5, xCoordinate=number, yCoordinate=0
+        )
+        sublocation = models.SubLocation.objects.create(name=f'Sublocation {number}', description='', parent_location=location)
+        npc = models.NPC.objects.create(name='NPC', location=location, imageUrl='npc.png')
+        enemy = models.Enemy.objects.create(
+            name='Enemy', health=120, armor=5, magicResist=3, damage=14, lvl=3, location=location
+        )
+        item = models.Item.objects.create(name='Item', itemType='weapon', rarity='common', damage=7)
+        models.LocationElement.objects.bulk_create([
+            models.LocationElement(location=location, type='npc', npc=npc, position_x=0, position_y=0),
+            models.LocationElement(location=location, type='enemy', enemy=enemy, position_x=1, position_y=0),
+            models.LocationElement(location=location, type='item', item=item, position_x=2, position_y=0),
+            models.LocationElement(location=location, type='location', sublocation_element=sublocation, position_x=3, position_y=0),
+            models.LocationElement(sublocation=sublocation, type='npc', npc=npc, position_x=0, position_y=0),
+        ])
+
+    # Saved without signals, the player needs no starting state here
+    user = get_user_model().objects.bulk_create([get_user_model()(email='benchmark-json@example.com', name='benchmark')])[0]
+    catalog = models.Item.objects.bulk_create(
+        models.Item(
+            name=f'Item {number}', itemType='helmet', rarity='rare', armor=number % 20, health=number % 50,
+            criticalHitChance=Decimal('0.05'), criticalHitDamage=Decimal('0.25'), goldValue=number
+        )
+        for number in range(items)
+    )
+    models.UserItems.objects.bulk_create(models.UserItems(user=user, item=item, stacked=True) for item in catalog)
+    return user
+
+
+class Command(BaseCommand):
+    help = 'Compare DRF\'s JSONRenderer and json.loads with api.renderers on location and inventory payloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--locations', type=int, default=100)
+        parser.add_argument('--items', type=int, default=500)
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def measure(self, function, data, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function(data)
+        return (time.perf_counter() - start) / repeat
+
+    def handle(self, *args, **options):
+        # Payloads are built from rows created for the run and rolled back afterwards
+        with transaction.atomic():
+            user = create_world(options['locations'], options['items'])
+            locations = serializers.LocationSerializer(
+                optimize_queryset(models.Location.objects.filter(region__name='Benchmark'), serializers.LocationSerializer),
+                many=True
+            ).data
+            request = APIRequestFactory().get('/api/inventory/', {'page_size': options['items']}, HTTP_HOST='localhost')
+            force_authenticate(request, user=user)
+            inventory = views.InventoryViewSet.as_view({'get': 'list'})(request).data
+            transaction.set_rollback(True)
+
+        backend = 'orjson' if renderers.orjson is not None else 'stdlib fallback'
+        self.stdout.write(f'api.renderers backend: {backend}')
+        for name, payload in (('locations', locations), ('inventory', inventory)):
+            body = JSONRenderer().render(payload)
+            if json.loads(renderers.dumps(payload)) != json.loads(body):
+                self.stderr.write(self.style.ERROR(f'{name}: output differs from JSONRenderer'))
+
+            drf_render = self.measure(JSONRenderer().render, payload, options['repeat'])
+            fast_render = self.measure(renderers.dumps, payload, options['repeat'])
+            stdlib_parse = self.measure(json.loads, body, options['repeat'])
+            fast_parse = self.measure(renderers.loads, body, options['repeat'])
+            self.stdout.write(
+                f'{name:<10} {len(body) / 1024:8.1f} KiB  '
+                f'render {drf_render * 1e6:9.1f} -> {fast_render * 1e6:8.1f} us ({drf_render / fast_render:5.1f}x)  '
+                f'parse {stdlib_parse * 1e6:9.1f} -> {fast_parse * 1e6:8.1f} us ({stdlib_parse / fast_parse:5.1f}x)'
+            )
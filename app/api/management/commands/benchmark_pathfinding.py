@@ -0,0 +1,83 @@
+import heapq
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.utils import TIME_PER_LOCATION, a_star
+from api.world import WorldGraph
+
+
+def legacy_dijkstra(locations, source_location, target_location):
+    # Previous api.utils.dijkstra, copies the whole path on every heap push
+    priority_queue = []
+    heapq.heappush(priority_queue, (0, source_location, [source_location]))
+
+    visited = set()
+
+    while priority_queue:
+        cost, current_location, path = heapq.heappop(priority_queue)
+
+        if current_location in visited:
+            continue
+
+        visited.add(current_location)
+        if current_location == target_location:
+            return cost, path
+
+        for neighboor in locations[current_location]:
+            if neighboor not in visited:
+                new_cost = cost + TIME_PER_LOCATION
+                heapq.heappush(priority_queue, (new_cost, neighboor, path + [neighboor]))
+
+    return float('inf'), []
+
+
+def build_grid(cells, obstacles, rnd):
+    side = int(cells ** 0.5)
+    locations = (
+        {'id': x * side + y, 'name': '', 'region': 1, 'xCoordinate': x, 'yCoordinate': y}
+        for x in range(side) for y in range(side)
+        if rnd.random() >= obstacles
+    )
+    return WorldGraph(locations)
+
+
+class Command(BaseCommand):
+    help = 'Compare A* with the previous path-copying Dijkstra on synthetic grids'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+        parser.add_argument('--queries', type=int, default=20)
+        parser.add_argument('--obstacles', type=float, default=0.1, help='Fraction of missing cells')
+        parser.add_argument('--legacy-limit', type=int, default=100_000,
+                            help='Skip the legacy implementation on grids larger than this')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def run(self, search, graph, pairs):
+        costs = []
+        start = time.perf_counter()
+        for source, target in pairs:
+            costs.append(search(graph.adjacency, source, target)[0])
+        return (time.perf_counter() - start) / len(pairs), costs
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+
+        for cells in options['sizes']:
+            graph = build_grid(cells, options['obstacles'], rnd)
+            coordinates = list(graph.locations)
+            pairs = [(rnd.choice(coordinates), rnd.choice(coordinates)) for _ in range(options['queries'])]
+
+            a_star_time, a_star_costs = self.run(a_star, graph, pairs)
+            line = f'{len(coordinates):>9} cells  a_star {a_star_time * 1000:10.2f} ms/query'
+
+            if len(coordinates) <= options['legacy_limit']:
+                legacy_time, legacy_costs = self.run(legacy_dijkstra, graph, pairs)
+                if legacy_costs != a_star_costs:
+                    self.stderr.write(self.style.ERROR('Path costs differ between implementations'))
+                line += f'  dijkstra {legacy_time * 1000:10.2f} ms/query  speedup {legacy_time / a_star_time:6.1f}x'
+            else:
+                line += '  dijkstra skipped'
+
+            self.stdout.write(line)
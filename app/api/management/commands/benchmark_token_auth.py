@@ -0,0 +1,61 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIRequestFactory
+
+from api import views
+from api.authentication import CachedTokenAuthentication
+
+
+class Command(BaseCommand):
+    help = 'Compare queries and time per request of TokenAuthentication and CachedTokenAuthentication'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--email', default='loadtest0@example.com', help='Player making the requests')
+        parser.add_argument('--requests', type=int, default=2000)
+
+    def run(self, view, token, requests):
+        factory = APIRequestFactory()
+        # Warms up caches so only steady state requests are measured
+        view(factory.get('/', HTTP_AUTHORIZATION=f'Token {token.key}'))
+        queries = 0
+
+        def count_query(execute, *args):
+            nonlocal queries
+            queries += 1
+            return execute(*args)
+
+        with connection.execute_wrapper(count_query):
+            start = time.perf_counter()
+            for _ in range(requests):
+                response = view(factory.get('/', HTTP_AUTHORIZATION=f'Token {token.key}'))
+                response.render()
+            elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise CommandError(f'Request failed with status {response.status_code}')
+        return queries / requests, elapsed / requests
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get(email=options['email'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f'No user {options["email"]}, create one with provision_players')
+        token, created = Token.objects.get_or_create(user=user)
+
+        endpoints = {
+            'resources': views.ResourceViewSet,
+            'enemies': views.EnemyViewSet,
+        }
+        for name, viewset in endpoints.items():
+            line = f'{name:<10}'
+            timings = []
+            for authentication in (TokenAuthentication, CachedTokenAuthentication):
+                view = viewset.as_view({'get': 'list'}, authentication_classes=(authentication,))
+                queries, elapsed = self.run(view, token, options['requests'])
+                timings.append(elapsed)
+                line += f'  {authentication.__name__} {queries:5.2f} queries {elapsed * 1000:7.3f} ms/request'
+            self.stdout.write(f'{line}  speedup {timings[0] / timings[1]:5.2f}x')
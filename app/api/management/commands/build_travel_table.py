@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.travel_table import TravelTable, build_travel_table
+from api.world import load_world_graph
+
+
+class Command(BaseCommand):
+    help = 'Precompute the next-hop and travel-time tables for the world map'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='Output file, defaults to settings.TRAVEL_TABLE_PATH')
+        parser.add_argument('--force', action='store_true', help='Rebuild even if the file matches the map')
+
+    def handle(self, *args, **options):
+        graph = load_world_graph()
+        path = options['path'] or settings.TRAVEL_TABLE_PATH
+        # Cheap when nothing moved, so the command can run periodically after map edits
+        if not options['force'] and TravelTable.load(path, graph) is not None:
+            self.stdout.write(f'Travel table is up to date for {len(graph.locations)} locations')
+            return
+
+        table = build_travel_table(graph, path)
+        self.stdout.write(self.style.SUCCESS(f'Travel table built for {table.size} locations'))
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+
+def is_dead(message):
+    for key in ('enemy', 'character'):
+        if key in message and message[key]['health'] <= 0:
+            return True
+    return False
+
+
+async def run_fight(consumer, email, enemy_id, latencies):
+    communicator = WebsocketCommunicator(consumer.as_asgi(), '/ws/combat/')
+    await communicator.connect()
+    await communicator.send_json_to({'type': 'set_enemy', 'enemyId': enemy_id})
+    await communicator.send_json_to({'type': 'set_user', 'userEmail': email})
+
+    messages = 0
+    finished = False
+    while not finished:
+        for action in ('user_attack', 'enemy_attack'):
+            start = time.perf_counter()
+            await communicator.send_json_to({'action': action})
+            message = await communicator.receive_json_from(timeout=60)
+            # A player's unfinished fight from a previous run is resumed
+            if 'fightResumed' in message:
+                message = await communicator.receive_json_from(timeout=60)
+            latencies.append(time.perf_counter() - start)
+            messages += 1
+            if is_dead(message):
+                await communicator.receive_json_from(timeout=60)
+                finished = True
+                break
+
+    await communicator.disconnect()
+    return messages
+
+
+async def run_fights(consumer, email, enemy_id, count):
+    latencies = []
+    messages = await asyncio.gather(*(
+        run_fight(consumer, email.format(i), enemy_id, latencies) for i in range(count)
+    ))
+    return sum(messages), sorted(latencies)
+
+
+class Command(BaseCommand):
+    help = 'Drive concurrent fights through a combat consumer in-process and report its capacity'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'email', help='Email of the fighting player, a {} placeholder is replaced with the fight number '
+            'so concurrent fights use separate players'
+        )
+        parser.add_argument('enemy', type=int, help='Id of the enemy to fight')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50, 100])
+        parser.add_argument('--consumer', default='api.consumers.CombatSystemConsumer')
+
+    def handle(self, *args, **options):
+        consumer = import_string(options['consumer'])
+        if '{}' not in options['email'] and max(options['concurrency']) > 1:
+            raise CommandError('Concurrent fights of one player share a fight group, use a {} placeholder in email')
+
+        for count in options['concurrency']:
+            start = time.perf_counter()
+            messages, latencies = asyncio.run(run_fights(consumer, options['email'], options['enemy'], count))
+            elapsed = time.perf_counter() - start
+
+            self.stdout.write(
+                f'{count:>5} fights  {count / elapsed:8.1f} fights/s  {messages / elapsed:8.1f} attacks/s  '
+                f'p50 {latencies[len(latencies) // 2] * 1000:7.1f} ms  '
+                f'p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:7.1f} ms'
+            )
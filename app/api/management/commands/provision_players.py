@@ -0,0 +1,41 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from api.provisioning import StarterState, create_players
+
+
+class Command(BaseCommand):
+    help = 'Bulk create players with their initial state, e.g. accounts for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int, help='Number of players to create')
+        parser.add_argument('--email', default='loadtest{}@example.com', help='Email pattern, {} is replaced with the player number')
+        parser.add_argument('--name', default='loadtest{}', help='Name pattern, {} is replaced with the player number')
+        parser.add_argument('--password', default='loadtest123')
+        parser.add_argument('--start', type=int, default=0, help='Number of the first player')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if '{}' not in options['email'] or '{}' not in options['name']:
+            raise CommandError('Email and name patterns need a {} placeholder')
+
+        starter = StarterState()
+        hashes = {}
+        created = 0
+        start = time.perf_counter()
+        numbers = range(options['start'], options['start'] + options['count'])
+        for offset in range(0, len(numbers), options['batch_size']):
+            batch = numbers[offset:offset + options['batch_size']]
+            emails = {options['email'].format(number): number for number in batch}
+            # Players from an earlier run are kept as they are
+            existing = set(get_user_model().objects.filter(email__in=emails).values_list('email', flat=True))
+            accounts = [
+                (email, options['name'].format(number), options['password'])
+                for email, number in emails.items() if email not in existing
+            ]
+            created += len(create_players(accounts, starter, hashes))
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f'Created {created} players in {elapsed:.1f}s ({created / max(elapsed, 1e-9):.0f} players/s)')
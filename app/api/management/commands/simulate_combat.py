@@ -0,0 +1,52 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from api import models
+from api.simulation import simulate_fights, stat_arrays, summarize
+
+
+class Command(BaseCommand):
+    help = 'Simulate fights against every enemy and report win rates, time to kill and exp per hour'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--email', help='Fight with this player\'s character and equipment, a new character by default')
+        parser.add_argument('--enemies', type=int, nargs='+', help='Enemy ids, all enemies by default')
+        parser.add_argument('--fights', type=int, default=1_000_000, help='Fights per enemy')
+        parser.add_argument('--round-seconds', type=float, default=2.0,
+                            help='Time of one round (a player and an enemy attack) used for exp per hour')
+        parser.add_argument('--seed', type=int)
+
+    def handle(self, *args, **options):
+        if options['email']:
+            try:
+                character = models.Character.objects.select_related('user', 'itemStats').get(user__email=options['email'])
+            except models.Character.DoesNotExist:
+                raise CommandError(f'No character for {options["email"]}')
+            character = character.get_character_object_with_item_stats()
+        else:
+            character = models.Character()
+
+        enemies = models.Enemy.objects.order_by('lvl', 'pk')
+        if options['enemies']:
+            enemies = enemies.filter(pk__in=options['enemies'])
+        enemies = list(enemies)
+        if not enemies:
+            raise CommandError('No enemies to fight')
+
+        start = time.perf_counter()
+        results = simulate_fights(
+            stat_arrays([character]), stat_arrays(enemies), options['fights'], np.random.default_rng(options['seed'])
+        )
+        elapsed = time.perf_counter() - start
+        summary = summarize(results, np.array([enemy.exp for enemy in enemies]), options['round_seconds'])
+
+        self.stdout.write(f'{"enemy":<24} {"lvl":>4} {"win rate":>9} {"rounds to kill":>15} {"exp/h":>10} {"draws":>8}')
+        for i, enemy in enumerate(enemies):
+            self.stdout.write(
+                f'{enemy.name[:24]:<24} {enemy.lvl:>4} {summary["win_rate"][i]:>9.2%} '
+                f'{summary["rounds_to_kill"][i]:>15.2f} {summary["exp_per_hour"][i]:>10.0f} {results["draws"][i]:>8}'
+            )
+        total = options['fights'] * len(enemies)
+        self.stdout.write(f'Simulated {total} fights in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} fights/s)')
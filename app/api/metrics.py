@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (0.5, 0.9, 0.99)
+SLOW_LOG_QUERIES = 100
+SLOW_LOG_SQL_LENGTH = 500
+
+_current_recorder = ContextVar('api_query_recorder', default=None)
+
+
+class QueryRecorder:
+    """Counts queries and their time for the request or message being measured.
+
+    The first SLOW_LOG_QUERIES queries are kept, with their SQL cut to
+    SLOW_LOG_SQL_LENGTH characters, for the slow request log, so memory stays
+    bounded however many queries run.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.time += duration
+            if len(self.queries) < SLOW_LOG_QUERIES:
+                self.queries.append((duration, sql[:SLOW_LOG_SQL_LENGTH]))
+
+
+def record_query(execute, sql, params, many, context):
+    recorder = _current_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    # Installed on every connection once; the recorder is picked from the context so
+    # queries run from sync_to_async threads are attributed to the right request
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class RouteStats:
+
+    def __init__(self, window):
+        self.durations = deque(maxlen=window)
+        self.queries = deque(maxlen=window)
+        self.db_durations = deque(maxlen=window)
+        self.count = 0
+        self.duration_sum = 0.0
+        self.queries_sum = 0
+        self.db_duration_sum = 0.0
+
+    def add(self, duration, queries, db_duration):
+        self.durations.append(duration)
+        self.queries.append(queries)
+        self.db_durations.append(db_duration)
+        self.count += 1
+        self.duration_sum += duration
+        self.queries_sum += queries
+        self.db_duration_sum += db_duration
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {str(p): 0 for p in PERCENTILES}
+    return {str(p): values[min(len(values) - 1, int(p * len(values)))] for p in PERCENTILES}
+
+
+class MetricsRegistry:
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def record(self, route, duration, queries, db_duration):
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = RouteStats(self.window)
+            stats.add(duration, queries, db_duration)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                route: {
+                    'count': stats.count,
+                    'durationSum': stats.duration_sum,
+                    'queriesSum': stats.queries_sum,
+                    'dbDurationSum': stats.db_duration_sum,
+                    'duration': percentiles(stats.durations),
+                    'queries': percentiles(stats.queries),
+                    'dbDuration': percentiles(stats.db_durations),
+                }
+                for route, stats in self.routes.items()
+            }
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+
+
+registry = MetricsRegistry(settings.API_METRICS_WINDOW)
+
+
+class Measurement:
+    """Context manager recording wall time and DB usage of one unit of work under a route"""
+
+    def __init__(self, route=None):
+        self.route = route
+        self.recorder = QueryRecorder()
+
+    def __enter__(self):
+        self.token = _current_recorder.set(self.recorder)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start
+        _current_recorder.reset(self.token)
+        registry.record(self.route, duration, self.recorder.count, self.recorder.time)
+
+        if duration >= settings.API_SLOW_REQUEST_THRESHOLD:
+            queries = '\n'.join(f'[{query_time:.4f}s] {sql}' for query_time, sql in self.recorder.queries)
+            if self.recorder.count > len(self.recorder.queries):
+                queries += f'\n... {self.recorder.count - len(self.recorder.queries)} more queries'
+            logger.warning(
+                'Slow %s: %.3fs, %d queries, %.3fs in DB\n%s',
+                self.route, duration, self.recorder.count, self.recorder.time, queries
+            )
+
+
+class MetricsMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with Measurement() as measurement:
+            response = self.get_response(request)
+            match = request.resolver_match
+            measurement.route = f'{request.method} {match.route if match else "unmatched"}'
+        return response
+
+
+class MetricsConsumerMixin:
+    """Records every websocket message handled by a consumer under its path and type"""
+
+    async def dispatch(self, message):
+        with Measurement(f'WS {self.scope["path"]} {message["type"]}'):
+            await super().dispatch(message)
+
+
+def to_prometheus(snapshot):
+    """Render a registry snapshot in the Prometheus text exposition format"""
+    metrics = (
+        ('api_request_duration_seconds', 'duration', 'durationSum'),
+        ('api_request_db_queries', 'queries', 'queriesSum'),
+        ('api_request_db_duration_seconds', 'dbDuration', 'dbDurationSum'),
+    )
+    lines = []
+    for name, key, sum_key in metrics:
+        lines.append(f'# TYPE {name} summary')
+        for route, stats in sorted(snapshot.items()):
+            label = route.replace('\\', '\\\\').replace('"', '\\"')
+            for quantile, value in stats[key].items():
+                lines.append(f'{name}{{route="{label}",quantile="{quantile}"}} {value}')
+            lines.append(f'{name}_sum{{route="{label}"}} {stats[sum_key]}')
+            lines.append(f'{name}_count{{route="{label}"}} {stats["count"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.1 on 2026-10-18 11:43
+
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+STAT_FIELDS = ('armor', 'magicResist', 'health', 'damage', 'criticalHitChance', 'criticalHitDamage')
+
+
+def create_character_stats(apps, schema_editor):
+    Character = apps.get_model('api', 'Character')
+    CharacterStats = apps.get_model('api', 'CharacterStats')
+    Item = apps.get_model('api', 'Item')
+
+    stats = []
+    for character_id in Character.objects.values_list('pk', flat=True):
+        totals = Item.objects.filter(characteritem__character_id=character_id).aggregate(
+            **{field: Sum(field) for field in STAT_FIELDS}
+        )
+        stats.append(CharacterStats(character_id=character_id, **{field: value or 0 for field, value in totals.items()}))
+    CharacterStats.objects.bulk_create(stats)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_alter_userlocation_starttraveltime_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CharacterStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('armor', models.IntegerField(default=0)),
+                ('magicResist', models.IntegerField(default=0)),
+                ('health', models.IntegerField(default=0)),
+                ('damage', models.IntegerField(default=0)),
+                ('criticalHitChance', models.DecimalField(decimal_places=2, default=0, max_digits=7)),
+                ('criticalHitDamage', models.DecimalField(decimal_places=2, default=0, max_digits=7)),
+                ('character', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='itemStats', to='api.character')),
+            ],
+        ),
+        migrations.RunPython(create_character_stats, migrations.RunPython.noop),
+    ]
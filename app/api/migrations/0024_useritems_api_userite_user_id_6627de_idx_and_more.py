@@ -0,0 +1,50 @@
+# Generated by Django 4.2.1 on 2026-10-18 11:47
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+STAT_FIELDS = ('armor', 'magicResist', 'health', 'damage', 'criticalHitChance', 'criticalHitDamage')
+
+
+def dedupe_character_slots(apps, schema_editor):
+    """Keep one row per character slot, preferring an equipped one, and rebuild the stats of those characters"""
+    CharacterItem = apps.get_model('api', 'CharacterItem')
+    CharacterStats = apps.get_model('api', 'CharacterStats')
+    Item = apps.get_model('api', 'Item')
+
+    duplicates = CharacterItem.objects.values('character', 'slot').annotate(total=Count('pk')).filter(total__gt=1)
+    characters = set()
+    for duplicate in duplicates:
+        rows = CharacterItem.objects.filter(character=duplicate['character'], slot=duplicate['slot'])
+        equipped = rows.filter(item__isnull=False)
+        keep = (equipped if equipped.exists() else rows).order_by('pk').values_list('pk', flat=True).first()
+        rows.exclude(pk=keep).delete()
+        characters.add(duplicate['character'])
+
+    for character_id in characters:
+        totals = Item.objects.filter(characteritem__character_id=character_id).aggregate(
+            **{field: Sum(field) for field in STAT_FIELDS}
+        )
+        CharacterStats.objects.update_or_create(
+            character_id=character_id, defaults={field: value or 0 for field, value in totals.items()}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_characterstats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='useritems',
+            index=models.Index(fields=['user', 'item'], name='api_userite_user_id_6627de_idx'),
+        ),
+        migrations.RunPython(dedupe_character_slots, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='characteritem',
+            constraint=models.UniqueConstraint(fields=('character', 'slot'), name='unique_character_slot'),
+        ),
+    ]
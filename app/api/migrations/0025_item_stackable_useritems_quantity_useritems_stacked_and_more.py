@@ -0,0 +1,63 @@
+# Generated by Django 4.2.1 on 2026-10-18 11:50
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def mark_stackable_items(apps, schema_editor):
+    """Items without an equipment type stack, equipment keeps one row per copy for its equip state"""
+    Item = apps.get_model('api', 'Item')
+    Item.objects.filter(itemType__isnull=True).update(stackable=True)
+
+
+def compact_user_items(apps, schema_editor):
+    """Merge the copies of each stackable item a player owns into one stacked row"""
+    UserItems = apps.get_model('api', 'UserItems')
+
+    stacks = UserItems.objects.filter(item__stackable=True).values('user', 'item').annotate(
+        keep=Min('pk'), total=Count('pk')
+    ).values_list('keep', 'total')
+    UserItems.objects.bulk_update(
+        [UserItems(pk=pk, quantity=total, stacked=True) for pk, total in stacks], ['quantity', 'stacked'], batch_size=1000
+    )
+    UserItems.objects.filter(item__stackable=True, stacked=False).delete()
+
+
+def expand_user_items(apps, schema_editor):
+    UserItems = apps.get_model('api', 'UserItems')
+
+    copies = []
+    for item in UserItems.objects.filter(quantity__gt=1):
+        copies.extend(UserItems(user_id=item.user_id, item_id=item.item_id) for _ in range(item.quantity - 1))
+    UserItems.objects.bulk_create(copies)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_useritems_api_userite_user_id_6627de_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='stackable',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='useritems',
+            name='quantity',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='useritems',
+            name='stacked',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_stackable_items, migrations.RunPython.noop),
+        migrations.RunPython(compact_user_items, expand_user_items),
+        migrations.AddConstraint(
+            model_name='useritems',
+            constraint=models.UniqueConstraint(condition=models.Q(('stacked', True)), fields=('user', 'item'), name='unique_user_item_stack'),
+        ),
+    ]
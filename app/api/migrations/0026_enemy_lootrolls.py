@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 11:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0025_item_stackable_useritems_quantity_useritems_stacked_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='enemy',
+            name='lootRolls',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
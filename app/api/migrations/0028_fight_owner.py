@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 13:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0027_state_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fight',
+            name='owner',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Case, F, Sum, Value, When
 from django.core.validators import MaxValueValidator, MinValueValidator
 from rest_framework.exceptions import ValidationError
 from django.contrib.auth import get_user_model
@@ -6,7 +7,7 @@ from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 from django.contrib.auth.models import BaseUserManager
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
@@ -22,6 +23,9 @@ ITEM_TYPES = [
     ('weapon', 'weapon')
 ]
 
+# Equipment slots every character starts with
+CHARACTER_SLOTS = ('weapon', 'helmet', 'armor', 'gloves', 'boots', 'trousers')
+
 ITEM_RARITY = [
     ('common', 'common'),
     ('rare', 'rare'),
@@ -48,6 +52,10 @@ QUEST_TYPE_CHOICES = [
 ]
 
 
+# Item stats added on top of the character's own
+STAT_FIELDS = ('armor', 'magicResist', 'health', 'damage', 'criticalHitChance', 'criticalHitDamage')
+
+
 ELEMENT_TYPE_CHOICES = [
     ("npc", "NPC"),
     ("enemy", "Enemy"),
@@ -73,7 +81,9 @@ class CustomUserManager(BaseUserManager):
         user = self.model(email=email, name=name, **extra_fields)
 
         user.set_password(password)
-        user.save(using=self._db)
+        # The player's initial state is provisioned by a post_save receiver in the same transaction
+        with transaction.atomic(using=self._db):
+            user.save(using=self._db)
 
         return user
     
@@ -122,28 +132,29 @@ class Resources(models.Model):
     gold = models.IntegerField(default=100)
     lvl = models.ForeignKey(UserLvl, on_delete=models.CASCADE, default=1)
     exp = models.IntegerField(default=0)
+    # StateVersion of the player when the row last changed
+    version = models.BigIntegerField(default=0)
 
     def __str__(self):
         return str(self.user.name)
     
     def add_exp(self, exp_points):
-        current_lvl = self.lvl.lvl
-        current_exp = self.exp + exp_points
-        
-        while current_exp >= UserLvl.objects.get(lvl=current_lvl).expPoints:
-            current_exp = current_exp - UserLvl.objects.get(lvl=current_lvl).expPoints
-            current_lvl = current_lvl+1
+        """Add exp with a single UPDATE, returns (lvl, exp, expPoints of the new lvl).
 
-        self.lvl = UserLvl.objects.get(lvl=current_lvl)
-        self.exp = current_exp
+        Callers granting exp concurrently should lock the row with select_for_update.
+        """
+        from api.progression import get_exp_curve
 
-        self.save()
+        curve = get_exp_curve()
+        index, exp = curve.add_exp(self.lvl_id, self.exp, exp_points)
 
+        self.lvl_id = curve.pks[index]
+        self.exp = exp
+        Resources.objects.filter(pk=self.pk).update(
+            lvl=self.lvl_id, exp=self.exp, version=StateVersion.bump(self.user_id)
+        )
 
-    @receiver(post_save, sender=get_user_model())
-    def create_resource(sender, instance, created, **kwargs):
-        if created:
-            Resources.objects.create(user=instance, lvl=UserLvl.create_default_lvl())
+        return curve.lvls[index], self.exp, curve.exp_points[index]
 
 
 class Character(models.Model):
@@ -159,17 +170,10 @@ class Character(models.Model):
         return str(self.user.name)
     
     def get_item_stats(self):
-        equipped_items = CharacterItem.objects.filter(character=self).select_related('item')
-        item_stats = {
-            'armor': sum(item.item.armor for item in equipped_items if item.item),
-            'magicResist': sum(item.item.magicResist for item in equipped_items if item.item),
-            'health': sum(item.item.health for item in equipped_items if item.item),
-            'damage': sum(item.item.damage for item in equipped_items if item.item),
-            'criticalHitChance': sum(item.item.criticalHitChance for item in equipped_items if item.item),
-            'criticalHitDamage': sum(item.item.criticalHitDamage for item in equipped_items if item.item)
-        }
-
-        return item_stats
+        try:
+            return self.itemStats.as_dict()
+        except CharacterStats.DoesNotExist:
+            return CharacterStats.rebuild(self.pk).as_dict()
     
     def get_character_object_with_item_stats(self):
         item_stats = self.get_item_stats()
@@ -184,11 +188,6 @@ class Character(models.Model):
             pk=self.pk
         )
 
-    @receiver(post_save, sender=get_user_model())
-    def create_character(sender, instance, created, **kwargs):
-        if created:
-            Character.objects.create(user=instance)
-
 
 class Item(models.Model):
     name = models.CharField(max_length=100)
@@ -203,6 +202,9 @@ class Item(models.Model):
     imageUrl = models.ImageField(upload_to=upload_to, blank=True, null=True)
     rarity = models.CharField(max_length=32, choices=ITEM_RARITY)
     lvlRequired = models.IntegerField(default=1)
+    # Copies of a stackable item are kept as a single UserItems row with a quantity,
+    # equipment stays one row per copy
+    stackable = models.BooleanField(default=False)
 
     def __str__(self):
         return self.name
@@ -222,30 +224,75 @@ class Potion(models.Model):
 class UserItems(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    quantity = models.IntegerField(default=1)
+    # The player's single stack of a stackable item
+    stacked = models.BooleanField(default=False)
+    version = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'item']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'item'], condition=models.Q(stacked=True), name='unique_user_item_stack'
+            ),
+        ]
 
     def delete(self):
         eqItem = CharacterItem.objects.get(slot=self.item.itemType, character=self.user.character)
         if eqItem.item is not None:
             if eqItem.item.id == self.item.id:
-                Character.objects.get(user=self.user).remove_equipped_item_stats(self.item.itemType)
-                item = CharacterItem.objects.get(character=self.user.character, slot=self.item.itemType)
-                item.item = None
-                item.save()
+                eqItem.equip(None)
         return super().delete()
     
     def add_item(item_id, user_pk):
-        try:
-            item = Item.objects.get(pk=item_id)
-        except Item.DoesNotExist:
-            raise ValidationError({'item': "Provided item does not exists"})
-        
-        try:
-            user = CustomUser.objects.get(pk=user_pk)
-        except CustomUser.DoesNotExist:
+        if not CustomUser.objects.filter(pk=user_pk).exists():
             raise ValidationError({'user': 'Provided user does not exists'})
-        
-        new_item = UserItems.objects.create(user=user, item=item)
-        new_item.save()
+
+        UserItems.add_items(user_pk, {item_id: 1})
+
+    def add_items(user_id, counts):
+        """Add {item id: count} to the inventory, stackable items are added to the player's stack"""
+        stackable = dict(Item.objects.filter(pk__in=counts).values_list('pk', 'stackable'))
+        if len(stackable) != len(counts):
+            raise ValidationError({'item': "Provided item does not exists"})
+
+        version = StateVersion.bump(user_id)
+        new_items = []
+        for item_id, count in counts.items():
+            if not stackable[item_id]:
+                new_items.extend(UserItems(user_id=user_id, item_id=item_id, version=version) for _ in range(count))
+                continue
+            stack = UserItems.objects.filter(user_id=user_id, item_id=item_id, stacked=True)
+            if stack.update(quantity=F('quantity') + count, version=version):
+                continue
+            try:
+                with transaction.atomic():
+                    UserItems.objects.create(user_id=user_id, item_id=item_id, quantity=count, stacked=True)
+            except IntegrityError:
+                # The stack was created concurrently
+                stack.update(quantity=F('quantity') + count, version=version)
+        UserItems.objects.bulk_create(new_items)
+
+    def remove_items(user_id, counts):
+        """Take {UserItems id: count} out of the inventory in a fixed number of queries.
+
+        Returns False when a row is missing or holds fewer items, the caller is
+        expected to roll back its transaction then.
+        """
+        ids_by_count = {}
+        for row_id, count in counts.items():
+            ids_by_count.setdefault(count, []).append(row_id)
+        taken = Case(*(When(pk__in=ids, then=Value(count)) for count, ids in ids_by_count.items()))
+
+        rows = UserItems.objects.filter(user_id=user_id, pk__in=counts)
+        if rows.update(quantity=F('quantity') - taken, version=StateVersion.bump(user_id)) != len(counts):
+            return False
+        if rows.filter(quantity__lt=0).exists():
+            return False
+        rows.filter(quantity=0).delete()
+        return True
 
     def __str__(self):
         return (f'[{self.user.name}] {self.item.name }')
@@ -262,6 +309,7 @@ class UserPotions(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
     potion = models.ForeignKey(Potion, on_delete=models.CASCADE)
     quantity = models.IntegerField()
+    version = models.BigIntegerField(default=0)
 
 
 class CharacterItem(models.Model):
@@ -269,26 +317,24 @@ class CharacterItem(models.Model):
     character = models.ForeignKey(Character, on_delete=models.CASCADE)
     item = models.ForeignKey(Item, on_delete=models.CASCADE, null=True)
     slot = models.CharField(max_length=100, choices=ITEM_TYPES, default='weapon')
+    version = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['character', 'slot'], name='unique_character_slot'),
+        ]
 
     def __str__(self):
         return str(self.slot) + ' ' + str(self.character.user.name)
 
     def validate(self):
-        # Check if there's already an equipped item of the same type
-        equipped_items = CharacterItem.objects.filter(character=self.character).exclude(id=self.id)
-        user_items = UserItems.objects.filter(user=self.character.user)
-        is_equipped = False
-        for useritem in user_items:
-            if useritem.item.id == self.item.id:
-                is_equipped = True
-        if not is_equipped:
-            raise ValidationError({'item': 'This item is not in player inventory!'})
-        for equipped_item in equipped_items:
-                if equipped_item.slot == self.slot and equipped_item.item.itemType == self.item.itemType:
-
-                    raise ValidationError({'item': 'Cannot equip more than one item of the same type in this slot'})
         if self.slot != self.item.itemType:
             raise ValidationError({'item': 'Invalid slot for this item'})
+        # Existence checks on the (user, item) index and the (character, slot) constraint
+        if not UserItems.objects.filter(user__character=self.character_id, item=self.item_id).exists():
+            raise ValidationError({'item': 'This item is not in player inventory!'})
+        if self.pk is None and CharacterItem.objects.filter(character=self.character_id, slot=self.slot).exists():
+            raise ValidationError({'item': 'Cannot equip more than one item of the same type in this slot'})
 
     def clean(self):
         if self.item:
@@ -298,15 +344,117 @@ class CharacterItem(models.Model):
         self.clean()
         return super().save(*args, **kwargs)
 
+    def equip(self, item):
+        """Put item (or None) in this slot and apply the stat difference to CharacterStats"""
+        with transaction.atomic():
+            # The slot is locked so concurrent replacements apply their differences in turn
+            old_item = CharacterItem.objects.select_for_update().select_related('item').get(pk=self.pk).item
+            self.item = item
+            self.save()
+            CharacterStats.apply_change(self.character_id, [old_item], [item])
+
+    def equip_many(character_id, items, lvl):
+        """Equip a loadout given as {slot: item id or None} with a fixed number of queries"""
+        if set(items) - set(CHARACTER_SLOTS):
+            raise ValidationError({'slot': 'Invalid slot'})
+        item_ids = {item_id for item_id in items.values() if item_id is not None}
+        new_items = Item.objects.in_bulk(item_ids)
+        if len(new_items) != len(item_ids):
+            raise ValidationError({'item': 'Provided item does not exists'})
+
+        for slot, item_id in items.items():
+            if item_id is None:
+                continue
+            if new_items[item_id].itemType != slot:
+                raise ValidationError({'item': 'Invalid slot for this item'})
+            if new_items[item_id].lvlRequired > lvl:
+                raise ValidationError({'error': 'This item requires higher lvl'})
+
+        with transaction.atomic():
+            character_items = list(
+                CharacterItem.objects.select_for_update().select_related('item')
+                .filter(character=character_id, slot__in=items).order_by('slot')
+            )
+            # Checked with the slots locked, so the items can't be sold between the check and the equip
+            owned = UserItems.objects.filter(user__character=character_id, item__in=item_ids).values_list('item', flat=True)
+            if item_ids - set(owned):
+                raise ValidationError({'item': 'This item is not in player inventory!'})
+            old_items = [character_item.item for character_item in character_items]
+            version = StateVersion.bump(Character.objects.values_list('user_id', flat=True).get(pk=character_id))
+            for character_item in character_items:
+                character_item.item = new_items.get(items[character_item.slot])
+                character_item.version = version
+            CharacterItem.objects.bulk_update(character_items, ['item', 'version'])
+            CharacterStats.apply_change(
+                character_id, old_items, [character_item.item for character_item in character_items]
+            )
+        return character_items
+
     @receiver(post_save, sender=Character)
     def create_characteritem(sender, instance, created, **kwargs):
         if created:
-            CharacterItem.objects.create(character=instance, slot='weapon')
-            CharacterItem.objects.create(character=instance, slot='helmet')
-            CharacterItem.objects.create(character=instance, slot='armor')
-            CharacterItem.objects.create(character=instance, slot='gloves')
-            CharacterItem.objects.create(character=instance, slot='boots')
-            CharacterItem.objects.create(character=instance, slot='trousers')
+            CharacterItem.objects.bulk_create(CharacterItem(character=instance, slot=slot) for slot in CHARACTER_SLOTS)
+
+
+class CharacterStats(models.Model):
+    """Stats of the items equipped by a character, updated on every equip so
+    fight-ready stats are read with the character row"""
+    character = models.OneToOneField(Character, on_delete=models.CASCADE, related_name='itemStats')
+    armor = models.IntegerField(default=0)
+    magicResist = models.IntegerField(default=0)
+    health = models.IntegerField(default=0)
+    damage = models.IntegerField(default=0)
+    criticalHitChance = models.DecimalField(default=0, max_digits=7, decimal_places=2)
+    criticalHitDamage = models.DecimalField(default=0, max_digits=7, decimal_places=2)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in STAT_FIELDS}
+
+    def rebuild(character_id):
+        """Sum the equipped items in a single query and store the result"""
+        totals = Item.objects.filter(characteritem__character_id=character_id).aggregate(
+            **{field: Sum(field) for field in STAT_FIELDS}
+        )
+        stats, _ = CharacterStats.objects.update_or_create(
+            character_id=character_id, defaults={field: value or 0 for field, value in totals.items()}
+        )
+        return stats
+
+    def apply_change(character_id, old_items, new_items):
+        """Add the stats of new_items and subtract those of old_items, None stands for an empty slot"""
+        old_items = [item for item in old_items if item is not None]
+        new_items = [item for item in new_items if item is not None]
+        changes = {}
+        for field in STAT_FIELDS:
+            difference = sum(getattr(item, field) for item in new_items) - sum(getattr(item, field) for item in old_items)
+            if difference:
+                changes[field] = F(field) + difference
+        if changes and not CharacterStats.objects.filter(character_id=character_id).update(**changes):
+            CharacterStats.rebuild(character_id)
+
+    @receiver(post_save, sender=Character)
+    def create_character_stats(sender, instance, created, **kwargs):
+        if created:
+            CharacterStats.objects.create(character=instance)
+
+    @receiver(post_save, sender=Item)
+    def rebuild_item_holders(sender, instance, created, **kwargs):
+        # Stats of an equipped item changed through the admin
+        if not created:
+            holders = CharacterItem.objects.filter(item=instance).values_list('character', flat=True)
+            for character_id in holders:
+                CharacterStats.rebuild(character_id)
+
+    @receiver(pre_delete, sender=Item)
+    def rebuild_deleted_item_holders(sender, instance, **kwargs):
+        # The equipped rows are deleted along with the item, holders are collected first
+        holders = list(CharacterItem.objects.filter(item=instance).values_list('character', flat=True))
+        def rebuild_holders():
+            for character_id in holders:
+                CharacterStats.rebuild(character_id)
+
+        if holders:
+            transaction.on_commit(rebuild_holders)
 
 
 class Region(models.Model):
@@ -414,6 +562,8 @@ class Enemy(models.Model):
     criticalHitDamage = models.DecimalField(default=1.5, max_digits=5, decimal_places=2)
     lvl = models.IntegerField()
     exp = models.IntegerField(default=10)
+    # Number of independent rolls on the loot table per kill
+    lootRolls = models.PositiveIntegerField(default=1)
     imgSrc = models.ImageField(blank=True, null=True, upload_to=upload_to)
     location = models.ForeignKey(Location, on_delete=models.CASCADE, null=True, blank=True)
 
@@ -498,27 +648,20 @@ class UserLocation(models.Model):
     user = models.OneToOneField(get_user_model(), on_delete=models.CASCADE)
     travelTime = models.DateTimeField(default=timezone.now)
     startTravelTime = models.DateTimeField(default=timezone.now)
+    version = models.BigIntegerField(default=0)
 
     def __str__(self):
         return (f'{self.user} - {self.location}')
 
-
-    @receiver(post_save, sender=get_user_model())
-    def create_user_location(sender, instance, created, **kwargs):
-        if created:
-            default_location = Location.get_or_create_default_location()
-            if default_location:
-                UserLocation.objects.create(user=instance, location=default_location)
-            else:
-                print("[WARN] Default location not found. UserLocation was not created.")
-
     def can_move(self):
         return timezone.now() >= self.travelTime
 
     def update_travel_time(self, seconds):
         self.travelTime = timezone.now() + timedelta(seconds=seconds)
         self.startTravelTime = timezone.now()
-        self.save()
+        # The row takes its sync version on save, both have to commit together
+        with transaction.atomic():
+            self.save()
         return self.travelTime, self.startTravelTime
     
     def update_user_location(self, location_id):
@@ -528,7 +671,8 @@ class UserLocation(models.Model):
             raise ValidationError({'location': "User can not travel to location that does not exist!"})
         
         self.location = target_location
-        self.save()
+        with transaction.atomic():
+            self.save()
         return self.location
             
 
@@ -538,6 +682,8 @@ class Fight(models.Model):
     currentPlayerHP = models.IntegerField()
     currentEnemyHP = models.IntegerField()
     isActive = models.BooleanField(default=False)
+    # Channel of the connection computing the fight's turns, empty while no connection owns it
+    owner = models.CharField(max_length=100, blank=True, default='')
 
 
 class Transaction(models.Model):
@@ -571,6 +717,7 @@ class StoryState(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name="story_states")
     key = models.CharField(max_length=100)
     value = models.JSONField()
+    version = models.BigIntegerField(default=0)
 
     class Meta:
         unique_together = ('user', 'key')
@@ -578,10 +725,54 @@ class StoryState(models.Model):
     def __str__(self):
         return f"State for {self.user.username}: {self.key} = {self.value}"
 
-    @receiver(post_save, sender=get_user_model())
-    def create_story_state(sender, instance, created, **kwargs):
-        if created:
-            StoryState.objects.create(user=instance, key="initial_story", value={})
+
+class StateVersion(models.Model):
+    """Monotonic counter of changes to a player's state.
+
+    Every change to a synced row (see api.sync) takes the next version and
+    stores it in the row's ``version``, deleted rows leave a StateTombstone, so
+    clients fetch only what changed since the version they hold.
+    """
+    user = models.OneToOneField(get_user_model(), on_delete=models.CASCADE, related_name='stateVersion')
+    version = models.BigIntegerField(default=0)
+
+    def bump(user_id):
+        """Take the player's next version.
+
+        Call it in the transaction writing the change, the counter row stays
+        locked until commit so changes become visible in version order.
+        """
+        with transaction.atomic(savepoint=False):
+            version = StateVersion.increment(user_id)
+            if version is None:
+                # Players created before versions were tracked
+                StateVersion.objects.get_or_create(user_id=user_id)
+                version = StateVersion.increment(user_id)
+            return version
+
+    def increment(user_id):
+        """Add one to the counter and read it back in a single UPDATE ... RETURNING, None without a counter row"""
+        table = connection.ops.quote_name(StateVersion._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f'UPDATE {table} SET version = version + 1 WHERE user_id = %s RETURNING version', [user_id])
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_version(user_id):
+        return StateVersion.objects.filter(user_id=user_id).values_list('version', flat=True).first() or 0
+
+
+class StateTombstone(models.Model):
+    """Synced row deleted at ``version``"""
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
+    section = models.CharField(max_length=32)
+    object_id = models.BigIntegerField()
+    version = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'version']),
+        ]
 
 
 class Quest(models.Model):
@@ -620,12 +811,6 @@ class UserQuest(models.Model):
     quest = models.ForeignKey(Quest, on_delete=models.CASCADE)
     progress = models.CharField(max_length=20, choices=QUEST_PROGRESS, default='not_started')
 
-    @receiver(post_save, sender=get_user_model())
-    def create_user_quest(sender, instance, created, **kwargs):
-        if created:
-            for quest in Quest.objects.all():
-                UserQuest.objects.create(user=instance, quest=Quest.objects.get(pk=1))
-
     def __str__(self):
         return f"{self.user.name} - {self.quest.title}"
 
@@ -635,6 +820,7 @@ class UserQuestRequirement(models.Model):
     requirement = models.ForeignKey(QuestRequirement, on_delete=models.CASCADE)
     progress = models.CharField(max_length=20, choices=QUEST_PROGRESS, default='not_started')
     amount_progress = models.IntegerField(default=0)
+    version = models.BigIntegerField(default=0)
 
     # Create user quest requirements for specific quest whenever user starts a quest
     @receiver(post_save, sender=UserQuest)
@@ -0,0 +1,130 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import weakref
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from api import models
+
+
+logger = logging.getLogger(__name__)
+
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+
+def notify(user_id, event, data):
+    """Push an event to every notification connection of the player once the current transaction commits.
+
+    Payloads cross the channel layer, so they must be plain JSON-compatible values.
+    """
+    def send():
+        channel_layer = get_channel_layer()
+        if channel_layer is not None:
+            async_to_sync(channel_layer.group_send)(
+                user_group(user_id), {'type': 'notification.event', 'event': event, 'data': data}
+            )
+
+    transaction.on_commit(send)
+
+
+def travel_payload(user_location):
+    """travelStarted event data of a travel to user_location.location"""
+    return {
+        'location': user_location.location_id,
+        'locationName': user_location.location.name,
+        'travelEndDatetime': user_location.travelTime.isoformat(),
+        'arrival': user_location.travelTime.timestamp(),
+    }
+
+
+class TravelScheduler:
+    """Travel arrivals of the connections in one event loop.
+
+    A single task sleeps until the earliest arrival of a heap of timers, so
+    thousands of travelling players cost one sleeping task. Scheduling again
+    under the same key replaces the previous timer, replaced and cancelled
+    timers are dropped lazily when they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self.timers = []
+        self.pending = {}
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def schedule(self, key, deadline, callback):
+        """Run the coroutine function callback at the unix timestamp deadline"""
+        sequence = next(self.sequence)
+        self.pending[key] = sequence
+        heapq.heappush(self.timers, (deadline, sequence, key, callback))
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        elif self.timers[0][1] == sequence:
+            # New earliest arrival, the task sleeps until the previous one
+            self.wakeup.set()
+
+    def cancel(self, key):
+        self.pending.pop(key, None)
+
+    async def run(self):
+        while self.pending:
+            deadline, sequence, key, callback = self.timers[0]
+            if self.pending.get(key) != sequence:
+                heapq.heappop(self.timers)
+                continue
+
+            delay = deadline - time.time()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.timers)
+            del self.pending[key]
+            asyncio.ensure_future(self.fire(callback))
+        self.timers.clear()
+
+    async def fire(self, callback):
+        try:
+            await callback()
+        except Exception:
+            logger.exception('Travel arrival callback failed')
+
+
+_schedulers = weakref.WeakKeyDictionary()
+
+
+def get_travel_scheduler():
+    """Scheduler of the running event loop"""
+    loop = asyncio.get_running_loop()
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        scheduler = _schedulers[loop] = TravelScheduler()
+    return scheduler
+
+
+@receiver(post_save, sender=models.UserQuestRequirement)
+def notify_quest_progress(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    user_id = models.UserQuest.objects.values_list('user_id', flat=True).get(pk=instance.user_quest_id)
+    notify(user_id, 'questProgress', {
+        'id': instance.pk,
+        'userQuest': instance.user_quest_id,
+        'requirement': instance.requirement_id,
+        'progress': instance.progress,
+        'amountProgress': instance.amount_progress,
+    })
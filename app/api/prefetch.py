@@ -0,0 +1,75 @@
+from functools import lru_cache
+
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+
+
+def get_model_field(model, name):
+    try:
+        return model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+
+
+def build_plan(serializer):
+    """Walk serializer fields and collect relations it is going to touch.
+
+    Returns ``(select_related, prefetch_related)`` where prefetch entries are
+    ``(lookup, model, nested plan)`` tuples, nested plan being None for plain lookups.
+    """
+    model = serializer.Meta.model
+    select_related = []
+    prefetch_related = []
+
+    for field in serializer.fields.values():
+        if field.write_only or field.source == '*' or '.' in field.source:
+            continue
+        model_field = get_model_field(model, field.source)
+        if model_field is None:
+            continue
+
+        if isinstance(field, serializers.ListSerializer) and isinstance(field.child, serializers.ModelSerializer):
+            prefetch_related.append((field.source, field.child.Meta.model, build_plan(field.child)))
+        elif isinstance(field, serializers.ModelSerializer):
+            select_related.append(field.source)
+            nested_select, nested_prefetch = build_plan(field)
+            select_related += [f'{field.source}__{lookup}' for lookup in nested_select]
+            prefetch_related += [
+                (f'{field.source}__{lookup}', nested_model, nested_plan)
+                for lookup, nested_model, nested_plan in nested_prefetch
+            ]
+        elif isinstance(field, serializers.ManyRelatedField):
+            prefetch_related.append((field.source, None, None))
+        elif isinstance(field, serializers.RelatedField):
+            if isinstance(model_field, GenericForeignKey):
+                prefetch_related.append((field.source, None, None))
+            elif not field.use_pk_only_optimization():
+                select_related.append(field.source)
+
+    return select_related, prefetch_related
+
+
+@lru_cache(maxsize=None)
+def get_prefetch_plan(serializer_class):
+    return build_plan(serializer_class())
+
+
+def apply_plan(queryset, plan):
+    select_related, prefetch_related = plan
+    lookups = []
+    for lookup, model, nested_plan in prefetch_related:
+        if nested_plan is None:
+            lookups.append(lookup)
+        else:
+            # Prefetch objects are mutated while evaluated, so build new ones every time
+            lookups.append(Prefetch(lookup, queryset=apply_plan(model.objects.all(), nested_plan)))
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    return queryset.prefetch_related(*lookups)
+
+
+def optimize_queryset(queryset, serializer_class):
+    """Attach select_related/prefetch_related needed to serialize queryset without N+1 queries"""
+    return apply_plan(queryset, get_prefetch_plan(serializer_class))
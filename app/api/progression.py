@@ -0,0 +1,45 @@
+from bisect import bisect_right
+
+from api.caching import user_lvl_cache
+
+
+class ExpCurve:
+    """Level table flattened into cumulative exp thresholds.
+
+    ``thresholds[i]`` is the total exp needed to reach ``lvls[i]``, so the level
+    for a given total is found with a single binary search.
+    """
+
+    def __init__(self, user_lvls):
+        user_lvls = sorted(user_lvls, key=lambda user_lvl: user_lvl.lvl)
+        self.lvls = [user_lvl.lvl for user_lvl in user_lvls]
+        self.exp_points = [user_lvl.expPoints for user_lvl in user_lvls]
+        self.pks = [user_lvl.pk for user_lvl in user_lvls]
+        self.index_by_pk = {pk: i for i, pk in enumerate(self.pks)}
+
+        self.thresholds = []
+        total = 0
+        for exp_points in self.exp_points:
+            self.thresholds.append(total)
+            total += exp_points
+
+    def add_exp(self, lvl_pk, exp, exp_points):
+        """Returns (index of the new level, exp within it) after gaining exp_points"""
+        index = self.index_by_pk[lvl_pk]
+        total = self.thresholds[index] + exp + exp_points
+        # Exp above the last level in the table stays on the last level
+        new_index = max(index, bisect_right(self.thresholds, total) - 1)
+        return new_index, total - self.thresholds[new_index]
+
+
+_exp_curve = None
+
+
+def get_exp_curve():
+    global _exp_curve
+    generation = user_lvl_cache.get_generation()
+    curve = _exp_curve
+    if curve is None or curve[0] != generation:
+        curve = (generation, ExpCurve(user_lvl_cache.all()))
+        _exp_curve = curve
+    return curve[1]
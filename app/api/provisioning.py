@@ -0,0 +1,85 @@
+import logging
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from api import models
+
+
+logger = logging.getLogger(__name__)
+
+
+class StarterState:
+    """Shared rows every new player starts with, loaded once per provisioning run"""
+
+    def __init__(self):
+        self.lvl = models.UserLvl.create_default_lvl()
+        self.location = models.Location.get_or_create_default_location()
+        if self.location is None:
+            logger.warning("Default location not found. UserLocation was not created.")
+        self.quests = list(models.Quest.objects.prefetch_related('requirements').order_by('pk'))
+
+
+def provision_players(users, starter=None):
+    """Create the initial state of already saved users with one bulk insert per table"""
+    users = list(users)
+    if not users:
+        return users
+    starter = starter or StarterState()
+
+    with transaction.atomic():
+        models.StateVersion.objects.bulk_create(models.StateVersion(user=user) for user in users)
+        models.Resources.objects.bulk_create(models.Resources(user=user, lvl=starter.lvl) for user in users)
+        characters = models.Character.objects.bulk_create(models.Character(user=user) for user in users)
+        models.CharacterItem.objects.bulk_create(
+            models.CharacterItem(character=character, slot=slot) for character in characters for slot in models.CHARACTER_SLOTS
+        )
+        models.CharacterStats.objects.bulk_create(models.CharacterStats(character=character) for character in characters)
+        if starter.location is not None:
+            models.UserLocation.objects.bulk_create(
+                models.UserLocation(user=user, location=starter.location) for user in users
+            )
+        models.StoryState.objects.bulk_create(
+            models.StoryState(user=user, key="initial_story", value={}) for user in users
+        )
+
+        user_quests = models.UserQuest.objects.bulk_create(
+            models.UserQuest(user=user, quest=quest) for user in users for quest in starter.quests
+        )
+        models.UserQuestRequirement.objects.bulk_create(
+            models.UserQuestRequirement(
+                user_quest=user_quest, requirement=requirement,
+                progress='in_progress' if requirement.position == 1 else 'not_started'
+            )
+            for user_quest in user_quests for requirement in user_quest.quest.requirements.all()
+        )
+    return users
+
+
+def create_players(accounts, starter=None, hashes=None):
+    """Bulk create users from (email, name, password) tuples together with their initial state.
+
+    Equal passwords are hashed once and share the salt, which keeps imports of
+    load testing accounts fast. Pass the same ``hashes`` dict to reuse them between batches.
+    """
+    hashes = {} if hashes is None else hashes
+    users = []
+    for email, name, password in accounts:
+        if password not in hashes:
+            hashes[password] = make_password(password)
+        users.append(get_user_model()(
+            email=get_user_model().objects.normalize_email(email), name=name, password=hashes[password]
+        ))
+
+    with transaction.atomic():
+        users = get_user_model().objects.bulk_create(users)
+        return provision_players(users, starter)
+
+
+@receiver(post_save, sender=get_user_model())
+def provision_new_user(sender, instance, created, **kwargs):
+    if created:
+        provision_players([instance])
@@ -0,0 +1,56 @@
+import json
+
+from rest_framework import renderers
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.settings import api_settings
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Same output as DRF's compact, unicode JSON: datetimes end with Z and keys
+# such as location ids may be ints
+ORJSON_OPTIONS = orjson and orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+_encoder = encoders.JSONEncoder()
+
+
+def dumps(data):
+    """Encode data to UTF-8 JSON bytes the way DRF's JSONRenderer does, Decimal values become numbers"""
+    if orjson is not None:
+        # Types orjson doesn't know (Decimal, timedelta, lazy strings...) go through DRF's encoder
+        return orjson.dumps(data, default=_encoder.default, option=ORJSON_OPTIONS)
+    return json.dumps(data, cls=encoders.JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    """JSONRenderer backed by orjson when it is installed"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Indented output is for humans, orjson only indents by two spaces
+        if data is None or self.get_indent(accepted_media_type, renderer_context or {}) \
+                or not (api_settings.COMPACT_JSON and api_settings.UNICODE_JSON):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data)
+
+
+class FastJSONParser(JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if orjson is None:
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
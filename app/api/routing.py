@@ -3,4 +3,5 @@ from api import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/combat/', consumers.CombatSystemConsumer.as_asgi()),
+    re_path(r'ws/notifications/', consumers.NotificationConsumer.as_asgi()),
 ]
@@ -1,4 +1,8 @@
+from collections import Counter
+
 from django.contrib.auth import get_user_model, authenticate
+from django.db import transaction
+from django.db.models import F, Sum
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
@@ -123,6 +127,8 @@ class UserItemsSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.UserItems
         fields = '__all__'
+        # Stacks change through UserItems.add_items and remove_items only, a writable quantity would duplicate items
+        read_only_fields = ('quantity', 'stacked', 'version')
     
     def get_imageUrl(self, obj):
         # Get the request object from the context
@@ -146,6 +152,31 @@ class UserPotionsSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class UserItemsCompactSerializer(serializers.ModelSerializer):
+    """Inventory entry referencing the item catalog by id"""
+    class Meta:
+        model = models.UserItems
+        fields = ('id', 'item', 'quantity')
+
+
+class UserPotionsCompactSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.UserPotions
+        fields = ('id', 'potion', 'quantity')
+
+
+class UserCollectableItemsCompactSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.UserCollectableItem
+        fields = ('id', 'collectableItem', 'quantity')
+
+
+class StoryStateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.StoryState
+        fields = ('id', 'key', 'value', 'version')
+
+
 class EnemySerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Enemy
@@ -216,46 +247,69 @@ class TransactionSerializer(serializers.ModelSerializer):
         itemsSell = args.pop('sellItems', [])
         itemsBuy = args.pop('buyItems', [])
 
-        sum1 = 0
-        sum2 = 0
-        
-        for i, item in enumerate(itemsSell):
-            try:
-                sum1 += models.UserItems.objects.filter(user=user).get(id=item).item.goldValue
-            except models.UserItems.DoesNotExist:
-                raise ValidationError({'error': 'Podano nieprawidłowe id przedmiotów użytkownika'})
-        # Sum values of items that user is going to buy
-        for i, item in enumerate(itemsBuy):
-            try: 
-                sum2 += models.StoreItem.objects.filter(store=attrs['store']).get(id=item).price
-            except models.StoreItem.DoesNotExist:
-                raise ValidationError({'error': 'Podano niepoprawne id przedmiotów ze sklepu'})
-        
-        total = sum1 - sum2
+        # An owned row can be sold as many times as its quantity, store items can be bought several times
+        sold_items = Counter(itemsSell)
+        owned_items = models.UserItems.objects.filter(user=user, id__in=sold_items).select_related('item').in_bulk()
+        if any(item not in owned_items or count > owned_items[item].quantity for item, count in sold_items.items()):
+            raise ValidationError({'error': 'Podano nieprawidłowe id przedmiotów użytkownika'})
+        sold_items = {owned_items[item]: count for item, count in sold_items.items()}
+
+        store_items = models.StoreItem.objects.filter(store=attrs['store'], id__in=itemsBuy).in_bulk()
+        if any(item not in store_items for item in itemsBuy):
+            raise ValidationError({'error': 'Podano niepoprawne id przedmiotów ze sklepu'})
+        bought_items = [store_items[item] for item in itemsBuy]
+
+        total = sum(item.item.goldValue * count for item, count in sold_items.items()) - sum(item.price for item in bought_items)
         args['totalAmount'] = total
-        
+
         if total < 0:
             resurces = models.Resources.objects.get(user=user)
             can_afford = resurces.gold + total
 
             if can_afford < 0:
                 raise ValidationError({'error': 'Niewystarczająca ilość złota'})
-            
-        for item in itemsSell:
-            models.UserItems.objects.get(user=user, id=item).delete()
-        for item in itemsBuy:
-            itemId = models.StoreItem.objects.get(id=item).item.id
-            models.UserItems.objects.create(user=user, item=models.Item.objects.get(id=itemId))
-        
+
+        args['soldItems'] = sold_items
+        args['boughtItems'] = bought_items
         return args
     
     def create(self, validated_data):
-        transaction = models.Transaction.objects.create(**validated_data)
         user = self.context.get('request').user
-        resources = models.Resources.objects.get(user=user)
-        resources.gold += validated_data['totalAmount']
-        resources.save()
-        return models.Transaction.objects.create(**validated_data)
+        sold_items = validated_data.pop('soldItems')
+        bought_items = validated_data.pop('boughtItems')
+        total = validated_data['totalAmount']
+
+        with transaction.atomic():
+            version = models.StateVersion.bump(user.pk)
+            # Gold and sold items are checked again under the transaction, a concurrent
+            # request may have spent the gold or sold the same items since validation
+            resources = models.Resources.objects.filter(user=user)
+            if total < 0:
+                resources = resources.filter(gold__gte=-total)
+            if not resources.update(gold=F('gold') + total, version=version):
+                raise ValidationError({'error': 'Niewystarczająca ilość złota'})
+
+            if sold_items:
+                # Unequip only items the player has no other copy of
+                sold_per_item = Counter()
+                for item, count in sold_items.items():
+                    sold_per_item[item.item_id] += count
+                owned = models.UserItems.objects.filter(user=user, item__in=sold_per_item).values('item').annotate(
+                    total=Sum('quantity')
+                ).values_list('item', 'total')
+                unequipped = models.CharacterItem.objects.filter(
+                    character__user=user, item__in=[item for item, total in owned if total <= sold_per_item[item]]
+                ).update(item=None, version=version)
+                if unequipped:
+                    models.CharacterStats.rebuild(user.character.pk)
+
+                if not models.UserItems.remove_items(user.pk, {item.id: count for item, count in sold_items.items()}):
+                    raise ValidationError({'error': 'Podano nieprawidłowe id przedmiotów użytkownika'})
+
+            if bought_items:
+                models.UserItems.add_items(user.pk, Counter(item.item_id for item in bought_items))
+
+            return models.Transaction.objects.create(**validated_data)
     
     def update(self, instance, validated_data):
         instance.save()
@@ -0,0 +1,87 @@
+import numpy as np
+
+from api.fight import is_critical_hit, strike_damage
+
+
+COMBAT_STATS = ('health', 'armor', 'damage', 'criticalHitChance', 'criticalHitDamage')
+
+# Fights still running after this many rounds (e.g. both sides blocked by armor) end as draws
+MAX_ROUNDS = 1000
+
+
+def stat_arrays(combatants):
+    """Stats of Character/Enemy objects as float arrays, one element per combatant"""
+    combatants = list(combatants)
+    return {stat: np.array([float(getattr(combatant, stat)) for combatant in combatants]) for stat in COMBAT_STATS}
+
+
+def simulate_fights(character, enemies, fights, rng=None, max_rounds=MAX_ROUNDS, chunk_size=100_000):
+    """Run ``fights`` fights for every pair of the broadcast character and enemy stat arrays.
+
+    Rounds follow CombatSystemConsumer: the player strikes first and the enemy
+    strikes back while alive, both with the strike formula of api.fight. Returns
+    arrays of the broadcast shape with the number of wins, losses and draws, the
+    rounds played in all fights and the rounds played in won fights.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    shape = np.broadcast(*character.values(), *enemies.values()).shape
+    character = {stat: np.broadcast_to(values, shape).ravel() for stat, values in character.items()}
+    enemies = {stat: np.broadcast_to(values, shape).ravel() for stat, values in enemies.items()}
+    pairs = character['health'].size
+
+    totals = {key: np.zeros(pairs, dtype=np.int64) for key in ('wins', 'losses', 'draws', 'rounds', 'kill_rounds')}
+    for offset in range(0, fights, chunk_size):
+        chunk = min(chunk_size, fights - offset)
+        pair = np.repeat(np.arange(pairs), chunk)
+        _simulate_chunk(character, enemies, pair, rng, max_rounds, totals)
+
+    return {key: values.reshape(shape) for key, values in totals.items()}
+
+
+def _simulate_chunk(character, enemies, pair, rng, max_rounds, totals):
+    # Only running fights are kept, ``pair`` maps them back to their stats
+    player_health = character['health'][pair]
+    enemy_health = enemies['health'][pair]
+
+    for round_number in range(1, max_rounds + 1):
+        critical = is_critical_hit(character['criticalHitChance'][pair], rng.random(pair.size))
+        enemy_health -= strike_damage(
+            character['damage'][pair], character['criticalHitDamage'][pair], critical, enemies['armor'][pair], np.maximum
+        )
+        won = enemy_health <= 0
+        _finish(totals, pair[won], round_number, 'wins')
+
+        running = ~won
+        pair, player_health, enemy_health = pair[running], player_health[running], enemy_health[running]
+        critical = is_critical_hit(enemies['criticalHitChance'][pair], rng.random(pair.size))
+        player_health -= strike_damage(
+            enemies['damage'][pair], enemies['criticalHitDamage'][pair], critical, character['armor'][pair], np.maximum
+        )
+        lost = player_health <= 0
+        _finish(totals, pair[lost], round_number, 'losses')
+
+        running = ~lost
+        pair, player_health, enemy_health = pair[running], player_health[running], enemy_health[running]
+        if not pair.size:
+            return
+
+    _finish(totals, pair, max_rounds, 'draws')
+
+
+def _finish(totals, pair, rounds, result):
+    counts = np.bincount(pair, minlength=totals[result].size)
+    totals[result] += counts
+    totals['rounds'] += counts * rounds
+    if result == 'wins':
+        totals['kill_rounds'] += counts * rounds
+
+
+def summarize(results, exp, round_seconds):
+    """Win rate, mean rounds to kill and exp per hour of simulate_fights results, ``exp`` broadcasts like the stats"""
+    fights = results['wins'] + results['losses'] + results['draws']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'win_rate': results['wins'] / fights,
+            'rounds_to_kill': np.where(results['wins'] > 0, results['kill_rounds'] / results['wins'], np.nan),
+            'exp_per_hour': exp * results['wins'] * 3600 / (results['rounds'] * round_seconds),
+        }
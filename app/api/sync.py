@@ -0,0 +1,74 @@
+from django.contrib.auth import get_user_model
+from django.db.models import QuerySet
+from django.db.models.signals import pre_save, post_delete
+
+from api import models
+from api import serializers
+from api.prefetch import optimize_queryset
+
+
+# Section name: (model, lookup of the owning user, serializer)
+SYNCED_SECTIONS = {
+    'resources': (models.Resources, 'user', serializers.ResourcesSerializer),
+    'items': (models.UserItems, 'user', serializers.UserItemsSerializer),
+    'potions': (models.UserPotions, 'user', serializers.UserPotionsSerializer),
+    'equipment': (models.CharacterItem, 'character__user', serializers.CharacterItemSerializer),
+    'location': (models.UserLocation, 'user', serializers.UserLocationSerializer),
+    'questRequirements': (models.UserQuestRequirement, 'user_quest__user', serializers.UserQuestRequirementSerializer),
+    'storyState': (models.StoryState, 'user', serializers.StoryStateSerializer),
+}
+
+SECTIONS_BY_MODEL = {model: section for section, (model, owner, serializer_class) in SYNCED_SECTIONS.items()}
+
+
+def get_owner_id(instance):
+    if isinstance(instance, models.CharacterItem):
+        return models.Character.objects.values_list('user_id', flat=True).get(pk=instance.character_id)
+    if isinstance(instance, models.UserQuestRequirement):
+        return models.UserQuest.objects.values_list('user_id', flat=True).get(pk=instance.user_quest_id)
+    return instance.user_id
+
+
+def get_changes(request, since=None):
+    """Synced rows changed after ``since`` and ids of the rows deleted since then, every row when since is None"""
+    user = request.user
+    # Read first, rows changed meanwhile are sent again with the next sync rather than missed
+    version = models.StateVersion.get_version(user.pk)
+
+    changes = {}
+    for section, (model, owner, serializer_class) in SYNCED_SECTIONS.items():
+        queryset = model.objects.filter(**{owner: user})
+        if since is not None:
+            queryset = queryset.filter(version__gt=since)
+        queryset = optimize_queryset(queryset.order_by('pk'), serializer_class)
+        changes[section] = serializer_class(queryset, many=True, context={'request': request}).data
+
+    deleted = {}
+    if since is not None:
+        tombstones = models.StateTombstone.objects.filter(user=user, version__gt=since).order_by('version')
+        for section, object_id in tombstones.values_list('section', 'object_id'):
+            deleted.setdefault(section, []).append(object_id)
+
+    return {'version': version, 'changes': changes, 'deleted': deleted}
+
+
+def stamp_version(sender, instance, raw, **kwargs):
+    # Bulk writes skip signals, they stamp versions themselves
+    if not raw:
+        instance.version = models.StateVersion.bump(get_owner_id(instance))
+
+
+def record_tombstone(sender, instance, origin=None, **kwargs):
+    # Rows deleted together with their player need no tombstone
+    if isinstance(origin, get_user_model()) or (isinstance(origin, QuerySet) and origin.model is get_user_model()):
+        return
+    user_id = get_owner_id(instance)
+    models.StateTombstone.objects.create(
+        user_id=user_id, section=SECTIONS_BY_MODEL[sender], object_id=instance.pk,
+        version=models.StateVersion.bump(user_id)
+    )
+
+
+for model in SECTIONS_BY_MODEL:
+    pre_save.connect(stamp_version, sender=model, dispatch_uid=f'sync_stamp_{model._meta.label_lower}')
+    post_delete.connect(record_tombstone, sender=model, dispatch_uid=f'sync_tombstone_{model._meta.label_lower}')
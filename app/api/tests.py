@@ -1,3 +1,1801 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import importlib
+import io
+import json
+import math
+import os
+import pickle
+import random
+import tempfile
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.management import call_command
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ParseError, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from api import models
+from api import serializers
+from api import world
+from api.authentication import CachedTokenAuthentication, _local as local_cache, token_cache_key
+from api.caching import LocalCache, enemy_loot_cache, incr_version, item_cache, user_lvl_cache
+from api.content import accepts_gzip, bump_content_version
+from api.consumers import CombatSystemConsumer, NotificationConsumer
+from api.fight import Fight, FightSession, is_critical_hit, strike_damage
+from api.loot import LootTable, get_loot_table
+from api.metrics import Measurement, QueryRecorder, registry, to_prometheus
+from api.notifications import TravelScheduler
+from api.progression import ExpCurve, get_exp_curve
+from api.provisioning import StarterState, create_players, provision_players
+from api.renderers import FastJSONParser, FastJSONRenderer
+from api.simulation import simulate_fights, stat_arrays
+from api.travel_table import GraphSearch, TravelTable, get_travel_table
+from api.utils import TIME_PER_LOCATION, a_star, dijkstra, region_cost
+
+
+class LocationQueryCountTests(TestCase):
+
+    def setUp(self):
+        self.region = models.Region.objects.create(name='Region', description='Region')
+        self.location_count = 0
+        user = models.CustomUser.objects.create_user('test@example.com', 'test', 'password123')
+        token = Token.objects.create(user=user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        # Cached from here on, so authentication costs the same in every measured request
+        CachedTokenAuthentication().authenticate_credentials(token.key)
+
+    def create_locations(self, count):
+        for _ in range(count):
+            self.location_count += 1
+            location = models.Location.objects.create(
+                name=f'Location {self.location_count}', region=self.region, lvlRequired=1,
+                description='', xCoordinate=self.location_count, yCoordinate=0
+            )
+            sublocation = models.SubLocation.objects.create(
+                name=f'Sublocation {self.location_count}', description='', parent_location=location
+            )
+            npc = models.NPC.objects.create(name='NPC', location=location, imageUrl='npc.png')
+            enemy = models.Enemy.objects.create(
+                name='Enemy', health=10, armor=0, magicResist=0, damage=1, lvl=1, location=location
+            )
+            item = models.Item.objects.create(name='Item', itemType='weapon', rarity='common')
+            models.LocationElement.objects.create(location=location, type='npc', npc=npc, position_x=0, position_y=0)
+            models.LocationElement.objects.create(location=location, type='enemy', enemy=enemy, position_x=1, position_y=0)
+            models.LocationElement.objects.create(location=location, type='item', item=item, position_x=2, position_y=0)
+            models.LocationElement.objects.create(
+                location=location, type='location', location_element=location, position_x=3, position_y=0
+            )
+            models.LocationElement.objects.create(
+                location=location, type='location', sublocation_element=sublocation, position_x=4, position_y=0
+            )
+            models.LocationElement.objects.create(sublocation=sublocation, type='npc', npc=npc, position_x=0, position_y=0)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_location_list_query_count_is_constant(self):
+        self.create_locations(2)
+        small = self.count_queries('/api/locations/')
+        self.create_locations(10)
+        self.assertEqual(self.count_queries('/api/locations/'), small)
+
+    def test_user_location_query_count_is_constant(self):
+        self.create_locations(1)
+        models.UserLocation.objects.create(user=models.CustomUser.objects.get(), location=models.Location.objects.first())
+        small = self.count_queries('/api/current_location/')
+        self.create_locations(10)
+        for location in models.Location.objects.all():
+            models.LocationElement.objects.create(
+                location=models.Location.objects.first(), type='location', location_element=location,
+                position_x=0, position_y=0
+            )
+        self.assertEqual(self.count_queries('/api/current_location/'), small)
+
+
+class ReachabilityTests(TestCase):
+
+    def setUp(self):
+        region = models.Region.objects.create(name='Region', description='Region')
+        self.locations = [
+            models.Location.objects.create(
+                name=f'Location {x}', region=region, lvlRequired=1, description='', xCoordinate=x, yCoordinate=0
+            )
+            for x in (0, 1, 3)
+        ]
+        self.user = models.CustomUser.objects.create_user('reach@example.com', 'reach', 'password123')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+
+    def get_reachability(self, locations):
+        return self.client.get('/api/locations/reachability/', {'locations': ','.join(map(str, locations))})
+
+    def test_travel_times(self):
+        models.UserLocation.objects.create(user=self.user, location=self.locations[0])
+        response = self.get_reachability(location.pk for location in self.locations)
+        self.assertEqual(response.status_code, 200)
+        start, neighbor, island = self.locations
+        self.assertEqual(response.data['travelTimes'], {start.pk: 0, neighbor.pk: TIME_PER_LOCATION, island.pk: None})
+
+    def test_player_without_location(self):
+        self.assertEqual(self.get_reachability([self.locations[0].pk]).status_code, 400)
+
+    def test_unknown_locations(self):
+        models.UserLocation.objects.create(user=self.user, location=self.locations[0])
+        response = self.get_reachability([self.locations[1].pk, 0])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': 'Unknown locations: 0'})
+
+
+def use_temporary_travel_table(test_case):
+    """Point TRAVEL_TABLE_PATH at a file removed after the test, returns its path"""
+    directory = tempfile.TemporaryDirectory()
+    test_case.addCleanup(directory.cleanup)
+    path = os.path.join(directory.name, 'travel_table.bin')
+    override = test_case.settings(TRAVEL_TABLE_PATH=path)
+    override.enable()
+    test_case.addCleanup(override.disable)
+    return path
+
+
+class TravelTableTests(SimpleTestCase):
+
+    def setUp(self):
+        self.path = use_temporary_travel_table(self)
+        # Irregular map: holes, a dead end and an island no path reaches
+        rows = (
+            'XXXX.XX',
+            'X..X.X.',
+            'XX.XXXX',
+            '.X...X.',
+            'XXXX.X.',
+            '.....XX',
+            'XX.....',
+        )
+        self.graph = world.WorldGraph(
+            {'id': 100 + len(rows[0]) * y + x, 'name': f'{x},{y}', 'region': 1, 'xCoordinate': x, 'yCoordinate': y}
+            for y, row in enumerate(rows) for x, cell in enumerate(row) if cell == 'X'
+        )
+
+    def assertMatchesDijkstra(self, table):
+        for source in self.graph.locations:
+            travel_times = table.get_travel_times(source)
+            for target, location in self.graph.locations.items():
+                with self.subTest(source=source, target=target):
+                    expected_time, expected_path = dijkstra(self.graph.adjacency, source, target)
+                    time, path = table.find_path(source, target)
+                    self.assertEqual(time, expected_time)
+                    self.assertEqual(travel_times[location['id']], None if expected_time == math.inf else expected_time)
+                    self.assertEqual(len(path), len(expected_path))
+                    if path:
+                        self.assertEqual((path[0], path[-1]), (source, target))
+                        for step, next_step in zip(path, path[1:]):
+                            self.assertIn(next_step, self.graph.adjacency[step])
+
+    def test_built_table_matches_dijkstra(self):
+        self.assertMatchesDijkstra(TravelTable.build(self.graph))
+
+    def test_mapped_table_matches_dijkstra(self):
+        TravelTable.build(self.graph).save(self.path)
+        self.assertMatchesDijkstra(TravelTable.load(self.path, self.graph))
+
+    def test_graph_search_matches_dijkstra(self):
+        self.assertMatchesDijkstra(GraphSearch(self.graph))
+
+    def test_unknown_locations(self):
+        for table in (TravelTable.build(self.graph), GraphSearch(self.graph)):
+            self.assertEqual(table.find_path((0, 0), (4, 0)), (math.inf, []))
+
+    def test_table_of_another_map_is_not_loaded(self):
+        TravelTable.build(self.graph).save(self.path)
+        other = world.WorldGraph([{'id': 1, 'name': 'Start', 'region': 1, 'xCoordinate': 0, 'yCoordinate': 0}])
+        self.assertIsNone(TravelTable.load(self.path, other))
+
+    def test_requests_never_build_the_table(self):
+        with mock.patch.object(TravelTable, 'build') as build:
+            table = get_travel_table(self.graph)
+        build.assert_not_called()
+        self.assertIsInstance(table, GraphSearch)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_file_is_mapped_once_built(self):
+        self.assertIsInstance(get_travel_table(self.graph), GraphSearch)
+        TravelTable.build(self.graph).save(self.path)
+        with mock.patch('api.travel_table.TRAVEL_TABLE_RETRY_INTERVAL', 0):
+            self.assertIsInstance(get_travel_table(self.graph), TravelTable)
+
+
+class TravelTableStalenessTests(TestCase):
+
+    def setUp(self):
+        self.path = use_temporary_travel_table(self)
+        self.region = models.Region.objects.create(name='Region', description='Region')
+
+    def create_location(self, x):
+        return models.Location.objects.create(
+            name=f'Location {x}', region=self.region, lvlRequired=1, description='', xCoordinate=x, yCoordinate=0
+        )
+
+    def build(self, *args):
+        out = io.StringIO()
+        call_command('build_travel_table', *args, stdout=out)
+        return out.getvalue()
+
+    def test_location_changes_only_mark_the_table_stale(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_location(0)
+            location = self.create_location(1)
+        self.assertIn('built for 2 locations', self.build())
+        self.assertIsInstance(get_travel_table(), TravelTable)
+
+        with mock.patch.object(TravelTable, 'build') as build, self.captureOnCommitCallbacks(execute=True):
+            location.delete()
+            self.create_location(2)
+        build.assert_not_called()
+        # New world version, the file of the old coordinates is not used
+        table = get_travel_table()
+        self.assertIsInstance(table, GraphSearch)
+        self.assertEqual(table.find_path((0, 0), (2, 0)), (math.inf, []))
+
+        self.build()
+        with mock.patch('api.travel_table.TRAVEL_TABLE_RETRY_INTERVAL', 0):
+            self.assertIsInstance(get_travel_table(), TravelTable)
+
+    def test_command_skips_a_current_table(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            location = self.create_location(0)
+        self.build()
+        with self.captureOnCommitCallbacks(execute=True):
+            location.name = 'Renamed'
+            location.save()
+        with mock.patch.object(TravelTable, 'build', wraps=TravelTable.build) as build:
+            self.assertIn('up to date', self.build())
+            build.assert_not_called()
+            self.assertIn('built', self.build('--force'))
+            build.assert_called_once()
+
+
+class WorldGraphTests(TestCase):
+
+    def setUp(self):
+        use_temporary_travel_table(self)
+        self.region = models.Region.objects.create(name='Region', description='Region')
+        self.location = models.Location.objects.create(
+            name='Start', region=self.region, lvlRequired=1, description='', xCoordinate=0, yCoordinate=0
+        )
+
+    def add_location(self, x):
+        # Saved without the receiver, as another worker would
+        models.Location.objects.bulk_create([models.Location(
+            name=f'Location {x}', region=self.region, lvlRequired=1, description='', xCoordinate=x, yCoordinate=0
+        )])
+
+    def test_graph_is_reused(self):
+        graph = world.get_world_graph()
+        with CaptureQueriesContext(connection) as context:
+            self.assertIs(world.get_world_graph(), graph)
+        self.assertEqual(len(context.captured_queries), 0)
+
+    def test_version_bump_reloads_graph(self):
+        world.get_world_graph()
+        self.add_location(1)
+        self.assertNotIn((1, 0), world.get_world_graph())
+
+        world.bump_world_version()
+        graph = world.get_world_graph()
+        self.assertIn((1, 0), graph)
+        self.assertEqual(graph.version, world.get_world_version())
+
+    def test_location_change_bumps_version_on_commit(self):
+        version = world.get_world_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.location.name = 'Renamed'
+            self.location.save()
+        self.assertGreater(world.get_world_version(), version)
+        self.assertEqual(world.get_world_graph().get_location((0, 0))['name'], 'Renamed')
+
+    def test_graph_loaded_during_a_change_is_not_kept(self):
+        world.invalidate_world_graph()
+        load_world_graph = world.load_world_graph
+
+        def load_during_change(version):
+            graph = load_world_graph(version)
+            world.bump_world_version()
+            return graph
+
+        with mock.patch('api.world.load_world_graph', load_during_change):
+            world.get_world_graph()
+        self.add_location(1)
+        self.assertIn((1, 0), world.get_world_graph())
+
+
+class PlayerStateTests(TestCase):
+
+    def setUp(self):
+        self.region = models.Region.objects.create(name='Region', description='Region')
+        models.Location.objects.create(
+            name='Przełęcz Mroźnego Wiatru', region=self.region, lvlRequired=1, description='', xCoordinate=0, yCoordinate=0
+        )
+        self.enemy = models.Enemy.objects.create(name='Enemy', health=10, armor=0, magicResist=0, damage=1, lvl=1)
+        self.create_quests(1)
+        self.user = models.CustomUser.objects.create_user('state@example.com', 'state', 'password123')
+        token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        CachedTokenAuthentication().authenticate_credentials(token.key)
+
+    def create_quests(self, count, user=None):
+        enemy_type = ContentType.objects.get_for_model(models.Enemy)
+        for _ in range(count):
+            quest = models.Quest.objects.create(title='Quest', description='')
+            for position in (1, 2):
+                models.QuestRequirement.objects.create(
+                    quest=quest, type='kill', amount=1, target_content_type=enemy_type,
+                    target_object_id=self.enemy.pk, position=position
+                )
+            if user:
+                models.UserQuest.objects.create(user=user, quest=quest)
+
+    def get_state(self, fields=None):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/me/state/', {'fields': fields} if fields else {})
+        return response, len(context)
+
+    def test_query_count_is_constant(self):
+        response, small = self.get_state()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['quests']), 1)
+
+        self.create_quests(5, self.user)
+        items = [models.Item.objects.create(name='Item', itemType='weapon', rarity='common') for _ in range(5)]
+        models.UserItems.add_items(self.user.pk, {item.pk: 1 for item in items})
+        models.CharacterItem.objects.get(character__user=self.user, slot='weapon').equip(items[0])
+
+        response, large = self.get_state()
+        self.assertEqual(large, small)
+        self.assertEqual(len(response.data['quests']), 6)
+        self.assertEqual(len(response.data['inventory']['items']['results']), 5)
+
+    def test_sections_match_endpoints(self):
+        response, _ = self.get_state()
+        self.assertEqual(response.data['resources'], self.client.get('/api/resources/').data)
+        self.assertEqual(response.data['character'], self.client.get('/api/character/get_all_stats/').data)
+        self.assertEqual(response.data['equipment'], self.client.get('/api/equipment/').data)
+        self.assertEqual(response.data['location'], self.client.get('/api/current_location/').data)
+
+    def test_sparse_fields(self):
+        response, queries = self.get_state('resources,quests')
+        self.assertEqual(set(response.data), {'version', 'resources', 'quests'})
+        self.assertLess(queries, self.get_state()[1])
+
+        response, _ = self.get_state('resources,unknown')
+        self.assertEqual(response.status_code, 400)
+
+    def test_inventory_links_continue_on_inventory_endpoint(self):
+        items = [models.Item.objects.create(name='Item', itemType='weapon', rarity='common') for _ in range(3)]
+        models.UserItems.add_items(self.user.pk, {item.pk: 1 for item in items})
+
+        response = self.client.get('/api/me/state/', {'fields': 'inventory', 'compact': 'true', 'page_size': 2})
+        next_link = response.data['inventory']['items']['next']
+        self.assertTrue(next_link.startswith('http://testserver/api/inventory/?'))
+        self.assertNotIn('fields=', next_link)
+
+        page = self.client.get(next_link)
+        self.assertEqual(page.status_code, 200)
+        self.assertEqual([row['item'] for row in page.data['results']], [items[2].pk])
+
+        response = self.client.get('/api/me/state/', {'cursor': 'cD0x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class InventoryTests(TestCase):
+
+    def setUp(self):
+        self.user = models.CustomUser.objects.create_user('inventory@example.com', 'inventory', 'password123')
+        self.items = [
+            models.Item.objects.create(name=f'Item {number}', itemType=item_type, rarity=rarity, lvlRequired=lvl)
+            for number, (item_type, rarity, lvl) in enumerate((
+                ('weapon', 'common', 1), ('weapon', 'rare', 5), ('helmet', 'common', 3),
+                ('helmet', 'rare', 8), ('boots', 'common', 2),
+            ))
+        ]
+        self.rows = [models.UserItems.objects.create(user=self.user, item=item) for item in self.items]
+        other = models.CustomUser.objects.create_user('other@example.com', 'other', 'password123')
+        models.UserItems.objects.create(user=other, item=self.items[0])
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+
+    def get_inventory(self, **params):
+        return self.client.get('/api/inventory/', params)
+
+    def get_item_ids(self, **params):
+        response = self.get_inventory(section='items', **params)
+        self.assertEqual(response.status_code, 200)
+        return [row['item']['id'] for row in response.data['results']]
+
+    def test_sections(self):
+        response = self.get_inventory()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'items', 'potions', 'collectableItems'})
+        for section in response.data.values():
+            self.assertEqual(set(section), {'next', 'previous', 'results'})
+        self.assertEqual([row['id'] for row in response.data['items']['results']], [row.pk for row in self.rows])
+        self.assertEqual(response.data['potions']['results'], [])
+
+    def test_pages_follow_next_links(self):
+        response = self.get_inventory(page_size=2)
+        pages = [response.data['items']['results']]
+        next_link = response.data['items']['next']
+        self.assertIn('section=items', next_link)
+        while next_link:
+            response = self.client.get(next_link)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(set(response.data), {'next', 'previous', 'results'})
+            pages.append(response.data['results'])
+            next_link = response.data['next']
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([row['id'] for page in pages for row in page], [row.pk for row in self.rows])
+
+    def test_item_filters(self):
+        weapon, rare_weapon, helmet, rare_helmet, boots = (item.pk for item in self.items)
+        self.assertEqual(self.get_item_ids(itemType='helmet'), [helmet, rare_helmet])
+        self.assertEqual(self.get_item_ids(rarity='rare'), [rare_weapon, rare_helmet])
+        self.assertEqual(self.get_item_ids(lvlRequired=3), [helmet])
+        self.assertEqual(self.get_item_ids(minLvlRequired=3, maxLvlRequired=5), [rare_weapon, helmet])
+        self.assertEqual(self.get_item_ids(itemType='weapon', rarity='common'), [weapon])
+
+    def test_equipped_filter(self):
+        models.CharacterItem.objects.filter(character__user=self.user, slot='helmet').update(item=self.items[2])
+        self.assertEqual(self.get_item_ids(equipped='true'), [self.items[2].pk])
+        self.assertEqual(len(self.get_item_ids(equipped='false')), len(self.items) - 1)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.get_inventory(section='items', lvlRequired='high').status_code, 400)
+        self.assertEqual(self.get_inventory(section='gold').status_code, 400)
+
+    def test_cursor_needs_a_section(self):
+        next_link = self.get_inventory(page_size=1).data['items']['next']
+        cursor = parse_qs(urlsplit(next_link).query)['cursor'][0]
+        # Another section's cursor would skip rows of the other sections
+        self.assertEqual(self.get_inventory(page_size=1, cursor=cursor).status_code, 400)
+        response = self.get_inventory(section='items', page_size=1, cursor=cursor)
+        self.assertEqual([row['id'] for row in response.data['results']], [self.rows[1].pk])
+
+    def test_compact(self):
+        response = self.get_inventory(compact='true')
+        self.assertEqual(response.data['items']['results'][0], {'id': self.rows[0].pk, 'item': self.items[0].pk, 'quantity': 1})
+        response = self.get_inventory(section='potions', compact='1')
+        self.assertEqual(response.data['results'], [])
+
+
+class PlayerChangesTests(TestCase):
+
+    def setUp(self):
+        self.user = models.CustomUser.objects.create_user('sync@example.com', 'sync', 'password123')
+        self.item = models.Item.objects.create(name='Item', itemType='weapon', rarity='common')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+
+    def get_changes(self, since=None):
+        response = self.client.get('/api/me/changes/', {'since': since} if since is not None else {})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_full_sync_returns_every_row(self):
+        data = self.get_changes()
+        self.assertEqual(len(data['changes']['resources']), 1)
+        self.assertEqual(len(data['changes']['equipment']), len(models.CHARACTER_SLOTS))
+        self.assertEqual(data['deleted'], {})
+
+    def test_only_changed_rows_are_returned(self):
+        version = self.get_changes()['version']
+        self.assertEqual(self.get_changes(version)['changes']['items'], [])
+
+        models.UserItems.add_items(self.user.pk, {self.item.pk: 2})
+        models.CharacterItem.objects.get(character__user=self.user, slot='weapon').equip(self.item)
+        data = self.get_changes(version)
+        self.assertGreater(data['version'], version)
+        self.assertEqual([row['quantity'] for row in data['changes']['items']], [1, 1])
+        self.assertEqual([row['slot'] for row in data['changes']['equipment']], ['weapon'])
+        self.assertEqual(data['changes']['resources'], [])
+
+        self.assertEqual(self.get_changes(data['version'])['changes']['items'], [])
+
+    def test_deleted_rows_leave_tombstones(self):
+        models.UserItems.add_items(self.user.pk, {self.item.pk: 1})
+        row = models.UserItems.objects.get(user=self.user)
+        version = self.get_changes()['version']
+
+        self.assertTrue(models.UserItems.remove_items(self.user.pk, {row.pk: 1}))
+        data = self.get_changes(version)
+        self.assertEqual(data['deleted'], {'items': [row.pk]})
+        self.assertEqual(self.get_changes(data['version'])['deleted'], {})
+
+    def test_invalid_version(self):
+        self.assertEqual(self.client.get('/api/me/changes/', {'since': 'x'}).status_code, 400)
+
+
+class PathfindingTests(SimpleTestCase):
+
+    def setUp(self):
+        rng = random.Random(7)
+        # 12x12 map with about a fifth of the cells missing and three terrain regions
+        self.graph = world.WorldGraph(
+            {'id': 12 * y + x, 'name': f'{x},{y}', 'region': rng.choice((1, 2, 3)), 'xCoordinate': x, 'yCoordinate': y}
+            for y in range(12) for x in range(12) if rng.random() > 0.2
+        )
+        self.pairs = [tuple(rng.sample(sorted(self.graph.locations), 2)) for _ in range(200)]
+
+    def assertOptimal(self, cost=None):
+        step_cost = cost or (lambda current, neighbor: TIME_PER_LOCATION)
+        for source, target in self.pairs:
+            with self.subTest(source=source, target=target):
+                # Without a heuristic a_star is a plain Dijkstra search
+                expected, _ = a_star(self.graph.adjacency, source, target, cost, min_cost=0)
+                time, path = a_star(self.graph.adjacency, source, target, cost)
+                self.assertAlmostEqual(time, expected)
+                if path:
+                    self.assertAlmostEqual(sum(step_cost(*step) for step in zip(path, path[1:])), time)
+
+    def test_default_cost_matches_dijkstra(self):
+        for source, target in self.pairs:
+            self.assertEqual(
+                a_star(self.graph.adjacency, source, target)[0], dijkstra(self.graph.adjacency, source, target)[0]
+            )
+
+    def test_region_cost_is_optimal(self):
+        for weights in ({2: 3, 3: 0.4}, {1: 2, 2: 2, 3: 2}, {}):
+            with self.subTest(weights=weights):
+                self.assertOptimal(region_cost(weights, self.graph))
+
+    def test_region_cost_min_cost(self):
+        self.assertEqual(region_cost({2: 3, 3: 0.4}, self.graph).min_cost, TIME_PER_LOCATION * 0.4)
+        self.assertEqual(region_cost({1: 2, 2: 2, 3: 2}, self.graph).min_cost, TIME_PER_LOCATION * 2)
+        # Weights of regions not on the map don't lower the bound
+        self.assertEqual(region_cost({4: 0.1}, self.graph).min_cost, TIME_PER_LOCATION)
+
+
+class StateVersionTests(TransactionTestCase):
+
+    def setUp(self):
+        use_temporary_travel_table(self)
+        region = models.Region.objects.create(name='Region', description='Region')
+        self.start, self.target = [
+            models.Location.objects.create(
+                name=name, region=region, lvlRequired=1, description='', xCoordinate=x, yCoordinate=0
+            )
+            for x, name in enumerate(('Przełęcz Mroźnego Wiatru', 'Target'))
+        ]
+        self.user = models.CustomUser.objects.create_user('version@example.com', 'version', 'password123')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+
+    def record_bumps(self):
+        """Patch StateVersion.bump to record whether each call ran inside a transaction"""
+        bump = models.StateVersion.bump
+        in_transaction = []
+
+        def record(user_id):
+            in_transaction.append(connection.in_atomic_block)
+            return bump(user_id)
+
+        patcher = mock.patch.object(models.StateVersion, 'bump', record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return in_transaction
+
+    def test_travel_stamps_in_a_transaction(self):
+        in_transaction = self.record_bumps()
+        response = self.client.post('/api/locations/travel/', {'target_location_id': self.target.pk}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(in_transaction, [True])
+        user_location = models.UserLocation.objects.get(user=self.user)
+        self.assertEqual(user_location.location, self.target)
+        self.assertEqual(user_location.version, models.StateVersion.get_version(self.user.pk))
+
+    def test_location_update_stamps_in_a_transaction(self):
+        in_transaction = self.record_bumps()
+        models.UserLocation.objects.get(user=self.user).update_user_location(self.target.pk)
+        self.assertEqual(in_transaction, [True])
+
+    def test_bump_takes_one_query(self):
+        version = models.StateVersion.get_version(self.user.pk)
+        with transaction.atomic(), CaptureQueriesContext(connection) as context:
+            self.assertEqual(models.StateVersion.bump(self.user.pk), version + 1)
+        self.assertEqual(len(context.captured_queries), 1)
+
+    def test_bump_creates_missing_counter(self):
+        models.StateVersion.objects.filter(user=self.user).delete()
+        self.assertEqual(models.StateVersion.bump(self.user.pk), 1)
+        self.assertEqual(models.StateVersion.bump(self.user.pk), 2)
+
+
+class TravelSchedulerTests(SimpleTestCase):
+
+    def test_timers_fire_in_deadline_order(self):
+        async def run():
+            fired = []
+            scheduler = TravelScheduler()
+
+            def record(key):
+                async def callback():
+                    fired.append(key)
+                return callback
+
+            start = time.time()
+            scheduler.schedule('late', start + 0.2, record('late'))
+            scheduler.schedule('replaced', start + 0.05, record('replaced'))
+            scheduler.schedule('cancelled', start + 0.1, record('cancelled'))
+            scheduler.schedule('early', start + 0.1, record('early'))
+            scheduler.schedule('replaced', start + 0.15, record('replaced'))
+            scheduler.cancel('cancelled')
+            await asyncio.sleep(0.3)
+            return fired
+
+        self.assertEqual(async_to_sync(run)(), ['early', 'replaced', 'late'])
+
+
+class FightSessionTests(TestCase):
+
+    def setUp(self):
+        self.user = models.CustomUser.objects.create_user('session@example.com', 'session', 'password123')
+        self.enemy = models.Enemy.objects.create(name='Enemy', health=50, armor=0, magicResist=0, damage=1, lvl=1)
+
+    def start(self, enemy=None, owner=''):
+        character = models.Character.objects.select_related('user').get(user=self.user).get_character_object_with_item_stats()
+        enemy = models.Enemy.objects.get(pk=(enemy or self.enemy).pk)
+        session, resumed = FightSession.start(character, enemy, owner)
+        return session, resumed, character, enemy
+
+    def test_resume_from_snapshot(self):
+        session, resumed, character, enemy = self.start()
+        self.assertFalse(resumed)
+        character.health, enemy.health = 70, 20
+        session.update(character, enemy)
+        session.snapshot()
+
+        session, resumed, character, enemy = self.start()
+        self.assertTrue(resumed)
+        self.assertEqual((character.health, enemy.health), (70, 20))
+        self.assertEqual(models.Fight.objects.filter(user=self.user, isActive=True).count(), 1)
+
+    def test_other_enemy_replaces_the_fight(self):
+        first, _, _, _ = self.start()
+        other = models.Enemy.objects.create(name='Other', health=30, armor=0, magicResist=0, damage=1, lvl=1)
+        second, resumed, _, enemy = self.start(other)
+        self.assertFalse(resumed)
+        self.assertEqual(enemy.health, 30)
+        self.assertEqual(list(models.Fight.objects.filter(user=self.user, isActive=True)), [second.record])
+
+    def test_owner_is_kept_until_released(self):
+        first, _, _, _ = self.start(owner='first')
+        self.assertEqual(first.previous_owner, '')
+        second, _, _, _ = self.start(owner='second')
+        self.assertEqual(second.previous_owner, 'first')
+
+        # The first owner leaving does not clear the fight taken over by the second
+        first.release('first')
+        self.assertEqual(models.Fight.objects.get(pk=first.record.pk).owner, 'second')
+        second.release('second')
+        third, _, _, _ = self.start(owner='third')
+        self.assertEqual(third.previous_owner, '')
+
+    def test_start_locks_the_character(self):
+        with mock.patch.object(
+            models.Character.objects, 'select_for_update', wraps=models.Character.objects.select_for_update
+        ) as select_for_update:
+            self.start()
+        select_for_update.assert_called_once_with()
+
+    def test_snapshots_are_written_behind(self):
+        session, _, character, enemy = self.start()
+        enemy.health = 40
+        with mock.patch('api.fight.SNAPSHOT_INTERVAL', 1000):
+            session.update(character, enemy)
+            self.assertFalse(session.should_snapshot())
+        # Changes stay in memory until a snapshot
+        self.assertEqual(models.Fight.objects.get(pk=session.record.pk).currentEnemyHP, 50)
+
+        with mock.patch('api.fight.SNAPSHOT_INTERVAL', 0):
+            self.assertTrue(session.should_snapshot())
+            session.snapshot()
+            self.assertEqual(models.Fight.objects.get(pk=session.record.pk).currentEnemyHP, 40)
+            # Nothing changed since, so nothing to write
+            self.assertFalse(session.should_snapshot())
+
+
+class FightEndTests(TransactionTestCase):
+
+    def setUp(self):
+        self.addCleanup(enemy_loot_cache.bump_generation)
+        self.addCleanup(user_lvl_cache.bump_generation)
+        self.user = models.CustomUser.objects.create_user('end@example.com', 'end', 'password123')
+        self.enemy = models.Enemy.objects.create(
+            name='Enemy', health=50, armor=0, magicResist=0, damage=1, lvl=1, exp=30, lootRolls=1
+        )
+        self.item = models.Item.objects.create(name='Drop', itemType='weapon', rarity='common')
+        models.EnemyLoot.objects.create(enemy=self.enemy, item=self.item, rarity=1.0)
+
+    def finish(self, winner=True):
+        character = models.Character.objects.select_related('user').get(user=self.user).get_character_object_with_item_stats()
+        consumer = CombatSystemConsumer()
+        consumer.user, consumer.enemy, consumer.winner = character, self.enemy, winner
+        consumer.session, _ = FightSession.start(character, self.enemy)
+        return async_to_sync(consumer.finish_fight)()
+
+    def test_win_awards_loot_and_exp(self):
+        drops, lvl, exp, exp_points = self.finish()
+        self.assertEqual([drop['id'] for drop in drops], [self.item.pk])
+        self.assertEqual((lvl, exp, exp_points), (1, 30, 100))
+        self.assertEqual(models.UserItems.objects.get(user=self.user).item, self.item)
+        self.assertEqual(models.Resources.objects.get(user=self.user).exp, 30)
+        self.assertFalse(models.Fight.objects.get(user=self.user).isActive)
+
+    def test_loss_awards_nothing(self):
+        self.assertEqual(self.finish(winner=False), (None, None, None, None))
+        self.assertFalse(models.UserItems.objects.filter(user=self.user).exists())
+        self.assertEqual(models.Resources.objects.get(user=self.user).exp, 0)
+        self.assertFalse(models.Fight.objects.get(user=self.user).isActive)
+
+    def test_rewards_are_written_in_one_transaction(self):
+        with mock.patch.object(models.Resources, 'add_exp', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.finish()
+        # Neither the drops nor the end of the fight are kept without the exp
+        self.assertFalse(models.UserItems.objects.filter(user=self.user).exists())
+        self.assertTrue(models.Fight.objects.get(user=self.user).isActive)
+
+
+class CombatHandoverTests(TransactionTestCase):
+
+    def setUp(self):
+        user = models.CustomUser.objects.create_user('fight@example.com', 'fight', 'password123')
+        models.Character.objects.filter(user=user).update(criticalHitChance=0, damage=10)
+        self.enemy = models.Enemy.objects.create(name='Enemy', health=50, armor=0, magicResist=0, damage=1, lvl=1, exp=10)
+
+    async def join(self):
+        communicator = WebsocketCommunicator(CombatSystemConsumer.as_asgi(), '/ws/combat/')
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'set_enemy', 'enemyId': self.enemy.pk})
+        await communicator.send_json_to({'type': 'set_user', 'userEmail': 'fight@example.com'})
+        return communicator
+
+    @mock.patch('api.fight.SNAPSHOT_INTERVAL', 1000)
+    def test_actions_wait_for_the_handover(self):
+        async def run():
+            first = await self.join()
+            await first.send_json_to({'action': 'user_attack'})
+            self.assertEqual((await first.receive_json_from())['enemy']['health'], 40)
+
+            # The snapshot still holds 50, the attack sent right away lands after the 40 handed over
+            second = await self.join()
+            await second.send_json_to({'action': 'user_attack'})
+            resumed = await second.receive_json_from()
+            self.assertEqual((resumed['fightResumed'], resumed['enemy']['health']), (True, 50))
+            self.assertEqual((await second.receive_json_from())['enemy']['health'], 30)
+            self.assertEqual((await first.receive_json_from())['enemy']['health'], 30)
+
+            await first.disconnect()
+            await second.disconnect()
+
+        async_to_sync(run)()
+
+    @mock.patch('api.consumers.HANDOVER_TIMEOUT', 1000)
+    def test_resumed_fight_without_owner_goes_on_from_snapshot(self):
+        models.Fight.objects.create(
+            user=models.CustomUser.objects.get(), enemy=self.enemy, currentPlayerHP=80, currentEnemyHP=20, isActive=True
+        )
+
+        async def run():
+            communicator = await self.join()
+            await communicator.send_json_to({'action': 'user_attack'})
+            self.assertTrue((await communicator.receive_json_from())['fightResumed'])
+            # Nobody to wait for, the attack is not held for the handover
+            self.assertEqual((await communicator.receive_json_from(timeout=1))['enemy']['health'], 10)
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    @mock.patch('api.fight.SNAPSHOT_INTERVAL', 1000)
+    @mock.patch('api.consumers.HANDOVER_TIMEOUT', 1000)
+    def test_reconnect_after_owner_left_goes_on_from_snapshot(self):
+        async def run():
+            first = await self.join()
+            await first.send_json_to({'action': 'user_attack'})
+            self.assertEqual((await first.receive_json_from())['enemy']['health'], 40)
+            await first.disconnect()
+
+            second = await self.join()
+            await second.send_json_to({'action': 'user_attack'})
+            self.assertEqual((await second.receive_json_from())['enemy']['health'], 40)
+            self.assertEqual((await second.receive_json_from(timeout=1))['enemy']['health'], 30)
+            await second.disconnect()
+
+        async_to_sync(run)()
+
+    @mock.patch('api.consumers.HANDOVER_TIMEOUT', 0.05)
+    def test_lost_owner_is_waited_for_until_the_timeout(self):
+        # Owner of a node that went down without leaving the fight
+        models.Fight.objects.create(
+            user=models.CustomUser.objects.get(), enemy=self.enemy, currentPlayerHP=80, currentEnemyHP=20,
+            isActive=True, owner='lost'
+        )
+
+        async def run():
+            communicator = await self.join()
+            await communicator.send_json_to({'action': 'user_attack'})
+            self.assertTrue((await communicator.receive_json_from())['fightResumed'])
+            self.assertEqual((await communicator.receive_json_from(timeout=1))['enemy']['health'], 10)
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+
+class CombatConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.addCleanup(enemy_loot_cache.bump_generation)
+        self.addCleanup(user_lvl_cache.bump_generation)
+        self.user = models.CustomUser.objects.create_user('combat@example.com', 'combat', 'password123')
+        models.Character.objects.filter(user=self.user).update(criticalHitChance=0, damage=10)
+        self.item = models.Item.objects.create(name='Drop', itemType='weapon', rarity='common')
+
+    def create_enemy(self, damage):
+        enemy = models.Enemy.objects.create(
+            name='Enemy', health=20, armor=0, magicResist=0, damage=damage, criticalHitChance=0, lvl=1, exp=30
+        )
+        models.EnemyLoot.objects.create(enemy=enemy, item=self.item, rarity=1.0)
+        return enemy
+
+    def play(self, enemy, actions):
+        """Send the actions one by one, returns every message up to the end of the fight"""
+        async def run():
+            communicator = WebsocketCommunicator(CombatSystemConsumer.as_asgi(), '/ws/combat/')
+            await communicator.connect()
+            await communicator.send_json_to({'type': 'set_enemy', 'enemyId': enemy.pk})
+            await communicator.send_json_to({'type': 'set_user', 'userEmail': 'combat@example.com'})
+            messages = []
+            for action in actions:
+                await communicator.send_json_to({'action': action})
+                messages.append(await communicator.receive_json_from())
+                if messages[-1].get('fightIsOver'):
+                    break
+            messages.append(await communicator.receive_json_from())
+            # The consumer closes the socket once it sent the result
+            self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+            return messages
+
+        return async_to_sync(run)()
+
+    def test_won_fight_awards_the_rewards(self):
+        messages = self.play(self.create_enemy(damage=1), ['user_attack', 'enemy_attack', 'user_attack'])
+        self.assertEqual(
+            [message.get('enemy', {}).get('health') for message in messages[:3]], [10, None, 0]
+        )
+        self.assertEqual(messages[1]['character']['health'], 99)
+
+        result = messages[3]
+        self.assertTrue(result['fightIsOver'])
+        self.assertEqual(result['messageShort'], 'Wygrałeś walkę!')
+        self.assertEqual((result['lvl'], result['exp'], result['expPoints']), (1, 30, 100))
+        self.assertEqual([drop['id'] for drop in result['drops']], [self.item.pk])
+        self.assertEqual(result['loot'], result['drops'][0])
+
+        self.assertEqual(models.Resources.objects.get(user=self.user).exp, 30)
+        self.assertTrue(models.UserItems.objects.filter(user=self.user, item=self.item).exists())
+        self.assertFalse(models.Fight.objects.get(user=self.user).isActive)
+
+    def test_lost_fight_awards_nothing(self):
+        messages = self.play(self.create_enemy(damage=500), ['enemy_attack'])
+        self.assertLessEqual(messages[0]['character']['health'], 0)
+
+        result = messages[1]
+        self.assertTrue(result['fightIsOver'])
+        self.assertEqual(result['messageShort'], 'Przegrałeś walkę.')
+        self.assertEqual((result['exp'], result['drops'], result['loot']), (None, [], None))
+
+        self.assertEqual(models.Resources.objects.get(user=self.user).exp, 0)
+        self.assertFalse(models.UserItems.objects.filter(user=self.user).exists())
+        self.assertFalse(models.Fight.objects.get(user=self.user).isActive)
+
+
+class NotificationConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        # Rows commit here, travel lookups must not map or write the real table file
+        use_temporary_travel_table(self)
+        self.user = models.CustomUser.objects.create_user('notify@example.com', 'notify', 'password123')
+        self.token = Token.objects.create(user=self.user)
+        region = models.Region.objects.create(name='Region', description='Region')
+        self.location = models.Location.objects.create(
+            name='Location', region=region, lvlRequired=1, description='', xCoordinate=0, yCoordinate=0
+        )
+
+    def test_invalid_token_is_rejected(self):
+        async def run():
+            communicator = WebsocketCommunicator(NotificationConsumer.as_asgi(), '/ws/notifications/?token=invalid')
+            connected, _ = await communicator.connect()
+            return connected
+
+        self.assertFalse(async_to_sync(run)())
+
+    def test_events_are_pushed(self):
+        models.UserLocation.objects.create(
+            user=self.user, location=self.location, travelTime=timezone.now() + timedelta(seconds=0.2)
+        )
+        quest = models.Quest.objects.create(title='Quest', description='')
+        models.QuestRequirement.objects.create(
+            quest=quest, type='explore', target_content_type=ContentType.objects.get_for_model(models.Location),
+            target_object_id=self.location.pk
+        )
+        user_quest = models.UserQuest.objects.create(user=self.user, quest=quest)
+
+        async def run():
+            communicator = WebsocketCommunicator(NotificationConsumer.as_asgi(), f'/ws/notifications/?token={self.token.key}')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            arrival = await communicator.receive_json_from(timeout=2)
+
+            def progress():
+                requirement = models.UserQuestRequirement.objects.get(user_quest=user_quest)
+                requirement.progress = 'completed'
+                requirement.save()
+            await database_sync_to_async(progress)()
+            quest_progress = await communicator.receive_json_from(timeout=2)
+            await communicator.disconnect()
+            return arrival, quest_progress
+
+        arrival, quest_progress = async_to_sync(run)()
+        self.assertEqual(arrival['type'], 'travelComplete')
+        self.assertEqual(arrival['location'], self.location.pk)
+        self.assertEqual(quest_progress['type'], 'questProgress')
+        self.assertEqual(quest_progress['progress'], 'completed')
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        registry.reset()
+        self.addCleanup(registry.reset)
+        self.admin = models.CustomUser.objects.create_superuser('admin@example.com', 'admin', 'password123')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.admin).key)
+
+    def test_recorder_keeps_totals(self):
+        recorder = QueryRecorder()
+        for sql, duration in (('SELECT 1', 0.01), ('SELECT 2', 0.03), ('SELECT 3', 0.02)):
+            with mock.patch('api.metrics.time.perf_counter', side_effect=[0, duration]):
+                self.assertEqual(recorder(lambda *args: sql, sql, None, False, {}), sql)
+        self.assertEqual(recorder.count, 3)
+        self.assertAlmostEqual(recorder.time, 0.06)
+        self.assertEqual(recorder.queries, [(0.01, 'SELECT 1'), (0.03, 'SELECT 2'), (0.02, 'SELECT 3')])
+
+    def test_recorder_bounds_kept_queries(self):
+        recorder = QueryRecorder()
+        with mock.patch('api.metrics.SLOW_LOG_QUERIES', 2), mock.patch('api.metrics.SLOW_LOG_SQL_LENGTH', 8):
+            for number in range(5):
+                recorder(lambda *args: None, f'SELECT {number} FROM table', None, False, {})
+        self.assertEqual(recorder.count, 5)
+        self.assertEqual([sql for _, sql in recorder.queries], ['SELECT 0', 'SELECT 1'])
+
+    def test_middleware_records_route(self):
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            for _ in range(2):
+                self.assertEqual(self.client.get('/api/me/changes/').status_code, 200)
+
+        stats = registry.snapshot()['GET api/me/changes/']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['queriesSum'], len(queries))
+        self.assertGreater(stats['durationSum'], 0)
+
+    def test_slow_requests_are_logged(self):
+        item = models.Item.objects.create(name='Sword', itemType='weapon', rarity='common')
+        with self.settings(API_SLOW_REQUEST_THRESHOLD=0), self.assertLogs('api.metrics', 'WARNING') as logs:
+            with mock.patch('api.metrics.SLOW_LOG_QUERIES', 3), Measurement('test'):
+                # N+1 pattern the log has to show query by query
+                for _ in range(4):
+                    models.Item.objects.filter(pk=item.pk).exists()
+                models.Item.objects.count()
+        lines = logs.output[0].splitlines()
+        self.assertIn('Slow test', lines[0])
+        self.assertIn('5 queries', lines[0])
+        self.assertEqual(len(lines), 5)
+        for line in lines[1:4]:
+            self.assertRegex(line, r'^\[\d+\.\d{4}s\] SELECT .* FROM "api_item" WHERE "api_item"."id" = ')
+        self.assertEqual(lines[4], '... 2 more queries')
+
+    def test_prometheus_output(self):
+        snapshot = {'GET "quoted"': {
+            'count': 2, 'durationSum': 0.5, 'queriesSum': 6, 'dbDurationSum': 0.1,
+            'duration': {'0.5': 0.2, '0.9': 0.3, '0.99': 0.3},
+            'queries': {'0.5': 3, '0.9': 3, '0.99': 3},
+            'dbDuration': {'0.5': 0.05, '0.9': 0.05, '0.99': 0.05},
+        }}
+        lines = to_prometheus(snapshot).splitlines()
+        self.assertEqual(lines[:6], [
+            '# TYPE api_request_duration_seconds summary',
+            'api_request_duration_seconds{route="GET \\"quoted\\"",quantile="0.5"} 0.2',
+            'api_request_duration_seconds{route="GET \\"quoted\\"",quantile="0.9"} 0.3',
+            'api_request_duration_seconds{route="GET \\"quoted\\"",quantile="0.99"} 0.3',
+            'api_request_duration_seconds_sum{route="GET \\"quoted\\""} 0.5',
+            'api_request_duration_seconds_count{route="GET \\"quoted\\""} 2',
+        ])
+        self.assertIn('api_request_db_queries_sum{route="GET \\"quoted\\""} 6', lines)
+        self.assertEqual(len(lines), 18)
+
+    def test_metrics_view(self):
+        self.client.get('/api/me/changes/')
+        response = self.client.get('/api/metrics/', {'format': 'prometheus'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('api_request_db_queries_count{route="GET api/me/changes/"} 1', response.content.decode())
+
+        user = models.CustomUser.objects.create_user('player@example.com', 'player', 'password123')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+
+
+class FastJSONTests(SimpleTestCase):
+    payload = {
+        'criticalHitChance': Decimal('0.15'),
+        'criticalHitDamage': Decimal('1.50'),
+        'travelEndDatetime': datetime(2024, 5, 1, 12, 30, 15, 250000, tzinfo=dt_timezone.utc),
+        'startTravelTime': datetime(2024, 5, 1, 12, 30, tzinfo=dt_timezone.utc),
+        'date': date(2024, 5, 1),
+        'travelTimes': {1: 30, 2: None},
+        'name': 'Przełęcz Mroźnego Wiatru',
+        'duration': timedelta(seconds=90),
+        'items': [{'id': 1, 'quantity': 2}],
+    }
+
+    def assert_matches_drf(self):
+        self.assertEqual(FastJSONRenderer().render(self.payload), JSONRenderer().render(self.payload))
+
+    def test_output_matches_drf(self):
+        self.assert_matches_drf()
+
+    def test_stdlib_fallback_matches_drf(self):
+        with mock.patch('api.renderers.orjson', None):
+            self.assert_matches_drf()
+
+    def test_parser(self):
+        body = '{"items": [1, 2], "name": "Mroźny", "price": 1.5}'.encode()
+        self.assertEqual(FastJSONParser().parse(io.BytesIO(body)), {'items': [1, 2], 'name': 'Mroźny', 'price': 1.5})
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(io.BytesIO(b'{"items": '))
+
+
+class CombatSimulationTests(SimpleTestCase):
+
+    def make_combatants(self):
+        # perform_attack hashes its combatants, they need a pk
+        character = models.Character(
+            pk=1, health=100, armor=2, damage=12, criticalHitChance=Decimal('0.30'), criticalHitDamage=Decimal('1.50')
+        )
+        enemy = models.Enemy(
+            pk=1, health=60, armor=3, magicResist=0, damage=14, lvl=1,
+            criticalHitChance=Decimal('0.20'), criticalHitDamage=Decimal('2.00')
+        )
+        return character, enemy
+
+    def scalar_fight(self):
+        """One fight played with Fight.perform_attack in CombatSystemConsumer's turn order, returns (won, rounds)"""
+        character, enemy = self.make_combatants()
+        fight = Fight()
+        rounds = 0
+        while True:
+            rounds += 1
+            fight.perform_attack(character, enemy)
+            if enemy.health <= 0:
+                return True, rounds
+            fight.perform_attack(enemy, character)
+            if character.health <= 0:
+                return False, rounds
+
+    def test_strikes_match_perform_attack(self):
+        character, enemy = self.make_combatants()
+        rolls = [0.0, 0.1, 0.29, 0.3, 0.31, 0.7, 1.0]
+        scalar = []
+        for roll in rolls:
+            with mock.patch('api.fight.random.uniform', return_value=roll):
+                fight = Fight()
+                fight.perform_attack(character, enemy)
+                scalar.append((fight.last_strike_critical, fight.damage_dealt))
+
+        stats = stat_arrays([character])
+        critical = is_critical_hit(stats['criticalHitChance'], np.array(rolls))
+        damage = strike_damage(stats['damage'], stats['criticalHitDamage'], critical, 3, np.maximum)
+        self.assertEqual([(bool(hit), int(value)) for hit, value in zip(critical, damage)], scalar)
+
+    def test_results_match_the_scalar_fight(self):
+        random.seed(11)
+        fights = 4000
+        scalar = [self.scalar_fight() for _ in range(fights)]
+        scalar_win_rate = sum(won for won, _ in scalar) / fights
+        scalar_kill_rounds = Counter(rounds for won, rounds in scalar if won)
+
+        character, enemy = self.make_combatants()
+        results = simulate_fights(
+            stat_arrays([character]), stat_arrays([enemy]), 20_000, rng=np.random.default_rng(11)
+        )
+        win_rate = results['wins'][0] / 20_000
+        self.assertEqual(results['draws'][0], 0)
+
+        # Four standard errors of the difference between the two estimates
+        tolerance = 4 * math.sqrt(scalar_win_rate * (1 - scalar_win_rate) * (1 / fights + 1 / 20_000))
+        self.assertAlmostEqual(win_rate, scalar_win_rate, delta=tolerance)
+        scalar_mean = sum(rounds * count for rounds, count in scalar_kill_rounds.items()) / sum(scalar_kill_rounds.values())
+        self.assertAlmostEqual(results['kill_rounds'][0] / results['wins'][0], scalar_mean, delta=0.1)
+
+
+class LootTableTests(SimpleTestCase):
+    kills = 2_000_000
+
+    def make_table(self, *rarities):
+        return LootTable([
+            models.EnemyLoot(rarity=rarity, item=models.Item(pk=pk, name=f'Item {pk}', rarity='common'))
+            for pk, rarity in enumerate(rarities, start=1)
+        ])
+
+    def assertFrequencies(self, counts, expected, trials):
+        for outcome, probability in expected.items():
+            observed = counts[outcome]
+            # Five standard deviations keep the test stable while catching a wrong table
+            margin = 5 * math.sqrt(trials * probability * (1 - probability))
+            self.assertLessEqual(abs(observed - trials * probability), margin, f'outcome {outcome}')
+        self.assertEqual(set(counts) - set(expected), set())
+
+    def test_drop_frequencies_match_rarities(self):
+        table = self.make_table(0.5, 0.25, 0.1, 0.0001)
+        rng = random.Random(19)
+        counts = Counter()
+        for _ in range(self.kills):
+            drop = table.roll(rng)
+            counts[drop and drop['id']] += 1
+        self.assertFrequencies(counts, {1: 0.5, 2: 0.25, 3: 0.1, 4: 0.0001, None: 0.1499}, self.kills)
+
+    def test_chances_past_one_are_cut_off(self):
+        table = self.make_table(0.7, 0.6, 0.2)
+        rng = random.Random(19)
+        counts = Counter(table.roll(rng)['id'] for _ in range(self.kills))
+        self.assertFrequencies(counts, {1: 0.7, 2: 0.3}, self.kills)
+
+    def test_multi_roll_drops(self):
+        table = self.make_table(0.3, 0.05)
+        rng = random.Random(19)
+        rolls = 4
+        counts = Counter()
+        for _ in range(self.kills // rolls):
+            counts.update(drop['id'] for drop in table.roll_many(rolls, rng))
+        self.assertFrequencies(counts, {1: 0.3, 2: 0.05}, self.kills // rolls * rolls)
+
+    def test_empty_table_drops_nothing(self):
+        table = self.make_table()
+        self.assertEqual(table.roll_many(100), [])
+
+
+class LootTableCacheTests(TestCase):
+
+    def setUp(self):
+        # Rows rolled back with the test would otherwise stay cached for the next one
+        self.addCleanup(enemy_loot_cache.bump_generation)
+
+    def test_table_is_rebuilt_when_loot_changes(self):
+        enemy = models.Enemy.objects.create(name='Enemy', health=10, armor=0, magicResist=0, damage=1, lvl=1)
+        item = models.Item.objects.create(name='Item', itemType='weapon', rarity='common')
+        with self.captureOnCommitCallbacks(execute=True):
+            models.EnemyLoot.objects.create(enemy=enemy, item=item, rarity=0.5)
+
+        table = get_loot_table(enemy.pk)
+        self.assertIs(get_loot_table(enemy.pk), table)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            models.EnemyLoot.objects.filter(enemy=enemy).update(rarity=1.0)
+            models.EnemyLoot.objects.get(enemy=enemy).save()
+        table = get_loot_table(enemy.pk)
+        self.assertEqual(table.roll_many(100), [table.outcomes[0]] * 100)
+
+
+class ExpCurveTests(TestCase):
+
+    def setUp(self):
+        # Rows rolled back with the test would otherwise stay in the cached curve
+        self.addCleanup(user_lvl_cache.bump_generation)
+        self.lvls = {lvl: models.UserLvl.objects.create(lvl=lvl, expPoints=100 * lvl) for lvl in (1, 2, 3)}
+        user_lvl_cache.bump_generation()
+        self.user = models.CustomUser.objects.create_user('exp@example.com', 'exp', 'password123')
+        self.resources = models.Resources.objects.get(user=self.user)
+        self.resources.exp = 50
+        self.resources.save()
+
+    def assertStored(self, lvl, exp):
+        resources = models.Resources.objects.get(pk=self.resources.pk)
+        self.assertEqual((resources.lvl_id, resources.exp), (self.lvls[lvl].pk, exp))
+        self.assertEqual(resources.version, models.StateVersion.get_version(self.user.pk))
+
+    def test_curve_thresholds(self):
+        curve = ExpCurve(models.UserLvl(pk=10 * lvl, lvl=lvl, expPoints=100 * lvl) for lvl in (3, 1, 2))
+        self.assertEqual((curve.lvls, curve.thresholds, curve.pks), ([1, 2, 3], [0, 100, 300], [10, 20, 30]))
+        self.assertEqual(curve.add_exp(10, 0, 99), (0, 99))
+        self.assertEqual(curve.add_exp(10, 0, 100), (1, 0))
+        self.assertEqual(curve.add_exp(20, 150, 60), (2, 10))
+
+    def test_exp_within_a_level(self):
+        self.assertEqual(self.resources.add_exp(20), (1, 70, 100))
+        self.assertStored(1, 70)
+
+    def test_grant_crossing_several_levels(self):
+        # 50 + 400 exp: 100 for lvl 1, 200 for lvl 2, 150 into lvl 3
+        self.assertEqual(self.resources.add_exp(400), (3, 150, 300))
+        self.assertStored(3, 150)
+        self.assertEqual((self.resources.lvl_id, self.resources.exp), (self.lvls[3].pk, 150))
+
+    def test_last_level_keeps_the_exp(self):
+        self.assertEqual(self.resources.add_exp(10_000), (3, 9_750, 300))
+        self.assertStored(3, 9_750)
+        self.assertEqual(self.resources.add_exp(100), (3, 9_850, 300))
+
+    def test_curve_follows_level_changes(self):
+        curve = get_exp_curve()
+        self.assertIs(get_exp_curve(), curve)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lvls[4] = models.UserLvl.objects.create(lvl=4, expPoints=400)
+            self.lvls[2].expPoints = 50
+            self.lvls[2].save()
+        self.assertIsNot(get_exp_curve(), curve)
+        # 50 + 400 exp: 100 for lvl 1, 50 for lvl 2, 300 for lvl 3, nothing into lvl 4
+        self.assertEqual(self.resources.add_exp(400), (4, 0, 400))
+        self.assertStored(4, 0)
+
+
+class ModelCacheTests(TestCase):
+
+    def setUp(self):
+        # Local stand-in for the shared tier, dropped with the test's rows
+        self.shared = LocalCache(timeout=None)
+        item_cache.shared = self.shared
+        item_cache.local.clear()
+        self.addCleanup(item_cache.local.clear)
+        self.addCleanup(setattr, item_cache, 'shared', None)
+        self.item = models.Item.objects.create(name='Sword', itemType='weapon', rarity='common')
+
+    def test_hits_skip_the_database(self):
+        self.assertEqual(item_cache.get(self.item.pk).name, 'Sword')
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(item_cache.get(self.item.pk).name, 'Sword')
+            self.assertEqual(item_cache.filter(rarity='common'), item_cache.filter(rarity='common'))
+        self.assertEqual(len(context.captured_queries), 1)
+
+        # Another process finds the row in the shared tier
+        item_cache.local.clear()
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(item_cache.get(self.item.pk).name, 'Sword')
+        self.assertEqual(len(context.captured_queries), 0)
+
+    def test_generation_is_read_locally(self):
+        item_cache.get(self.item.pk)
+        with mock.patch.object(self.shared, 'get_or_set', wraps=self.shared.get_or_set) as get_or_set:
+            for _ in range(3):
+                item_cache.get(self.item.pk)
+        get_or_set.assert_not_called()
+
+    def test_invalidated_on_commit(self):
+        item_cache.get(self.item.pk)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.item.name = 'Long sword'
+            self.item.save()
+        # Other workers must not cache the old row under a new generation before the commit
+        self.assertEqual(item_cache.get(self.item.pk).name, 'Sword')
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(item_cache.get(self.item.pk).name, 'Long sword')
+
+    def test_bump_of_another_process_is_seen_after_timeout(self):
+        with mock.patch('api.caching.GENERATION_TIMEOUT', 0):
+            item_cache.get(self.item.pk)
+            models.Item.objects.filter(pk=self.item.pk).update(name='Long sword')
+            incr_version(self.shared, 'api:api.item:generation')
+            self.assertEqual(item_cache.get(self.item.pk).name, 'Long sword')
+
+
+class CachedTokenAuthenticationTests(TestCase):
+
+    def setUp(self):
+        self.user = models.CustomUser.objects.create_user('auth@example.com', 'auth', 'password123')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def test_token_is_authenticated_without_queries(self):
+        self.assertEqual(self.client.get('/api/enemies/').status_code, 200)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.get('/api/enemies/').status_code, 200)
+        self.assertEqual(len(context.captured_queries), 0)
+
+    def test_shared_cache_holds_no_credentials(self):
+        self.assertEqual(self.client.get('/api/enemies/').status_code, 200)
+        entry = pickle.dumps(caches[settings.API_CACHE_ALIAS].get(token_cache_key(self.token.key)))
+        self.assertNotIn(self.token.key.encode(), entry)
+        self.assertNotIn(self.user.password.encode(), entry)
+
+    def test_shared_cache_hit_loads_the_user(self):
+        CachedTokenAuthentication().authenticate_credentials(self.token.key)
+        local_cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            user, token = CachedTokenAuthentication().authenticate_credentials(self.token.key)
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertEqual((user, token.key), (self.user, self.token.key))
+
+    def test_deleted_token_is_rejected(self):
+        self.assertEqual(self.client.get('/api/enemies/').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+        self.assertEqual(self.client.get('/api/enemies/').status_code, 401)
+
+    def test_deactivated_user_is_rejected(self):
+        self.assertEqual(self.client.get('/api/enemies/').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.client.get('/api/enemies/').status_code, 401)
+
+
+class EquipmentTests(TestCase):
+
+    def setUp(self):
+        self.user = models.CustomUser.objects.create_user('equip@example.com', 'equip', 'password123')
+        self.character = models.Character.objects.get(user=self.user)
+        self.weapon = models.Item.objects.create(name='Sword', itemType='weapon', rarity='common', damage=5)
+        self.helmet = models.Item.objects.create(name='Helmet', itemType='helmet', rarity='common', armor=3)
+        self.heavy_weapon = models.Item.objects.create(name='Axe', itemType='weapon', rarity='rare', damage=9, lvlRequired=10)
+        self.unowned_helmet = models.Item.objects.create(name='Crown', itemType='helmet', rarity='rare', armor=7)
+        models.UserItems.add_items(self.user.pk, {self.weapon.pk: 1, self.helmet.pk: 1, self.heavy_weapon.pk: 1})
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+
+    def equipment(self):
+        return dict(models.CharacterItem.objects.filter(character=self.character).values_list('slot', 'item'))
+
+    def stats(self):
+        return models.CharacterStats.objects.get(character=self.character).as_dict()
+
+    def test_equip_many_updates_slots_and_stats(self):
+        models.CharacterItem.equip_many(self.character.pk, {'weapon': self.weapon.pk, 'helmet': self.helmet.pk}, 1)
+        self.assertEqual(self.equipment()['weapon'], self.weapon.pk)
+        self.assertEqual(self.equipment()['helmet'], self.helmet.pk)
+        self.assertEqual((self.stats()['damage'], self.stats()['armor']), (5, 3))
+
+        models.CharacterItem.equip_many(self.character.pk, {'weapon': None}, 1)
+        self.assertIsNone(self.equipment()['weapon'])
+        self.assertEqual(self.stats(), models.CharacterStats.rebuild(self.character.pk).as_dict())
+        self.assertEqual((self.stats()['damage'], self.stats()['armor']), (0, 3))
+
+    def test_equip_many_rejects_invalid_loadouts(self):
+        before = self.equipment()
+        loadouts = [
+            {'shield': self.weapon.pk},
+            {'helmet': self.weapon.pk},
+            {'helmet': self.unowned_helmet.pk},
+            {'weapon': self.heavy_weapon.pk},
+            {'weapon': 0},
+        ]
+        for loadout in loadouts:
+            with self.subTest(loadout=loadout), self.assertRaises(ValidationError):
+                models.CharacterItem.equip_many(self.character.pk, {'helmet': self.helmet.pk, **loadout}, 1)
+        self.assertEqual(self.equipment(), before)
+        self.assertEqual(self.stats()['armor'], 0)
+
+    def test_replace_many(self):
+        response = self.client.patch(
+            '/api/equipment/replace_many/', {'items': {'weapon': self.weapon.pk, 'helmet': self.helmet.pk}}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({row['slot'] for row in response.data}, {'weapon', 'helmet'})
+        self.assertEqual(self.stats()['damage'], 5)
+
+        response = self.client.patch('/api/equipment/replace_many/', {'items': {'weapon': self.heavy_weapon.pk}}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.patch('/api/equipment/replace_many/', {'items': ['weapon']}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.equipment()['weapon'], self.weapon.pk)
+
+    def test_validate_errors(self):
+        slot = models.CharacterItem.objects.get(character=self.character, slot='helmet')
+        for item in (self.weapon, self.unowned_helmet):
+            with self.subTest(item=item.name), self.assertRaises(ValidationError):
+                slot.equip(item)
+        self.assertIsNone(models.CharacterItem.objects.get(pk=slot.pk).item)
+
+        response = self.client.patch('/api/equipment/weapon/replace_item/', {'item': self.heavy_weapon.pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stats()['damage'], 0)
+
+
+class UserItemsStackTests(TestCase):
+
+    def setUp(self):
+        self.user = models.CustomUser.objects.create_user('stack@example.com', 'stack', 'password123')
+        self.potion = models.Item.objects.create(name='Potion', itemType=None, rarity='common', stackable=True)
+        self.sword = models.Item.objects.create(name='Sword', itemType='weapon', rarity='common')
+
+    def rows(self):
+        return list(models.UserItems.objects.filter(user=self.user).order_by('pk').values_list('item', 'quantity', 'stacked'))
+
+    def test_stack_fields_are_read_only(self):
+        models.UserItems.add_items(self.user.pk, {self.potion.pk: 2})
+        row = models.UserItems.objects.get(user=self.user)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+        response = client.patch(
+            f'/api/useritems/{row.pk}/', {'quantity': 9999, 'stacked': False, 'version': 0}, format='multipart'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['quantity'], 2)
+        row.refresh_from_db()
+        self.assertEqual((row.quantity, row.stacked), (2, True))
+        self.assertEqual(row.version, models.StateVersion.get_version(self.user.pk))
+
+    def test_items_do_not_stack_by_default(self):
+        self.assertFalse(models.Item.objects.create(name='Helmet', itemType='helmet', rarity='common').stackable)
+
+    def test_stackable_items_share_a_row(self):
+        models.UserItems.add_items(self.user.pk, {self.potion.pk: 2, self.sword.pk: 2})
+        models.UserItems.add_items(self.user.pk, {self.potion.pk: 3})
+        self.assertEqual(self.rows(), [
+            (self.potion.pk, 5, True), (self.sword.pk, 1, False), (self.sword.pk, 1, False)
+        ])
+
+    def test_unknown_item_is_rejected(self):
+        with self.assertRaises(ValidationError):
+            models.UserItems.add_items(self.user.pk, {self.potion.pk: 1, 0: 1})
+        self.assertEqual(self.rows(), [])
+
+    def test_rows_reaching_zero_are_deleted(self):
+        models.UserItems.add_items(self.user.pk, {self.potion.pk: 3, self.sword.pk: 1})
+        stack, sword = models.UserItems.objects.filter(user=self.user).order_by('pk')
+        self.assertTrue(models.UserItems.remove_items(self.user.pk, {stack.pk: 2, sword.pk: 1}))
+        self.assertEqual(self.rows(), [(self.potion.pk, 1, True)])
+        self.assertTrue(models.UserItems.remove_items(self.user.pk, {stack.pk: 1}))
+        self.assertEqual(self.rows(), [])
+
+    def test_removing_more_than_held_fails(self):
+        models.UserItems.add_items(self.user.pk, {self.potion.pk: 2})
+        stack = models.UserItems.objects.get(user=self.user)
+        other = models.CustomUser.objects.create_user('other@example.com', 'other', 'password123')
+        for user_id, counts in ((self.user.pk, {stack.pk: 3}), (self.user.pk, {stack.pk: 1, 0: 1}), (other.pk, {stack.pk: 1})):
+            with self.subTest(counts=counts), transaction.atomic():
+                self.assertFalse(models.UserItems.remove_items(user_id, counts))
+                transaction.set_rollback(True)
+        self.assertEqual(self.rows(), [(self.potion.pk, 2, True)])
+
+    def test_stack_migration_round_trip(self):
+        migration = importlib.import_module('api.migrations.0025_item_stackable_useritems_quantity_useritems_stacked_and_more')
+        models.Item.objects.update(stackable=False)
+        migration.mark_stackable_items(django_apps, None)
+        self.assertEqual(
+            dict(models.Item.objects.values_list('pk', 'stackable')), {self.potion.pk: True, self.sword.pk: False}
+        )
+
+        models.UserItems.objects.bulk_create(
+            [models.UserItems(user=self.user, item=self.potion) for _ in range(3)]
+            + [models.UserItems(user=self.user, item=self.sword) for _ in range(2)]
+        )
+
+        migration.compact_user_items(django_apps, None)
+        self.assertEqual(self.rows(), [
+            (self.potion.pk, 3, True), (self.sword.pk, 1, False), (self.sword.pk, 1, False)
+        ])
+
+        migration.expand_user_items(django_apps, None)
+        self.assertEqual(
+            Counter(models.UserItems.objects.filter(user=self.user).values_list('item', flat=True)),
+            {self.potion.pk: 3, self.sword.pk: 2}
+        )
+
+
+class TransactionTests(TestCase):
+
+    def setUp(self):
+        self.user = models.CustomUser.objects.create_user('trade@example.com', 'trade', 'password123')
+        region = models.Region.objects.create(name='Region', description='Region')
+        location = models.Location.objects.create(
+            name='Market', region=region, lvlRequired=1, description='', xCoordinate=0, yCoordinate=0
+        )
+        npc = models.NPC.objects.create(name='Trader', location=location, imageUrl='npc.png')
+        self.store = models.Store.objects.create(location=location, name='Store', type='weapon', npc=npc)
+        self.sword = models.Item.objects.create(name='Sword', itemType='weapon', rarity='common', damage=5, goldValue=20)
+        self.helmet = models.Item.objects.create(name='Helmet', itemType='helmet', rarity='common', armor=3)
+        self.cheap_helmet = models.StoreItem.objects.create(store=self.store, item=self.helmet, price=30)
+        self.crown = models.StoreItem.objects.create(
+            store=self.store, item=models.Item.objects.create(name='Crown', itemType='helmet', rarity='rare'), price=500
+        )
+        models.UserItems.add_items(self.user.pk, {self.sword.pk: 1})
+        self.sword_row = models.UserItems.objects.get(user=self.user)
+        models.CharacterItem.objects.get(character__user=self.user, slot='weapon').equip(self.sword)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+
+    def state(self):
+        return (
+            models.Resources.objects.get(user=self.user).gold,
+            sorted(models.UserItems.objects.filter(user=self.user).values_list('item', 'quantity')),
+            dict(models.CharacterItem.objects.filter(character__user=self.user).values_list('slot', 'item')),
+            models.CharacterStats.objects.get(character__user=self.user).as_dict(),
+        )
+
+    def trade(self, sell=(), buy=()):
+        data = {'user': self.user.pk, 'store': self.store.pk, 'sellItems': list(sell), 'buyItems': list(buy)}
+        return self.client.post('/api/transaction/', data, format='json')
+
+    def test_buy(self):
+        response = self.trade(buy=[self.cheap_helmet.pk, self.cheap_helmet.pk])
+        self.assertEqual(response.status_code, 201)
+        gold, items, equipment, stats = self.state()
+        self.assertEqual(gold, 40)
+        # Equipment doesn't stack, every bought copy is its own row
+        self.assertEqual(items, [(self.sword.pk, 1), (self.helmet.pk, 1), (self.helmet.pk, 1)])
+        self.assertEqual(stats['damage'], 5)
+        self.assertEqual(models.Transaction.objects.get().totalAmount, -60)
+
+    def test_sell_equipped_item(self):
+        response = self.trade(sell=[self.sword_row.pk])
+        self.assertEqual(response.status_code, 201)
+        gold, items, equipment, stats = self.state()
+        self.assertEqual((gold, items), (120, []))
+        self.assertIsNone(equipment['weapon'])
+        self.assertEqual(stats['damage'], 0)
+
+    def test_insufficient_gold(self):
+        before = self.state()
+        response = self.trade(sell=[self.sword_row.pk], buy=[self.crown.pk])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.state(), before)
+        self.assertFalse(models.Transaction.objects.exists())
+
+    def test_selling_items_the_player_does_not_own(self):
+        other = models.CustomUser.objects.create_user('other@example.com', 'other', 'password123')
+        models.UserItems.add_items(other.pk, {self.sword.pk: 1})
+        other_row = models.UserItems.objects.get(user=other)
+        before = self.state()
+        for sell in ([other_row.pk], [self.sword_row.pk, self.sword_row.pk]):
+            with self.subTest(sell=sell):
+                self.assertEqual(self.trade(sell=sell, buy=[self.cheap_helmet.pk]).status_code, 400)
+                self.assertEqual(self.state(), before)
+
+    def test_changes_after_validation_roll_back(self):
+        before = self.state()
+        request = mock.Mock(user=self.user)
+        data = {'user': self.user.pk, 'store': self.store.pk, 'sellItems': [self.sword_row.pk], 'buyItems': [self.cheap_helmet.pk]}
+
+        # The sold item is taken out of the inventory between validation and saving
+        serializer = serializers.TransactionSerializer(data=data, context={'request': request})
+        self.assertTrue(serializer.is_valid())
+        models.UserItems.objects.filter(pk=self.sword_row.pk).update(quantity=0)
+        with self.assertRaises(ValidationError):
+            serializer.save()
+        models.UserItems.objects.filter(pk=self.sword_row.pk).update(quantity=1)
+        self.assertEqual(self.state(), before)
+
+        # The gold is spent between validation and saving
+        serializer = serializers.TransactionSerializer(data=dict(data, sellItems=[]), context={'request': request})
+        self.assertTrue(serializer.is_valid())
+        models.Resources.objects.filter(user=self.user).update(gold=10)
+        with self.assertRaises(ValidationError):
+            serializer.save()
+        self.assertEqual(self.state(), (10, *before[1:]))
+        self.assertFalse(models.Transaction.objects.exists())
+
+
+class CharacterStatsTests(TestCase):
+
+    def setUp(self):
+        self.user = models.CustomUser.objects.create_user('stats@example.com', 'stats', 'password123')
+        self.character = models.Character.objects.get(user=self.user)
+        self.sword = models.Item.objects.create(
+            name='Sword', itemType='weapon', rarity='common', damage=5, criticalHitChance=Decimal('0.10')
+        )
+        self.helmet = models.Item.objects.create(name='Helmet', itemType='helmet', rarity='common', armor=3, health=10)
+        models.UserItems.add_items(self.user.pk, {self.sword.pk: 1, self.helmet.pk: 1})
+
+    def slot(self, slot):
+        return models.CharacterItem.objects.get(character=self.character, slot=slot)
+
+    def assertStatsRebuilt(self, **expected):
+        stats = models.CharacterStats.objects.get(character=self.character).as_dict()
+        self.assertEqual(stats, models.CharacterStats.rebuild(self.character.pk).as_dict())
+        for field, value in expected.items():
+            self.assertEqual(stats[field], value)
+
+    def test_equip_and_unequip(self):
+        self.slot('weapon').equip(self.sword)
+        self.slot('helmet').equip(self.helmet)
+        self.assertStatsRebuilt(damage=5, armor=3, health=10, criticalHitChance=Decimal('0.10'))
+
+        self.slot('weapon').equip(None)
+        self.assertStatsRebuilt(damage=0, armor=3, health=10, criticalHitChance=0)
+
+    def test_admin_edit_of_an_equipped_item(self):
+        self.slot('weapon').equip(self.sword)
+        self.sword.damage = 12
+        self.sword.save()
+        self.assertStatsRebuilt(damage=12)
+
+    def test_deleting_an_equipped_item(self):
+        self.slot('weapon').equip(self.sword)
+        self.slot('helmet').equip(self.helmet)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sword.delete()
+        self.assertStatsRebuilt(damage=0, armor=3, criticalHitChance=0)
+
+    def test_missing_stats_row_is_rebuilt(self):
+        models.CharacterStats.objects.filter(character=self.character).delete()
+        self.slot('helmet').equip(self.helmet)
+        self.assertStatsRebuilt(armor=3, health=10)
+
+
+class ProvisioningTests(TestCase):
+
+    def setUp(self):
+        region = models.Region.objects.create(name='Region', description='Region')
+        self.location = models.Location.objects.create(
+            name='Przełęcz Mroźnego Wiatru', region=region, lvlRequired=1, description='', xCoordinate=0, yCoordinate=0
+        )
+        location_type = ContentType.objects.get_for_model(models.Location)
+        self.quests = [models.Quest.objects.create(title=f'Quest {number}', description='') for number in range(3)]
+        for quest in self.quests:
+            for position in (1, 2):
+                models.QuestRequirement.objects.create(
+                    quest=quest, type='explore', target_content_type=location_type,
+                    target_object_id=self.location.pk, position=position
+                )
+
+    def assertProvisioned(self, user):
+        self.assertTrue(models.Resources.objects.filter(user=user, lvl__lvl=1).exists())
+        self.assertTrue(models.StateVersion.objects.filter(user=user).exists())
+        self.assertEqual(models.UserLocation.objects.get(user=user).location, self.location)
+        self.assertTrue(models.StoryState.objects.filter(user=user, key='initial_story').exists())
+        character = models.Character.objects.get(user=user)
+        self.assertTrue(models.CharacterStats.objects.filter(character=character).exists())
+        self.assertCountEqual(
+            models.CharacterItem.objects.filter(character=character).values_list('slot', flat=True), models.CHARACTER_SLOTS
+        )
+
+        # One UserQuest per quest, the old receivers created copies of the first quest instead
+        user_quests = models.UserQuest.objects.filter(user=user)
+        self.assertCountEqual(user_quests.values_list('quest', flat=True), [quest.pk for quest in self.quests])
+        self.assertCountEqual(
+            models.UserQuestRequirement.objects.filter(user_quest__user=user).values_list('requirement__position', 'progress'),
+            [(1, 'in_progress'), (2, 'not_started')] * len(self.quests)
+        )
+
+    def test_signup_provisions_player(self):
+        user = models.CustomUser.objects.create_user('new@example.com', 'new', 'password123')
+        self.assertProvisioned(user)
+
+    def test_provision_players(self):
+        users = models.CustomUser.objects.bulk_create([
+            models.CustomUser(email=f'bulk{number}@example.com', name=f'bulk{number}') for number in range(3)
+        ])
+        self.assertEqual(provision_players(users), users)
+        for user in users:
+            self.assertProvisioned(user)
+
+    def test_queries_do_not_grow_with_players(self):
+        starter = StarterState()
+
+        def count_queries(count, offset):
+            accounts = [(f'player{number}@example.com', f'player{number}', 'password123') for number in range(offset, offset + count)]
+            with CaptureQueriesContext(connection) as context:
+                create_players(accounts, starter, {'password123': 'hash'})
+            return len(context.captured_queries)
+
+        self.assertEqual(count_queries(1, 0), count_queries(5, 1))
+
+    def test_create_players_hashes_each_password_once(self):
+        users = create_players([('a@example.com', 'a', 'secret123'), ('b@example.com', 'b', 'secret123')])
+        self.assertEqual(users[0].password, users[1].password)
+        self.assertTrue(users[0].check_password('secret123'))
+        for user in users:
+            self.assertProvisioned(user)
+
+    def test_missing_default_location(self):
+        self.location.name = 'Elsewhere'
+        self.location.save()
+        with self.assertLogs('api.provisioning', 'WARNING'):
+            user = models.CustomUser.objects.create_user('lost@example.com', 'lost', 'password123')
+        self.assertFalse(models.UserLocation.objects.filter(user=user).exists())
+        self.assertTrue(models.Character.objects.filter(user=user).exists())
+
+
+class ContentSnapshotTests(TestCase):
+
+    def setUp(self):
+        self.user = models.CustomUser.objects.create_user('content@example.com', 'content', 'password123')
+        self.item = models.Item.objects.create(name='Sword', itemType='weapon', rarity='common', imageUrl='items/sword.png')
+        # The bump of the item's save only runs on commit
+        bump_content_version()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+
+    def get_content(self, **headers):
+        return self.client.get('/api/content/', **headers)
+
+    def test_requires_authentication(self):
+        self.assertEqual(APIClient().get('/api/content/').status_code, 401)
+
+    def test_etag_revalidation(self):
+        response = self.get_content()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.get_content(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len(context.captured_queries), 0)
+
+    def test_content_change_bumps_version(self):
+        response = self.get_content()
+        etag, version = response['ETag'], json.loads(response.content)['version']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.name = 'Long sword'
+            self.item.save()
+        response = self.get_content(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        data = json.loads(response.content)
+        self.assertGreater(data['version'], version)
+        self.assertEqual(data['items'][0]['name'], 'Long sword')
+
+    def test_image_urls_are_absolute(self):
+        data = json.loads(self.get_content().content)
+        self.assertEqual(data['items'][0]['imageUrl'], 'http://testserver/media/items/sword.png')
+
+    def test_gzip_negotiation(self):
+        response = self.get_content(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content))['items'][0]['name'], 'Sword')
+
+        response = self.get_content(HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(json.loads(response.content)['items'][0]['name'], 'Sword')
+
+    def test_accepts_gzip(self):
+        cases = {
+            '': False, 'gzip': True, 'GZIP;q=0.5': True, 'gzip;q=0': False, 'gzip; q=0.0, *': False,
+            'br, *': True, '*;q=0': False, 'x-gzip': True, 'deflate, br': False, 'gzip;q=x': False,
+        }
+        for header, expected in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(accepts_gzip(header), expected)
@@ -0,0 +1,208 @@
+import hashlib
+import mmap
+import os
+import struct
+import time
+from array import array
+from collections import deque
+
+from django.conf import settings
+
+from api.utils import TIME_PER_LOCATION, a_star
+from api.world import get_world_graph
+
+
+MAGIC = b'RPGTRVL1'
+HEADER = struct.Struct('<8sI20s')
+NO_PATH = -1
+TRAVEL_TIMES_CACHE_SIZE = 128
+TRAVEL_TABLE_RETRY_INTERVAL = 30
+
+
+def get_signature(coordinates):
+    digest = hashlib.sha1()
+    digest.update(f'{TIME_PER_LOCATION};'.encode())
+    for x, y in coordinates:
+        digest.update(f'{x},{y};'.encode())
+    return digest.digest()
+
+
+class TravelTable:
+    """All-pairs next-hop and travel-time matrices over the world graph.
+
+    Both matrices are flat int32 sequences indexed by ``source * size + target``
+    and can be backed either by in-memory arrays or by a memory-mapped file.
+    """
+
+    def __init__(self, graph, next_hop, travel_time):
+        self.coordinates = sorted(graph.locations)
+        self.location_ids = [graph.locations[coordinate]['id'] for coordinate in self.coordinates]
+        self.index = {coordinate: i for i, coordinate in enumerate(self.coordinates)}
+        self.size = len(self.coordinates)
+        self.next_hop = next_hop
+        self.travel_time = travel_time
+        # source coordinates -> {location id: travel time or None}
+        self.travel_times = {}
+
+    @classmethod
+    def build(cls, graph):
+        coordinates = sorted(graph.locations)
+        size = len(coordinates)
+        index = {coordinate: i for i, coordinate in enumerate(coordinates)}
+        neighbors = [[index[n] for n in graph.adjacency[coordinate]] for coordinate in coordinates]
+
+        next_hop = array('i', [NO_PATH]) * (size * size)
+        travel_time = array('i', [NO_PATH]) * (size * size)
+
+        # Map is undirected, so a BFS rooted at the target gives every source
+        # its first step towards that target.
+        for target in range(size):
+            travel_time[target * size + target] = 0
+            next_hop[target * size + target] = target
+            queue = deque([target])
+            while queue:
+                current = queue.popleft()
+                current_time = travel_time[current * size + target]
+                for neighbor in neighbors[current]:
+                    cell = neighbor * size + target
+                    if travel_time[cell] == NO_PATH:
+                        travel_time[cell] = current_time + TIME_PER_LOCATION
+                        next_hop[cell] = current
+                        queue.append(neighbor)
+
+        return cls(graph, next_hop, travel_time)
+
+    def save(self, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.size, get_signature(self.coordinates)))
+            array('i', [c for coordinate in self.coordinates for c in coordinate]).tofile(f)
+            array('i', self.next_hop).tofile(f)
+            array('i', self.travel_time).tofile(f)
+        # Replace is atomic, so workers mapping the file never see a partial one
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, graph):
+        """Map a table file, returns None if it is missing or was built for another map"""
+        coordinates = sorted(graph.locations)
+        try:
+            with open(path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            magic, size, signature = HEADER.unpack_from(buffer)
+        except struct.error:
+            buffer.close()
+            return None
+        if magic != MAGIC or size != len(coordinates) or signature != get_signature(coordinates):
+            buffer.close()
+            return None
+
+        view = memoryview(buffer)[HEADER.size:].cast('i')
+        matrix_size = size * size
+        next_hop = view[2 * size:2 * size + matrix_size]
+        travel_time = view[2 * size + matrix_size:2 * size + 2 * matrix_size]
+        return cls(graph, next_hop, travel_time)
+
+    def find_path(self, source_location, target_location):
+        """Same contract as api.utils.dijkstra: (travel time, list of coordinates)"""
+        try:
+            source = self.index[source_location]
+            target = self.index[target_location]
+        except KeyError:
+            return float('inf'), []
+
+        time = self.travel_time[source * self.size + target]
+        if time == NO_PATH:
+            return float('inf'), []
+
+        path = [source_location]
+        current = source
+        while current != target:
+            current = self.next_hop[current * self.size + target]
+            path.append(self.coordinates[current])
+        return time, path
+
+    def get_travel_times(self, source_location):
+        """Travel time from source to every location by id, None when it can not be reached"""
+        travel_times = self.travel_times.get(source_location)
+        if travel_times is None:
+            source = self.index[source_location]
+            row = self.travel_time[source * self.size:(source + 1) * self.size]
+            travel_times = {
+                location_id: None if time == NO_PATH else time
+                for location_id, time in zip(self.location_ids, row)
+            }
+            if len(self.travel_times) >= TRAVEL_TIMES_CACHE_SIZE:
+                self.travel_times.pop(next(iter(self.travel_times), None), None)
+            self.travel_times[source_location] = travel_times
+        return travel_times
+
+
+class GraphSearch:
+    """Per-request searches over the world graph with the interface of TravelTable.
+
+    Serves a map whose table file was not built yet, the table is never built
+    on the request path.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.created = time.monotonic()
+        self.travel_times = {}
+
+    def find_path(self, source_location, target_location):
+        if source_location not in self.graph or target_location not in self.graph:
+            return float('inf'), []
+        return a_star(self.graph.adjacency, source_location, target_location)
+
+    def get_travel_times(self, source_location):
+        travel_times = self.travel_times.get(source_location)
+        if travel_times is None:
+            times = {source_location: 0}
+            queue = deque([source_location])
+            while queue:
+                current = queue.popleft()
+                for neighbor in self.graph.adjacency[current]:
+                    if neighbor not in times:
+                        times[neighbor] = times[current] + TIME_PER_LOCATION
+                        queue.append(neighbor)
+            travel_times = {
+                location['id']: times.get(coordinates) for coordinates, location in self.graph.locations.items()
+            }
+            if len(self.travel_times) >= TRAVEL_TIMES_CACHE_SIZE:
+                self.travel_times.pop(next(iter(self.travel_times), None), None)
+            self.travel_times[source_location] = travel_times
+        return travel_times
+
+
+def build_travel_table(graph=None, path=None):
+    graph = graph or get_world_graph()
+    path = path or settings.TRAVEL_TABLE_PATH
+    table = TravelTable.build(graph)
+    table.save(path)
+    graph.travel_table = table
+    return table
+
+
+def get_travel_table(graph=None):
+    """Table file of the graph, mapped once per process.
+
+    The file is only written by the build_travel_table command. Location edits
+    bump the world version (see api.world), readers then reload the graph and a
+    file built for other coordinates no longer loads. Until a matching file
+    exists, requests are served by a GraphSearch and the file is looked up again
+    every TRAVEL_TABLE_RETRY_INTERVAL seconds.
+    """
+    graph = graph or get_world_graph()
+    table = graph.travel_table
+    if table is None or isinstance(table, GraphSearch) \
+            and time.monotonic() - table.created > TRAVEL_TABLE_RETRY_INTERVAL:
+        table = TravelTable.load(settings.TRAVEL_TABLE_PATH, graph)
+        if table is None:
+            table = GraphSearch(graph)
+        graph.travel_table = table
+    return table
@@ -28,7 +28,11 @@ urlpatterns = [
     path('', include(router.urls)),
     path('createuser/', views.CreateUserView.as_view(), name='createuser'),
     path('token/', views.CreateTokenView.as_view(), name='token'),
-    path('me/', views.ManageUserView.as_view(), name='me')
+    path('me/', views.ManageUserView.as_view(), name='me'),
+    path('me/state/', views.PlayerStateView.as_view(), name='me-state'),
+    path('me/changes/', views.PlayerChangesView.as_view(), name='me-changes'),
+    path('content/', views.ContentSnapshotView.as_view(), name='content'),
+    path('metrics/', views.MetricsView.as_view(), name='metrics')
 ]
 
 if settings.DEBUG:
@@ -3,6 +3,7 @@ import heapq
 from queue import Queue
 from django.db.models import Q
 from api.models import Location
+from api.world import get_world_graph
 
 TIME_PER_LOCATION = 5
 
@@ -19,14 +20,7 @@ def calculate_shortets_travel_time(source_location, target_location):
 
 
 def create_adjacency_map():
-    adjacency_map = {}
-
-    all_locations = Location.objects.all()
-    for location in all_locations:
-        adjacency_map[location] = get_neighboring_locations(location)
-        print(adjacency_map[location])
-
-    return adjacency_map
+    return get_world_graph().adjacency
         
 
 class PathItem:
@@ -35,25 +29,71 @@ class PathItem:
         self.previous = previous
 
 
-def dijkstra(locations, source_location, target_location):
-    priority_queue = []
-    heapq.heappush(priority_queue, (0, source_location, [source_location]))
+def manhattan_distance(location, other_location):
+    return abs(location[0] - other_location[0]) + abs(location[1] - other_location[1])
+
+
+def region_cost(weights, graph=None):
+    """Edge cost scaled by the terrain weight of the region being entered.
+
+    Regions missing from ``weights`` cost the default TIME_PER_LOCATION. The
+    cheapest step of the map is kept in ``cost.min_cost`` for a_star's heuristic.
+    """
+    graph = graph or get_world_graph()
+
+    def cost(current_location, neighbor):
+        return TIME_PER_LOCATION * weights.get(graph.locations[neighbor]['region'], 1)
+
+    regions = {location['region'] for location in graph.locations.values()}
+    cost.min_cost = max(0, min((TIME_PER_LOCATION * weights.get(region, 1) for region in regions), default=0))
+    return cost
+
+
+def a_star(locations, source_location, target_location, cost=None, min_cost=None):
+    """Shortest path on the coordinate grid.
 
-    visited = set()
+    ``cost(current, neighbor)`` returns the price of a single step and defaults to
+    TIME_PER_LOCATION. ``min_cost`` is the cheapest possible step and scales the
+    Manhattan heuristic, it has to be a lower bound for the heuristic to stay admissible.
+    It defaults to the cost's own ``min_cost`` (see region_cost), or 0 for costs without one.
+    """
+    if locations is None:
+        locations = get_world_graph().adjacency
+    if min_cost is None:
+        min_cost = TIME_PER_LOCATION if cost is None else getattr(cost, 'min_cost', 0)
+
+    target_x, target_y = target_location
+    best_cost = {source_location: 0}
+    previous = {source_location: None}
+    # Ties on estimated cost are broken by the longer known path, which keeps the search narrow on an open grid
+    priority_queue = [(manhattan_distance(source_location, target_location) * min_cost, 0, source_location)]
 
     while priority_queue:
-        cost, current_location, path = heapq.heappop(priority_queue)
-    
-        if current_location in visited:
-            continue
+        _, negative_cost, current_location = heapq.heappop(priority_queue)
+        current_cost = -negative_cost
 
-        visited.add(current_location)
         if current_location == target_location:
-            return cost, path
-        
-        for neighboor in locations[current_location]:
-            if neighboor not in visited:
-                new_cost = cost + TIME_PER_LOCATION
-                heapq.heappush(priority_queue, (new_cost, neighboor, path + [neighboor]))
-    
-    return float('inf'), []
\ No newline at end of file
+            path = []
+            while current_location is not None:
+                path.append(current_location)
+                current_location = previous[current_location]
+            path.reverse()
+            return current_cost, path
+
+        if current_cost > best_cost[current_location]:
+            continue
+
+        for neighbor in locations[current_location]:
+            new_cost = current_cost + (TIME_PER_LOCATION if cost is None else cost(current_location, neighbor))
+            if new_cost < best_cost.get(neighbor, float('inf')):
+                best_cost[neighbor] = new_cost
+                previous[neighbor] = current_location
+                estimate = new_cost + (abs(neighbor[0] - target_x) + abs(neighbor[1] - target_y)) * min_cost
+                heapq.heappush(priority_queue, (estimate, -new_cost, neighbor))
+
+    return float('inf'), []
+
+
+def dijkstra(locations, source_location, target_location):
+    # Kept for existing callers, the search itself lives in a_star
+    return a_star(locations, source_location, target_location)
@@ -1,17 +1,35 @@
-from rest_framework import viewsets, mixins, generics, authentication, permissions, status
-from rest_framework.authentication import TokenAuthentication
+from rest_framework import viewsets, mixins, generics, permissions, status
 from rest_framework.authtoken.models import Token
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.renderers import BaseRenderer
 from rest_framework.response import Response
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.settings import api_settings
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
 from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.views import APIView
 from api import models
 from api import serializers
-from api.utils import dijkstra
-
+from api import caching
+from api.authentication import CachedTokenAuthentication
+from api.content import accepts_gzip, get_content_snapshot
+from api.metrics import registry, to_prometheus
+from api.notifications import notify, travel_payload
+from api.prefetch import optimize_queryset
+from api.renderers import FastJSONRenderer
+from api.sync import get_changes
+from api.travel_table import get_travel_table
+from api.world import get_world_graph
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.urls import reverse
 from django.utils import timezone
+from django.utils.http import parse_etags
 
 
 class BaseViewSet(viewsets.GenericViewSet,
@@ -19,20 +37,49 @@ class BaseViewSet(viewsets.GenericViewSet,
                   mixins.CreateModelMixin,
                   mixins.UpdateModelMixin,
                   mixins.RetrieveModelMixin):
-    authentication_classes = (TokenAuthentication, )
+    authentication_classes = (CachedTokenAuthentication, )
     permission_classes = (IsAuthenticated,)
 
     def partial_update(self, request, *args, **kwargs):
         # Do something with the partial update data
         return super().partial_update(request, *args, **kwargs)
 
+    # Synced rows take their version from the player's counter in pre_save (see
+    # api.sync), the counter and the row have to commit together or a sync
+    # reading in between skips the change
+    def create(self, request, *args, **kwargs):
+        with transaction.atomic():
+            return super().create(request, *args, **kwargs)
+
+    def update(self, request, *args, **kwargs):
+        with transaction.atomic():
+            return super().update(request, *args, **kwargs)
+
+
+class CachedReadMixin:
+    """Serve list and retrieve from an api.caching.ModelCache instead of the queryset"""
+    model_cache = None
+
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer(self.model_cache.all(), many=True)
+        return Response(serializer.data)
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            instance = self.model_cache.get(self.kwargs[self.lookup_url_kwarg or self.lookup_field])
+        except (self.model_cache.model.DoesNotExist, ValueError):
+            raise Http404
+        self.check_object_permissions(request, instance)
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+
 
 class ResourceViewSet(BaseViewSet):
     queryset = models.Resources.objects.all()
     serializer_class = serializers.ResourcesSerializer
 
     def get_queryset(self):
-        return models.Resources.objects.filter(user=self.request.user)
+        return optimize_queryset(models.Resources.objects.filter(user=self.request.user), self.serializer_class)
 
 
 class CreateUserView(generics.CreateAPIView):
@@ -59,7 +106,7 @@ class CreateTokenView(ObtainAuthToken):
 
 class ManageUserView(generics.RetrieveUpdateAPIView):
     serializer_class = serializers.UserSerializer
-    authentication_classes = (authentication.TokenAuthentication,)
+    authentication_classes = (CachedTokenAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_object(self):
@@ -75,7 +122,7 @@ class CharacterViewSet(BaseViewSet):
     
     @action(detail=False, methods=['GET'], url_path='get_all_stats')
     def get_all_stats(self, request):
-        character = models.Character.objects.get(user=request.user)
+        character = models.Character.objects.select_related('itemStats').get(user=request.user)
         items_stats = character.get_item_stats()
         character_data = self.serializer_class(character).data
         response_data = Response({
@@ -86,9 +133,10 @@ class CharacterViewSet(BaseViewSet):
         return response_data
 
 
-class ItemViewSet(BaseViewSet):
+class ItemViewSet(CachedReadMixin, BaseViewSet):
     serializer_class = serializers.ItemSerializer
     queryset = models.Item.objects.all()
+    model_cache = caching.item_cache
     parser_classes = (MultiPartParser, FormParser)
 
     def perform_create(self, serializer):
@@ -100,8 +148,7 @@ class CharacterItemViewSet(BaseViewSet):
     lookup_field = 'slot'
 
     def get_queryset(self):
-        character = models.Character.objects.get(user=self.request.user)
-        return models.CharacterItem.objects.filter(character=character)
+        return optimize_queryset(models.CharacterItem.objects.filter(character__user=self.request.user), self.serializer_class)
 
     @action(detail=True, methods=['patch'])
     def replace_item(self, request, slot=None):
@@ -115,16 +162,29 @@ class CharacterItemViewSet(BaseViewSet):
         if item:
             new_item = models.Item.objects.get(id=item)
             if new_item.lvlRequired > models.Resources.objects.get(user=self.request.user).lvl.lvl:
-                print('A')                         
                 return Response({'error': 'This item requires higher lvl'}, status=status.HTTP_400_BAD_REQUEST)
-            character_item.item = new_item
         else:
-            character_item.item = None
+            new_item = None
 
-        character_item.save()
+        character_item.equip(new_item)
         serializer = self.get_serializer(character_item)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=['patch'])
+    def replace_many(self, request):
+        """Swap a whole loadout given as {"items": {slot: item id or null}}"""
+        items = request.data.get('items')
+        try:
+            items = {slot: int(item) if item is not None else None for slot, item in items.items()}
+        except (AttributeError, TypeError, ValueError):
+            return Response({'error': 'Provide items as a mapping of slots to item ids'}, status=status.HTTP_400_BAD_REQUEST)
+
+        character_id = models.Character.objects.filter(user=self.request.user).values_list('pk', flat=True).get()
+        lvl = models.Resources.objects.select_related('lvl').get(user=self.request.user).lvl.lvl
+        character_items = models.CharacterItem.equip_many(character_id, items, lvl)
+        serializer = self.get_serializer(character_items, many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
 
 class UserItemViewSet(BaseViewSet):
     serializer_class = serializers.UserItemsSerializer
@@ -138,9 +198,10 @@ class UserItemViewSet(BaseViewSet):
         return models.UserItems.objects.filter(user=self.request.user)    
 
 
-class EnemyViewSet(BaseViewSet):
+class EnemyViewSet(CachedReadMixin, BaseViewSet):
     serializer_class = serializers.EnemySerializer
     queryset = models.Enemy.objects.all()
+    model_cache = caching.enemy_cache
     http_method_names = ['get']
 
 class EnemyLootViewSet(BaseViewSet):
@@ -149,16 +210,24 @@ class EnemyLootViewSet(BaseViewSet):
     lookup_field = 'enemy'
     http_method_names = ['get']
 
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer(caching.enemy_loot_cache.all(), many=True)
+        return Response(serializer.data)
+
 
 class LocationViewSet(BaseViewSet):
     serializer_class = serializers.LocationSerializer
     queryset = models.Location.objects.all()
     http_method_names = ['get', 'post']
 
+    def get_queryset(self):
+        return optimize_queryset(models.Location.objects.all(), self.serializer_class)
+
     @action(detail=False, methods=['POST'], url_path="travel")
     def travel(self, request):
         user = request.user
-        user_location = models.UserLocation.objects.get(user=user).location
+        user_location_object = models.UserLocation.objects.select_related('location').get(user=user)
+        user_location = user_location_object.location
         is_sublocation = request.data.get("parent_location")
         target_location_id = request.data.get("target_location_id")
 
@@ -168,32 +237,32 @@ class LocationViewSet(BaseViewSet):
         if is_sublocation:
             start_travel_time = timezone.now()
             travel_end_datetime = timezone.now()
-            target_location = models.SubLocation.objects.get(pk=target_location_id)
+            target_location = optimize_queryset(models.SubLocation.objects.all(), serializers.SubLocationSerializer).get(pk=target_location_id)
             target_location_serialized = serializers.SubLocationSerializer(target_location).data
             time = 1
             locations = []
 
         if not is_sublocation:
             try:
-                target_location = models.Location.objects.get(pk=target_location_id)
+                target_location = self.get_queryset().get(pk=target_location_id)
             except models.Location.DoesNotExist:
                 return Response({'error': "Target location not found"})
             
-            adjacency_map = self.build_adjacency_map()
-            time, path = dijkstra(adjacency_map, (user_location.xCoordinate, user_location.yCoordinate), (target_location.xCoordinate, target_location.yCoordinate))
+            world_graph = get_world_graph()
+            time, path = get_travel_table(world_graph).find_path((user_location.xCoordinate, user_location.yCoordinate), (target_location.xCoordinate, target_location.yCoordinate))
 
             if time == float('inf'):
                 return Response({'error': "No path found"}, status=status.HTTP_400_BAD_REQUEST)
 
-            locations = []
-            for item in path:
-                locations.append(models.Location.get_location_by_coordinates(item[0], item[1]).name)
+            locations = world_graph.get_names(path)
 
-            travel_end_datetime, start_travel_time = models.UserLocation.objects.get(user=user).update_travel_time(time)
+            with transaction.atomic():
+                # update_travel_time saves the row, so the new location is written with it
+                user_location_object.location = target_location
+                travel_end_datetime, start_travel_time = user_location_object.update_travel_time(time)
+                notify(user.pk, 'travelStarted', travel_payload(user_location_object))
 
             target_location_serialized = serializers.LocationSerializer(target_location).data
-        
-            models.UserLocation.objects.get(user=user).update_user_location(target_location_id)
 
         return Response({
             'travelTime': time, 
@@ -201,17 +270,35 @@ class LocationViewSet(BaseViewSet):
             'targetLocation': target_location_serialized,
             'travelEndDatetime': travel_end_datetime, 
             'travelStartTime': start_travel_time})
-    
-    def build_adjacency_map(self):
-        adjacency_map = {}
-        locations = models.Location.objects.all()
-
-        for location in locations:
-            neighbors = models.Location.get_neighboring_locations(location)
-            adjacency_map[(location.xCoordinate, location.yCoordinate)] = [
-                (neighbor.xCoordinate, neighbor.yCoordinate) for neighbor in neighbors
-            ]
-        return adjacency_map
+
+    @action(detail=False, methods=['GET'], url_path="reachability")
+    def reachability(self, request):
+        try:
+            user_location = models.UserLocation.objects.select_related('location').get(user=request.user).location
+        except models.UserLocation.DoesNotExist:
+            return Response({'error': "Player has no location"}, status=status.HTTP_400_BAD_REQUEST)
+        source = (user_location.xCoordinate, user_location.yCoordinate)
+
+        try:
+            travel_times = get_travel_table().get_travel_times(source)
+        except KeyError:
+            return Response({'error': "Current location is not on the map"}, status=status.HTTP_400_BAD_REQUEST)
+
+        location_ids = request.query_params.get('locations')
+        if location_ids:
+            try:
+                location_ids = [int(location_id) for location_id in location_ids.split(',')]
+            except ValueError:
+                return Response({'error': "Locations must be a comma separated list of ids"}, status=status.HTTP_400_BAD_REQUEST)
+            # Unreachable locations map to None, so ids off the map are rejected rather than reported the same way
+            unknown = [str(location_id) for location_id in location_ids if location_id not in travel_times]
+            if unknown:
+                return Response({'error': f"Unknown locations: {', '.join(unknown)}"}, status=status.HTTP_400_BAD_REQUEST)
+            travel_times = {location_id: travel_times[location_id] for location_id in location_ids}
+
+        return Response({
+            'sourceLocation': user_location.pk,
+            'travelTimes': travel_times})
         
 
 
@@ -220,7 +307,7 @@ class UserLocationViewSet(BaseViewSet):
     queryset = models.UserLocation.objects.all()
 
     def get_queryset(self):
-        return models.UserLocation.objects.filter(user=self.request.user)
+        return optimize_queryset(models.UserLocation.objects.filter(user=self.request.user), self.serializer_class)
 
 
 class StoreViewSet(BaseViewSet):
@@ -234,9 +321,12 @@ class StoreViewSet(BaseViewSet):
     http_method_names = ['get']
 
     def retrieve(self, request, pk=None):
-        items = models.StoreItem.objects.filter(store=pk)
-        potions = models.StorePotion.objects.filter(store=pk)
-        collectable = models.StoreCollectableItem.objects.filter(store=pk)
+        try:
+            items = caching.store_item_cache.filter(store=int(pk))
+        except ValueError:
+            raise Http404
+        potions = models.StorePotion.objects.filter(store=pk).select_related('potion')
+        collectable = models.StoreCollectableItem.objects.filter(store=pk).select_related('collectableItem')
 
         item_serializer = self.serializer_classes['items'](items, many=True, context={'request': request})
         potion_serializer = self.serializer_classes['potions'](potions, many=True, context={'request': request})
@@ -254,6 +344,11 @@ class StoreViewSet(BaseViewSet):
         location = models.UserLocation.objects.get(user=self.request.user)
         return models.Store.objects.filter(location=location.location)
 
+    def list(self, request, *args, **kwargs):
+        location = models.UserLocation.objects.get(user=self.request.user)
+        serializer = self.get_serializer(caching.store_cache.filter(location=location.location_id), many=True)
+        return Response(serializer.data)
+
 
 class StoreItemViewSet(BaseViewSet):
     serializer_class = serializers.StoreItemSerializer
@@ -261,6 +356,10 @@ class StoreItemViewSet(BaseViewSet):
     lookup_field = 'store'
     http_method_names = ['get']
 
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer(caching.store_item_cache.all(), many=True)
+        return Response(serializer.data)
+
 
 class StoreItemDetailViewSet(BaseViewSet):
     serializer_class = serializers.StoreItemSerializer
@@ -271,15 +370,50 @@ class StoreItemDetailViewSet(BaseViewSet):
     def perform_create(self, serializer):
         serializer.save(creator=self.request.user)
 
+class InventoryPagination(CursorPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = 'pk'
+
+
 class InventoryViewSet(BaseViewSet):
+    """Inventory split into cursor-paginated sections.
+
+    ``?section=`` returns a single section, ``?compact=true`` returns catalog ids
+    instead of nested objects and the items section takes the filters in ``item_filters``
+    and ``?equipped=true|false``.
+
+    The list used to be a plain array of UserItems. Clients now read each section's
+    ``results`` and follow its ``next`` link for the remaining pages.
+    """
     serializer_class = serializers.UserItemsSerializer
     serializer_classes = {
         'items': serializers.UserItemsSerializer,
         'potions': serializers.UserPotionsSerializer,
         'collectableItems': serializers.UserCollectableItemsSerializer,
     }
+    compact_serializer_classes = {
+        'items': serializers.UserItemsCompactSerializer,
+        'potions': serializers.UserPotionsCompactSerializer,
+        'collectableItems': serializers.UserCollectableItemsCompactSerializer,
+    }
+    section_models = {
+        'items': models.UserItems,
+        'potions': models.UserPotions,
+        'collectableItems': models.UserCollectableItem,
+    }
+    item_filters = {
+        'itemType': 'item__itemType',
+        'rarity': 'item__rarity',
+        'lvlRequired': 'item__lvlRequired',
+        'minLvlRequired': 'item__lvlRequired__gte',
+        'maxLvlRequired': 'item__lvlRequired__lte',
+    }
     queryset = models.UserItems.objects.all()
     parser_classes = (MultiPartParser, FormParser)
+    # Url the section links continue from, the request's url when None
+    links_url = None
 
     def get_queryset(self):
         user = self.request.user
@@ -288,23 +422,60 @@ class InventoryViewSet(BaseViewSet):
     def perform_create(self, serializer):
         serializer.save(creator=self.request.user)
 
-    
+    def get_section_queryset(self, section, serializer_class):
+        user = self.request.user
+        params = self.request.query_params
+        queryset = self.section_models[section].objects.filter(user=user)
 
-    def list(self, request):
-        user = request.user
-        items = models.UserItems.objects.filter(user=user)
-        potions = models.UserPotions.objects.filter(user=user)
-        collectable = models.UserCollectableItem.objects.filter(user=user)
-    
-        item_serializer = self.serializer_classes['items'](items, many=True, context={'request': request})
-        potion_serializer = self.serializer_classes['potions'](potions, many=True, context={'request': request})
-        collectable_serializer = self.serializer_classes['collectableItems'](collectable, many=True, context={'request': request})
+        if section == 'items':
+            try:
+                queryset = queryset.filter(**{
+                    lookup: params[param] for param, lookup in self.item_filters.items() if param in params
+                })
+            except ValueError:
+                raise ValidationError({'error': 'Invalid filter value'})
+            if 'equipped' in params:
+                equipped = Exists(models.CharacterItem.objects.filter(character__user=user, item=OuterRef('item')))
+                queryset = queryset.filter(equipped if params['equipped'].lower() in ('1', 'true') else ~equipped)
+
+        return optimize_queryset(queryset, serializer_class)
+
+    def paginate_section(self, section, serializer_class):
+        paginator = InventoryPagination()
+        page = paginator.paginate_queryset(self.get_section_queryset(section, serializer_class), self.request, view=self)
+        if self.links_url is not None:
+            paginator.base_url = self.links_url
+        serializer = serializer_class(page, many=True, context=self.get_serializer_context())
+        return paginator, serializer.data
 
-        data = {
-            'items': item_serializer.data,
-            'potions': potion_serializer.data,
-            'collectableItems': collectable_serializer.data
-        }
+    def list(self, request):
+        compact = request.query_params.get('compact', '').lower() in ('1', 'true')
+        serializer_classes = self.compact_serializer_classes if compact else self.serializer_classes
+
+        section = request.query_params.get('section')
+        if section is not None:
+            if section not in serializer_classes:
+                return Response({'error': 'Unknown inventory section'}, status=status.HTTP_400_BAD_REQUEST)
+            paginator, data = self.paginate_section(section, serializer_classes[section])
+            return paginator.get_paginated_response(data)
+
+        # A cursor belongs to the section whose links it came from, the others would be paged with it too
+        if 'cursor' in request.query_params:
+            return Response(
+                {'error': 'Pass a cursor together with the section it continues'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # First page of every section, links continue a single section
+        data = {}
+        for section, serializer_class in serializer_classes.items():
+            paginator, results = self.paginate_section(section, serializer_class)
+            next_link, previous_link = paginator.get_next_link(), paginator.get_previous_link()
+            data[section] = {
+                'next': next_link and replace_query_param(next_link, 'section', section),
+                'previous': previous_link and replace_query_param(previous_link, 'section', section),
+                'results': results,
+            }
 
         return Response(data, status=status.HTTP_200_OK)
     
@@ -336,7 +507,7 @@ class UserQuestViewSet(BaseViewSet):
 
 
     def get_queryset(self):
-        return models.UserQuest.objects.filter(user=self.request.user)
+        return optimize_queryset(models.UserQuest.objects.filter(user=self.request.user), self.serializer_class)
     
 
 class DialogViewSet(BaseViewSet):
@@ -349,3 +520,115 @@ class DialogViewSet(BaseViewSet):
         if npc:
             return models.Dialog.objects.filter(npc=npc)
         return models.Dialog.objects.all()
+
+
+class PlayerStateView(APIView):
+    """Everything the client loads after logging in, in one response.
+
+    Sections are the responses of the endpoints they replace, ``?fields=`` picks
+    a comma separated subset of them and query parameters such as
+    ``?compact=true`` are passed on to the sections that read them. ``version``
+    is the state version to continue from with /me/changes/.
+    """
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (IsAuthenticated,)
+    sections = {
+        'resources': (ResourceViewSet, 'list'),
+        'character': (CharacterViewSet, 'get_all_stats'),
+        'equipment': (CharacterItemViewSet, 'list'),
+        'inventory': (InventoryViewSet, 'list'),
+        'location': (UserLocationViewSet, 'list'),
+        'quests': (UserQuestViewSet, 'list'),
+    }
+
+    def get(self, request):
+        fields = request.query_params.get('fields')
+        names = fields.split(',') if fields else list(self.sections)
+        unknown = [name for name in names if name not in self.sections]
+        if unknown:
+            return Response({'error': f'Unknown sections: {", ".join(unknown)}'}, status=status.HTTP_400_BAD_REQUEST)
+        if 'cursor' in request.query_params:
+            return Response(
+                {'error': 'Inventory pages are fetched from /inventory/ with the section links'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Read first, a delta sync from this version may repeat changes but never misses one
+        data = {'version': models.StateVersion.get_version(request.user.pk)}
+        for name in names:
+            viewset, action_name = self.sections[name]
+            # The request is already authenticated, so sections skip the dispatch of their viewsets
+            view = viewset(request=request, args=(), kwargs={}, format_kwarg=None, action=action_name)
+            if viewset is InventoryViewSet:
+                view.links_url = self.get_inventory_url(request)
+            data[name] = getattr(view, action_name)(request).data
+        return Response(data)
+
+    def get_inventory_url(self, request):
+        """/inventory/ url with the query parameters the inventory section read"""
+        params = request.query_params.copy()
+        params.pop('fields', None)
+        url = request.build_absolute_uri(reverse('api:useritems-list'))
+        return f'{url}?{params.urlencode()}' if params else url
+
+
+class PlayerChangesView(APIView):
+    """Rows of the player's state changed after ``?since=<version>`` and ids of deleted rows, see api.sync"""
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        since = request.query_params.get('since')
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                return Response({'error': 'since must be a version number'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(get_changes(request, since))
+
+
+class ContentSnapshotView(APIView):
+    """Static game content in one bundle, revalidated with If-None-Match"""
+    # Cached tokens keep 304 responses free of DB queries
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        snapshot = get_content_snapshot(request)
+        use_gzip = accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        etag = snapshot.gzip_etag if use_gzip else snapshot.etag
+
+        if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if etag in if_none_match or '*' in if_none_match:
+            response = HttpResponseNotModified()
+        elif use_gzip:
+            response = HttpResponse(snapshot.gzip_body, content_type='application/json')
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(snapshot.body, content_type='application/json')
+
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        response['Vary'] = 'Accept-Encoding'
+        return response
+
+
+class PrometheusRenderer(BaseRenderer):
+    media_type = 'text/plain'
+    format = 'prometheus'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if 'routes' not in data:
+            return str(data)
+        return to_prometheus(data['routes'])
+
+
+class MetricsView(APIView):
+    """Per-route latency and DB usage, ?format=prometheus for the text exposition format"""
+    authentication_classes = (CachedTokenAuthentication, )
+    permission_classes = (IsAdminUser,)
+    renderer_classes = (FastJSONRenderer, PrometheusRenderer)
+
+    def get(self, request):
+        return Response({'routes': registry.snapshot()})
@@ -0,0 +1,95 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from api.caching import get_version, incr_version
+from api.models import Location
+
+
+NEIGHBOR_OFFSETS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+
+
+class WorldGraph:
+    """Coordinate-indexed view of the world map built from a single query"""
+
+    def __init__(self, locations, version=None):
+        self.version = version
+        # (x, y) -> {'id': ..., 'name': ..., 'region': ...}
+        self.locations = {}
+        for location in locations:
+            coordinates = (location['xCoordinate'], location['yCoordinate'])
+            # Keep the first location if two of them share the same coordinates
+            self.locations.setdefault(coordinates, {
+                'id': location['id'],
+                'name': location['name'],
+                'region': location['region'],
+            })
+
+        self.adjacency = {}
+        for x, y in self.locations:
+            self.adjacency[(x, y)] = [
+                (x + dx, y + dy) for dx, dy in NEIGHBOR_OFFSETS if (x + dx, y + dy) in self.locations
+            ]
+
+        # Filled lazily by api.travel_table
+        self.travel_table = None
+
+    def __contains__(self, coordinates):
+        return coordinates in self.locations
+
+    def get_location(self, coordinates):
+        return self.locations[coordinates]
+
+    def get_names(self, path):
+        return [self.locations[coordinates]['name'] for coordinates in path]
+
+
+WORLD_VERSION_KEY = 'api:world_version'
+
+
+def get_world_version():
+    return get_version(cache, WORLD_VERSION_KEY)
+
+
+def bump_world_version():
+    incr_version(cache, WORLD_VERSION_KEY)
+
+
+def load_world_graph(version=None):
+    return WorldGraph(
+        Location.objects.order_by('pk').values('id', 'name', 'region', 'xCoordinate', 'yCoordinate'), version
+    )
+
+
+_world_graph = None
+
+
+def get_world_graph():
+    """Graph of the current world version, shared by the requests of this process.
+
+    The version lives in the shared cache, so a map edited in one worker is
+    reloaded by the others on their next request.
+    """
+    global _world_graph
+    version = get_world_version()
+    graph = _world_graph
+    if graph is None or graph.version != version:
+        graph = load_world_graph(version)
+        # A change committed while loading may be missing from the rows, the next request loads it again
+        if get_world_version() == version:
+            _world_graph = graph
+    return graph
+
+
+def invalidate_world_graph():
+    global _world_graph
+    _world_graph = None
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def location_changed(sender, **kwargs):
+    invalidate_world_graph()
+    # Other workers reading before the commit would otherwise load old rows under the new version
+    transaction.on_commit(bump_world_version)